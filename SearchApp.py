@@ -1,15 +1,15 @@
 import streamlit as st
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
-import os
-import json
+import html
+import time
 
-# Initialize OpenAI client
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-
-ProgramindexName = "programs"
-ScholarshipIndexName = "scholar"
+from encoder import batcher_stats, get_embedding_cache, get_model, model_stats
+from es_clients import pool_stats
+from llm_cache import get_llm_cache
+from result_cache import get_result_cache
+from search_engine import (fetch_details, remote_fetch_details, remote_search, remote_search_stream, search,
+                           search_stream, stream_error_response)
+from settings import get_setting
+from telemetry import span, start_metrics_server, start_trace, waterfall
 
 st.set_page_config(
     page_title="Education Search",
@@ -104,374 +104,42 @@ st.markdown("""
         .stAlert {
             font-size: 16px !important;
         }
-    </style>
-""", unsafe_allow_html=True)
-def analyze_search_context(keywords, field_weights, client):
-    """
-    Use OpenAI to analyze search context and adjust field weights intelligently
-    """
-    system_prompt = """
-    You are a search context analyzer for an educational program search engine.
-    Analyze the search query and identify the importance of different aspects (score 0-10, where 10 is highest priority).
-    Output a JSON object with these fields:
-    - location_importance: score for location relevance
-    - university_importance: score for university name relevance
-    - course_importance: score for course/program relevance
-    - ranking_importance: score for university ranking relevance
-    - fee_importance: score for course fee relevance
-    - salary_importance: score for salary/career relevance
-    - qualification_importance: score for degree qualification relevance
-    - detected_location: the location mentioned in the query or null if none
-    """
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Analyze this search query: {keywords}"}
-            ],
-            temperature=0
-        )
         
-        # Extract and parse the JSON from the response
-        response_text = response.choices[0].message.content
-        try:
-            # Handle case where response might be already formatted as JSON
-            context_analysis = json.loads(response_text)
-        except json.JSONDecodeError:
-            # If the response contains explanation text, try to extract JSON portion
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            if start_idx != -1 and end_idx != 0:
-                json_str = response_text[start_idx:end_idx]
-                context_analysis = json.loads(json_str)
-            else:
-                raise ValueError("Could not extract JSON from response")
-
-        # Map importance scores to field weight adjustments
-        field_importance_mapping = {
-            "location": {
-                "fields": ["location", "locationVector", "city"],
-                "score": context_analysis["location_importance"]
-            },
-            "university": {
-                "fields": ["universityName", "universityNameVector"],
-                "score": context_analysis["university_importance"]
-            },
-            "course": {
-                "fields": ["courseTitle", "courseTitleVector", "courseDetail", "courseDetailVector"],
-                "score": context_analysis["course_importance"]
-            },
-            "ranking": {
-                "fields": ["worldRanking"],
-                "score": context_analysis["ranking_importance"]
-            },
-            "fee": {
-                "fields": ["courseFee"],
-                "score": context_analysis["fee_importance"]
-            },
-            "salary": {
-                "fields": ["averageStartingSalary"],
-                "score": context_analysis["salary_importance"]
-            },
-            "qualification": {
-                "fields": ["qualification", "qualificationVector"],
-                "score": context_analysis["qualification_importance"]
-            }
+        /* Timing waterfall */
+        .waterfall-row {
+            display: flex;
+            align-items: center;
+            font-size: 13px !important;
+            margin-bottom: 2px;
         }
         
-        # Adjust weights based on importance scores
-        adjusted_weights = field_weights.copy()
-        for importance_info in field_importance_mapping.values():
-            boost_factor = 1 + (importance_info["score"] / 10)  # Convert 0-10 score to multiplier
-            for field in importance_info["fields"]:
-                if field in adjusted_weights:
-                    adjusted_weights[field] *= boost_factor
-        
-        # Store detected location for later use
-        detected_location = context_analysis.get("detected_location")
-        if detected_location:
-            st.session_state['detected_location'] = detected_location
-        
-        return adjusted_weights, detected_location
-        
-    except Exception as e:
-        st.error(f"Error in context analysis: {e}")
-        return field_weights, None
-
-def normalize_location(location, client):
-    """
-    Normalize location abbreviations to full country names using OpenAI
-    """
-    system_prompt = """
-    You are a helper that converts country abbreviations to their full names.
-    Only respond with the full country name.
-    If the input is already a full country name, return it as is.
-    If the input is not a recognized country or abbreviation, return it as is.
-    """
-    
-    user_prompt = f"Convert this location if it's an abbreviation: {location}"
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0,
-            max_tokens=50
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Error normalizing location: {e}")
-        return location
-
-def extract_multiple_keywords(query):
-    """
-    Extract relevant keywords for multiple search queries using OpenAI
-    """
-    system_prompt = """
-    You are a helper that extracts relevant keywords from natural language queries about educational programs and scholarships.
-    If the query contains multiple distinct searches, separate them with '|||'.
-    For each search, provide essential keywords separated by commas.
-    Keep location abbreviations as is - they will be processed separately.
-    """
-    
-    user_prompt = f"Extract search keywords for each distinct search from this query: {query}"
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.3,
-            max_tokens=200
-        )
-        
-        keywords_sets = response.choices[0].message.content.strip().split('|||')
-        normalized_keywords_sets = []
-        
-        for keyword_set in keywords_sets:
-            keywords = [k.strip() for k in keyword_set.split(',')]
-            normalized_keywords = []
-            
-            for keyword in keywords:
-                # Check if keyword might be a location (simple heuristic)
-                if len(keyword) <= 3 or keyword.upper() == keyword:
-                    normalized_location = normalize_location(keyword, client)
-                    normalized_keywords.append(normalized_location)
-                else:
-                    normalized_keywords.append(keyword)
-            
-            normalized_keywords_sets.append(', '.join(normalized_keywords))
-        
-        return normalized_keywords_sets
-        
-    except Exception as e:
-        st.error(f"Error in keyword extraction: {e}")
-        return [query]
-
-def search_programs(input_keywords_list, model, client, max_results=10):
-    """
-    Enhanced semantic search for programs with location-specific filtering
-    """
-    all_results = {}
-    base_weights = {
-        "courseDetailVector": 1.0,
-        "overviewVector": 0.9,
-        "entryRequirementsVector": 0.7,
-        "scholarshipsFundingVector": 0.6,
-        "courseTitleVector": 1.0,
-        "universityNameVector": 0.8,
-        "locationVector": 1.2
-    }
-    
-    vector_fields = list(base_weights.keys())
-    location_specific_results = []
-    
-    try:
-        client1 = Elasticsearch(
-            "https://149ddf030ad64e34a068782db7c12c33.us-central1.gcp.cloud.es.io:443",
-            api_key="RlhmcEVwVUJ0VDVKQ3FBOFMyUDg6MWZSRll4eWJSWFdEdlZ0cjJZX2RsQQ=="
-        )
-    except Exception as e:
-        st.error(f"Error connecting to Elasticsearch: {e}")
-        return []
-    
-    for keywords in input_keywords_list:
-        # Get context-adjusted weights and detected location
-        adjusted_weights, detected_location = analyze_search_context(keywords, base_weights, client)
-        vector_of_input_keyword = model.encode(keywords)
+        .waterfall-label {
+            width: 35%;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
+        }
         
-        # If location is detected, normalize it
-        if detected_location:
-            detected_location = normalize_location(detected_location, client)
+        .waterfall-track {
+            position: relative;
+            width: 65%;
+            height: 14px;
+            background-color: #f1f3f5;
+            border-radius: 3px;
+        }
         
-        for field in vector_fields:
-            query = {
-                "field": field,
-                "query_vector": vector_of_input_keyword,
-                "k": max_results * 2,
-                "num_candidates": 1000
-            }
-            
-            try:
-                res = client1.knn_search(
-                    index=ProgramindexName,
-                    knn=query,
-                    source=['location', 'universityName', 'overview', 'worldRanking',
-                           'courseTitle', 'courseDetail', 'qualification', 'duration',
-                           'nextIntake', 'courseFee', 'city', 'averageStartingSalary']
-                )
-                
-                for hit in res["hits"]["hits"]:
-                    source = hit['_source']
-                    uni_id = f"{source['universityName']}_{source['courseTitle']}"
-                    score = hit["_score"] * adjusted_weights[field]
-                    
-                    # Check if the result matches the detected location
-                    source_location = str(source.get('location', '')).lower()
-                    location_match = (
-                        detected_location and 
-                        detected_location.lower() in source_location
-                    )
-                    
-                    # Only add to results if location matches (when location is specified)
-                    if detected_location:
-                        if location_match:
-                            if uni_id not in location_specific_results:
-                                location_specific_results.append(uni_id)
-                            if uni_id in all_results:
-                                all_results[uni_id]["score"] += score * 2.0  # Double score for location match
-                            else:
-                                all_results[uni_id] = {
-                                    "hit": hit,
-                                    "score": score * 2.0,
-                                    "location": source_location
-                                }
-                    else:
-                        # If no location specified, add all results
-                        if uni_id in all_results:
-                            all_results[uni_id]["score"] += score
-                        else:
-                            all_results[uni_id] = {
-                                "hit": hit,
-                                "score": score,
-                                "location": source_location
-                            }
-                        
-            except Exception as e:
-                st.warning(f"Warning: Search failed for field {field}: {str(e)}")
-                continue
-    
-    # Handle location-specific results
-    if detected_location:
-        if not location_specific_results:
-            st.warning(f"⚠️ No programs found in {detected_location}.")
-            return []  # Return empty list if no programs found in specified location
-        else:
-            # Only return results from the specified location
-            filtered_results = {k: v for k, v in all_results.items() 
-                              if k in location_specific_results}
-            sorted_results = sorted(filtered_results.values(), 
-                                  key=lambda x: x["score"], 
-                                  reverse=True)
-            return [item["hit"] for item in sorted_results[:max_results]]
-    
-    # If no location specified, return all results
-    sorted_results = sorted(all_results.values(), 
-                          key=lambda x: x["score"], 
-                          reverse=True)
-    return [item["hit"] for item in sorted_results[:max_results]]
-
-def search_scholarships(input_keywords_list, model, client, max_results=10):
-    """
-    Enhanced semantic search for scholarships with OpenAI context analysis
-    """
-    all_results = {}
-    base_weights = {
-        "universityNameVector": 0.8,
-        "titleVector": 1.0,
-        "fundingDetailsVector": 0.9,
-        "qualificationVector": 0.7,
-        "locationVector": 0.6
-    }
-    
-    vector_fields = list(base_weights.keys())
-    location_results = {}
-    
-    try:
-        # Initialize Elasticsearch client for scholarships
-        client2 = Elasticsearch(
-            "https://149ddf030ad64e34a068782db7c12c33.us-central1.gcp.cloud.es.io:443",
-            api_key="LTNmdkVwVUJ0VDVKQ3FBOFdtUzE6UXpPSThOZXhSaFNDcm50UUNNYThoZw=="
-        )
-    except Exception as e:
-        st.error(f"Error connecting to Elasticsearch: {e}")
-        return []
-    
-    for keywords in input_keywords_list:
-        adjusted_weights, detected_location = analyze_search_context(keywords, base_weights, client)
-        vector_of_input_keyword = model.encode(keywords)
+        .waterfall-bar {
+            position: absolute;
+            height: 14px;
+            background-color: #4c6ef5;
+            border-radius: 3px;
+        }
         
-        for field in vector_fields:
-            query = {
-                "field": field,
-                "query_vector": vector_of_input_keyword,
-                "k": max_results * 2,
-                "num_candidates": 1000
-            }
-            
-            try:
-                res = client2.knn_search(
-                    index=ScholarshipIndexName,
-                    knn=query,
-                    source=['universityName', 'location', 'title', 'qualification', 
-                           'fundingDetails', 'deadline', 'eligibleIntake', 'studyMode']
-                )
-                
-                for hit in res["hits"]["hits"]:
-                    scholarship_id = f"{hit['_source']['universityName']}_{hit['_source']['title']}"
-                    score = hit["_score"] * adjusted_weights[field]
-                    
-                    source = hit['_source']
-                    source_location = str(source.get('location', '')).lower()
-                    
-                    if detected_location and detected_location.lower() in source_location:
-                        score *= 2.0
-                        
-                    if scholarship_id in all_results:
-                        all_results[scholarship_id]["score"] += score
-                    else:
-                        all_results[scholarship_id] = {
-                            "hit": hit,
-                            "score": score,
-                            "location": source_location
-                        }
-                        
-                    if detected_location:
-                        if detected_location not in location_results:
-                            location_results[detected_location] = []
-                        if scholarship_id not in location_results[detected_location]:
-                            location_results[detected_location].append(scholarship_id)
-                        
-            except Exception as e:
-                st.warning(f"Warning: Search failed for field {field}: {str(e)}")
-                continue
-    
-    if detected_location and (detected_location not in location_results or not location_results[detected_location]):
-        st.warning(f"⚠️ No scholarships found in {detected_location}. Showing results from other locations.")
-    
-    sorted_results = sorted(all_results.values(), 
-                          key=lambda x: x["score"], 
-                          reverse=True)
-    
-    return [item["hit"] for item in sorted_results[:max_results]]
-
+        .waterfall-bar.error {
+            background-color: #fa5252;
+        }
+    </style>
+""", unsafe_allow_html=True)
 def display_program_results(results):
     """
     Display program search results in an organized format
@@ -572,11 +240,168 @@ def display_scholarship_results(results):
                 
                 st.markdown('</div>', unsafe_allow_html=True)
 
+def display_messages(messages):
+    """
+    Show the warnings and errors a search returned
+    """
+    for message in messages:
+        if message["level"] == "error":
+            st.error(message["message"])
+        elif message["level"] == "warning":
+            st.warning(message["message"])
+        else:
+            st.info(message["message"])
+
+def load_details(search_type, results, service_url=None):
+    """
+    Add the detail fields to the results of the page being shown; results
+    not loaded before are fetched in one batch
+    """
+    details = st.session_state.setdefault('result_details', {})
+    missing = [result['_id'] for result in results if result['_id'] not in details]
+    if missing:
+        if service_url:
+            response = remote_fetch_details(service_url, search_type, missing)
+        else:
+            response = fetch_details(search_type, missing)
+        display_messages(response["messages"])
+        details.update(response["documents"])
+        if not response["messages"]:
+            # Don't ask again for documents that no longer exist
+            for doc_id in missing:
+                details.setdefault(doc_id, {})
+    
+    return [dict(result, _source={**result['_source'], **details.get(result['_id'], {})}) for result in results]
+
+def set_results_page(page):
+    st.session_state['results_page'] = page
+
+def display_pagination(page, page_count, first, last, total):
+    """
+    Show the page position and previous/next buttons
+    """
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    with prev_col:
+        st.button("◀ Previous", disabled=page == 0, on_click=set_results_page, args=(page - 1,))
+    with page_col:
+        st.caption(f"Results {first}–{last} of {total} · page {page + 1} of {page_count}")
+    with next_col:
+        st.button("Next ▶", disabled=page >= page_count - 1, on_click=set_results_page, args=(page + 1,))
+
+def display_results(response, service_url=None):
+    """
+    Show the messages of a search and the current page of its results
+    """
+    display_messages(response["messages"])
+    if response.get("cached_from"):
+        st.caption(f"Results of the similar query \"{response['cached_from']['query']}\" "
+                   f"(similarity {response['cached_from']['similarity']:.2f})")
+    if response["detected_location"]:
+        st.session_state['detected_location'] = response["detected_location"]
+    
+    results = response["results"]
+    if any(message["level"] == "error" and message["code"] == "search_failed"
+           for message in response["messages"]):
+        st.info("Please try again with a different search query.")
+        return
+    
+    if response["type"] == "Scholarships":
+        if not results:
+            st.info("No matching scholarships found. Try broadening your search criteria.")
+            return
+        st.success(f"Found {len(results)} matching scholarships!")
+    elif not results:
+        return
+    
+    # Only the page being shown is loaded in full and rendered
+    page_size = max(get_setting("RESULTS_PAGE_SIZE", 10, int), 1)
+    page_count = (len(results) + page_size - 1) // page_size
+    page = min(max(st.session_state.get('results_page', 0), 0), page_count - 1)
+    first = page * page_size
+    page_results = load_details(response["type"], results[first:first + page_size], service_url)
+    
+    with span("render", results=len(page_results), page=page):
+        if response["type"] == "Programs":
+            display_program_results(page_results)
+        else:
+            display_scholarship_results(page_results)
+    
+    if page_count > 1:
+        display_pagination(page, page_count, first + 1, first + len(page_results), len(results))
+
+def display_provisional_results(response):
+    """
+    Show a provisional ranking in summary form, marked as still being refined
+    """
+    if response["stage"] == "preview":
+        st.caption("⏳ First results for your query as typed · refining while it is analyzed…")
+    else:
+        st.caption("⏳ Provisional ranking from the results received so far · refining…")
+    
+    page_size = max(get_setting("RESULTS_PAGE_SIZE", 10, int), 1)
+    for position, result in enumerate(response["results"][:page_size], 1):
+        source = result['_source']
+        title = source.get('courseTitle' if response["type"] == "Programs" else 'title', 'N/A')
+        st.markdown(f"**{position}. {title}**  \n"
+                    f"{source.get('universityName', 'N/A')} · {source.get('location', 'N/A')}")
+
+def stream_search(placeholder, search_query, search_type, max_results, model, service_url, include_trace):
+    """
+    Run a search that refines its ranking in place until the final results
+    arrive; returns the final response, or an error response when the stream
+    ended without one
+    """
+    start = time.perf_counter()
+    placeholder.info("🔄 Processing your query...")
+    if service_url:
+        updates = remote_search_stream(service_url, search_query, search_type, max_results,
+                                       include_trace=include_trace)
+    else:
+        updates = search_stream(search_query, search_type, max_results, model)
+    
+    for response in updates:
+        if response["final"]:
+            return response
+        with placeholder.container():
+            with span("render", results=len(response["results"]), stage=response["stage"]):
+                display_provisional_results(response)
+    return stream_error_response(search_query, search_type, start, "the search ended without final results")
+
+def display_waterfall(rows, trace_id):
+    """
+    Show the stages of a search as a timing waterfall
+    """
+    total_ms = max(rows[0]["duration_ms"], 1e-3)
+    with st.expander(f"⏱️ Query Waterfall ({total_ms:.0f} ms)", expanded=True):
+        bars = []
+        for row in rows:
+            left = row["offset_ms"] / total_ms * 100
+            width = max(row["duration_ms"] / total_ms * 100, 0.5)
+            details = ", ".join(f"{key}={value}" for key, value in row["attributes"].items())
+            if row["error"]:
+                details = f"{details}, error={row['error']}" if details else f"error={row['error']}"
+            label = html.escape(f"{row['name']} · {row['duration_ms']:.1f} ms")
+            bars.append(
+                f'<div class="waterfall-row" title="{html.escape(details)}">'
+                f'<div class="waterfall-label" style="padding-left: {row["depth"] * 12}px">{label}</div>'
+                f'<div class="waterfall-track"><div class="waterfall-bar{" error" if row["error"] else ""}" '
+                f'style="left: {left:.2f}%; width: {min(width, 100 - left):.2f}%"></div></div></div>'
+            )
+        st.markdown("".join(bars), unsafe_allow_html=True)
+        st.caption(f"Trace {trace_id} · hover a stage for its attributes")
+
 def main():
     st.markdown('<h1 class="main-title">🎓 Education Program & Scholarship Search</h1>', unsafe_allow_html=True)
     
-    # Initialize the model
-    model = SentenceTransformer('all-mpnet-base-v2')
+    # With SEARCH_SERVICE_URL the searches run on the search service, so this
+    # process doesn't need the model
+    service_url = get_setting("SEARCH_SERVICE_URL")
+    
+    # Shared, pre-warmed model (loaded once per process, not on every rerun)
+    model = None if service_url else get_model()
+    
+    # Prometheus /metrics endpoint, when METRICS_PORT is set
+    start_metrics_server()
     
     # Create two columns for the layout
     search_col, filter_col = st.columns([2, 1])
@@ -605,40 +430,73 @@ def main():
         st.markdown("### ⚙️ Search Filters")
         max_results = st.slider("Maximum Results", 1, 50, 10)
         
+        stats = model_stats()
+        if stats:
+            memory = stats.get('resident_memory_mb')
+            memory_text = f"{memory:.0f} MB resident" if memory is not None else "memory N/A"
+            st.caption(f"Model {stats['model_name']} ({stats['backend']}) loaded in {stats['load_seconds']:.1f}s · {memory_text}")
+        
+        connection_stats = pool_stats()
+        if connection_stats:
+            with st.expander("🔌 Connection Pools"):
+                st.json(connection_stats)
+        
+        with st.expander("🧠 LLM Cache"):
+            st.json(get_llm_cache().stats())
+        
+        with st.expander("🧮 Embedding Cache"):
+            st.json(get_embedding_cache(model).stats())
+        
+        with st.expander("🗂️ Result Cache"):
+            st.json(get_result_cache().stats())
+        
+        encoder_batches = batcher_stats()
+        if encoder_batches:
+            with st.expander("📦 Encoder Batching"):
+                st.json(encoder_batches)
+        
+        show_waterfall = st.checkbox("Show timing waterfall", value=get_setting("DEBUG_PANEL", False, bool))
     
     if st.button("🔍 Search", type="primary"):
         if search_query:
-            with st.spinner("🔄 Processing your query..."):
-                keywords_list = extract_multiple_keywords(search_query)
-                
-                try:
-                    if search_type == "Programs":
-                        program_results = search_programs(
-                            keywords_list, 
-                            model,
-                            client,
-                            max_results=max_results
-                        )
-                        if program_results:
-                            display_program_results(program_results)
-                    else:
-                        scholarship_results = search_scholarships(
-                            keywords_list,
-                            model,
-                            client,
-                            max_results=max_results
-                        )
-                        if scholarship_results:
-                            st.success(f"Found {len(scholarship_results)} matching scholarships!")
-                            display_scholarship_results(scholarship_results)
+            # Streamed searches show a provisional ranking first and refine it in place
+            streamed = get_setting("STREAM_RESULTS", True, bool)
+            placeholder = st.empty()
+            with start_trace("search", search_type=search_type, max_results=max_results,
+                             service=bool(service_url), stream=streamed) as trace:
+                if streamed:
+                    response = stream_search(placeholder, search_query, search_type, max_results, model,
+                                             service_url, show_waterfall)
+                else:
+                    with st.spinner("🔄 Processing your query..."):
+                        if service_url:
+                            response = remote_search(service_url, search_query, search_type, max_results,
+                                                     include_trace=show_waterfall)
                         else:
-                            st.info("No matching scholarships found. Try broadening your search criteria.")
+                            response = search(search_query, search_type, max_results, model)
                 
-                except Exception as e:
-                    st.error(f"An error occurred during search: {str(e)}")
-                    st.info("Please try again with a different search query.")
+                # Kept for reruns, e.g. when the user changes the results page
+                st.session_state['search_response'] = response
+                st.session_state['search_request'] = (search_query, search_type, max_results)
+                st.session_state['results_page'] = 0
+                st.session_state['result_details'] = {}
+                with placeholder.container():
+                    if streamed:
+                        st.caption("✅ Final ranking")
+                    display_results(response, service_url)
+            
+            if show_waterfall:
+                # A search service returns the waterfall of the search it ran
+                if response.get("trace"):
+                    display_waterfall(response["trace"], response.get("trace_id"))
+                else:
+                    display_waterfall(waterfall(trace), trace.trace_id)
         else:
             st.warning("Please enter a search query.")
+    elif st.session_state.get('search_request') == (search_query, search_type, max_results):
+        # Page changes rerun the script: show the stored results without searching again,
+        # as long as they answer the inputs on screen
+        display_results(st.session_state['search_response'], service_url)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,158 @@
+"""
+Offline batch search: runs a JSONL file of queries through the search engine
+with a pool of worker threads and streams the responses to a JSONL file as
+they finish.
+
+    python batch_search.py queries.jsonl results.jsonl --workers 8 --llm-rps 5 --es-rps 50
+    python batch_search.py queries.jsonl results.jsonl --resume
+
+Each input line is {"id": ..., "query": "...", "type": "Programs" |
+"Scholarships", "max_results": 10}; only "query" is required and the id
+defaults to the line number. Each output line is the search response plus the
+id. With --resume, queries whose last output line is a complete answer are
+skipped and the rest are appended, so the last line of an id wins.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from search_engine import cacheable
+from search_service import parse_search_request
+
+# Progress is printed every this many finished queries
+PROGRESS_EVERY = 100
+
+
+def read_requests(path):
+    """
+    Yield (id, query, search_type, max_results) per valid input line; invalid
+    lines are reported and skipped
+    """
+    with open(path, encoding="utf-8") as source:
+        for line_number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                query, search_type, max_results, _ = parse_search_request(record)
+            except ValueError as e:
+                print(f"Skipping line {line_number}: {e}", file=sys.stderr)
+                continue
+            yield record.get("id", line_number), query, search_type, max_results
+
+
+def completed_ids(path):
+    """
+    Return the ids whose last response in an earlier output file is complete:
+    no errors, failed field queries or LLM stages skipped for the budget
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as source:
+        for line in source:
+            try:
+                response = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut off when the earlier run was stopped
+            doc_id = json.dumps(response.get("id"))
+            if cacheable(response.get("messages", [])):
+                done.add(doc_id)
+            else:
+                done.discard(doc_id)
+    return done
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as source:
+        source.seek(-1, os.SEEK_END)
+        return source.read(1) == b"\n"
+
+
+def run_batch(requests, output, workers, engine, skip=frozenset()):
+    """
+    Search every request with at most workers in flight and append each
+    response to output as soon as it finishes; returns (searched, failed)
+    """
+    import search_engine
+    from encoder import get_model
+
+    model = get_model()
+    write_lock = threading.Lock()
+    searched = failed = 0
+    start = time.perf_counter()
+
+    def run(request):
+        doc_id, query, search_type, max_results = request
+        response = search_engine.search(query, search_type, max_results, model, engine)
+        line = json.dumps({"id": doc_id, **response}, ensure_ascii=False)
+        with write_lock:
+            output.write(line + "\n")
+            output.flush()
+        return any(message["level"] == "error" for message in response["messages"])
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-search") as executor:
+        pending = set()
+        for request in requests:
+            if json.dumps(request[0]) in skip:
+                continue
+            # Bounded window, so a large input isn't queued all at once
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    searched += 1
+                    failed += future.result()
+                    if searched % PROGRESS_EVERY == 0:
+                        elapsed = time.perf_counter() - start
+                        print(f"{searched} queries in {elapsed:.0f}s ({searched / elapsed:.1f} q/s, {failed} failed)")
+            pending.add(executor.submit(run, request))
+        for future in pending:
+            searched += 1
+            failed += future.result()
+    return searched, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of queries through the search engine")
+    parser.add_argument("input", help="JSONL queries: {\"id\", \"query\", \"type\", \"max_results\"}")
+    parser.add_argument("output", help="JSONL file the search responses are appended to")
+    parser.add_argument("--workers", type=int, default=8, help="Queries in flight at once")
+    parser.add_argument("--engine", choices=["async", "sync"], help="SEARCH_ENGINE (default: setting)")
+    parser.add_argument("--llm-rps", type=float, help="OpenAI requests per second (LLM_RATE_LIMIT)")
+    parser.add_argument("--es-rps", type=float, help="Elasticsearch requests per second (ES_RATE_LIMIT)")
+    parser.add_argument("--llm-budget-ms", type=float, default=30000,
+                        help="LLM latency budget per query; offline runs can wait longer than the UI")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip queries the output already answered completely")
+    args = parser.parse_args()
+
+    # Read by the engine when it creates its rate limiters and budgets. A call's
+    # timeout is capped by LLM_TIMEOUT_MS too, so it is raised with the budget.
+    os.environ["LLM_BUDGET_MS"] = str(args.llm_budget_ms)
+    os.environ["LLM_TIMEOUT_MS"] = str(args.llm_budget_ms)
+    # Every query is searched: a near-duplicate must not get another query's cached results
+    os.environ["RESULT_CACHE_MAX_ENTRIES"] = "0"
+    if args.llm_rps:
+        os.environ["LLM_RATE_LIMIT"] = str(args.llm_rps)
+    if args.es_rps:
+        os.environ["ES_RATE_LIMIT"] = str(args.es_rps)
+
+    skip = completed_ids(args.output) if args.resume else frozenset()
+    if skip:
+        print(f"Resuming: {len(skip)} queries already answered")
+
+    start = time.perf_counter()
+    with open(args.output, "a" if args.resume else "w", encoding="utf-8") as output:
+        if output.tell() and not _ends_with_newline(args.output):
+            output.write("\n")  # don't append to a line cut off by an earlier run
+        searched, failed = run_batch(read_requests(args.input), output, args.workers, args.engine, skip)
+    elapsed = time.perf_counter() - start
+    print(f"Searched {searched} queries in {elapsed:.1f}s ({failed} with errors), results in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Context scorer calibration: fits the similarity-to-score mapping of the local
+context scorer (CONTEXT_SCORE_FLOOR / CONTEXT_SCORE_CEILING, see
+context_scorer.py) to the importance scores of the LLM context analysis, and
+reports how well the two agree.
+
+    python -m benchmarks.context_calibration --log context_log.jsonl
+    python -m benchmarks.context_calibration --log context_log.jsonl --no-llm --output calibration.json
+
+The LLM analyses are logged to --log (one {"keywords", "analysis"} line per
+keyword set); keyword sets already in the log are not sent again, and with
+--no-llm only the log is used. The corpus queries are scored as typed, like a
+single-intent search. For the current and the fitted constants it reports the
+mean absolute score error, how often both pick the same most important aspect,
+and the cosine similarity of the field weights each analysis produces, which
+is what the search actually uses.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from benchmarks.replay import DEFAULT_QUERIES, load_queries
+from context_scorer import LOCATION_MENTIONED_SCORE, prototype_similarities, similarity_score
+from encoder import encode_queries, get_model
+from llm_cache import cached_completion
+from locations import find_location
+from query_understanding import IMPORTANCE_FIELDS
+from search_engine import (CONTEXT_ANALYSIS_PROMPT, PROGRAM_BASE_WEIGHTS, SCHOLARSHIP_BASE_WEIGHTS,
+                           apply_context_analysis, get_openai_client, parse_context_analysis)
+from settings import get_setting
+
+BASE_WEIGHTS = {"Programs": PROGRAM_BASE_WEIGHTS, "Scholarships": SCHOLARSHIP_BASE_WEIGHTS}
+
+
+def read_log(path):
+    """
+    Return {keywords: LLM analysis} from an earlier log
+    """
+    logged = {}
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as source:
+            for line in source:
+                if line.strip():
+                    record = json.loads(line)
+                    logged[record["keywords"]] = record["analysis"]
+    return logged
+
+
+def llm_analysis(keywords):
+    """
+    Ask the context analysis prompt of the search for a keyword set
+    """
+    return parse_context_analysis(cached_completion(
+        get_openai_client(),
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": CONTEXT_ANALYSIS_PROMPT},
+            {"role": "user", "content": f"Analyze this search query: {keywords}"}
+        ],
+        stage="context_analysis",
+        temperature=0
+    ))
+
+
+def local_analysis(similarities, location, floor, ceiling):
+    """
+    The analysis context_scorer.score_context returns for the given constants
+    """
+    analysis = {field: similarity_score(similarities[field], floor, ceiling) for field in IMPORTANCE_FIELDS}
+    if location:
+        analysis["location_importance"] = max(analysis["location_importance"], LOCATION_MENTIONED_SCORE)
+    return analysis
+
+
+def _weights(analysis, search_type):
+    weights, _ = apply_context_analysis(analysis, dict(BASE_WEIGHTS[search_type]))
+    return np.array([weights[field] for field in BASE_WEIGHTS[search_type]], dtype=np.float64)
+
+
+def agreement(samples, floor, ceiling):
+    """
+    Compare the local analyses for floor/ceiling with the LLM analyses
+    """
+    errors, same_top, weight_similarity = [], [], []
+    for sample in samples:
+        local = local_analysis(sample["similarities"], sample["location"], floor, ceiling)
+        llm = sample["llm"]
+        errors.extend(abs(local[field] - float(llm[field])) for field in IMPORTANCE_FIELDS)
+        llm_top = max(IMPORTANCE_FIELDS, key=lambda field: float(llm[field]))
+        same_top.append(max(IMPORTANCE_FIELDS, key=local.get) == llm_top)
+        local_weights, llm_weights = _weights(local, sample["type"]), _weights(llm, sample["type"])
+        norm = np.linalg.norm(local_weights) * np.linalg.norm(llm_weights)
+        weight_similarity.append(float(local_weights @ llm_weights / norm) if norm else 0.0)
+    return {
+        "floor": floor,
+        "ceiling": ceiling,
+        "mae": float(np.mean(errors)),
+        "top_aspect_agreement": float(np.mean(same_top)),
+        "weight_similarity": float(np.mean(weight_similarity))
+    }
+
+
+def fit(samples, step=0.02):
+    """
+    Grid search the floor and ceiling with the smallest mean absolute error
+    """
+    best = None
+    for floor in np.arange(-0.2, 0.8, step):
+        for ceiling in np.arange(floor + 0.1, 1.0 + step / 2, step):
+            result = agreement(samples, round(float(floor), 3), round(float(ceiling), 3))
+            if best is None or result["mae"] < best["mae"]:
+                best = result
+    return best
+
+
+def field_correlations(samples):
+    """
+    Pearson correlation of prototype similarity and LLM score per aspect; a
+    low value means no floor/ceiling can make the two agree
+    """
+    correlations = {}
+    for field in IMPORTANCE_FIELDS:
+        similarities = np.array([sample["similarities"][field] for sample in samples])
+        scores = np.array([float(sample["llm"][field]) for sample in samples])
+        if similarities.std() and scores.std():
+            correlations[field] = float(np.corrcoef(similarities, scores)[0, 1])
+        else:
+            correlations[field] = None
+    return correlations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the local context scorer to the LLM context analysis")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="JSONL query corpus")
+    parser.add_argument("--log", default="context_log.jsonl", help="JSONL log of LLM analyses, read and extended")
+    parser.add_argument("--no-llm", action="store_true", help="Only use the analyses already in the log")
+    parser.add_argument("--output", help="Write the report as JSON")
+    args = parser.parse_args()
+
+    records = load_queries(args.queries)
+    logged = read_log(args.log)
+    model = get_model()
+
+    samples = []
+    with open(args.log, "a", encoding="utf-8") as log:
+        for record in records:
+            keywords = record["query"]
+            analysis = logged.get(keywords)
+            if analysis is None:
+                if args.no_llm:
+                    continue
+                try:
+                    analysis = llm_analysis(keywords)
+                except Exception as e:
+                    print(f"Skipping {keywords!r}: {e}")
+                    continue
+                log.write(json.dumps({"keywords": keywords, "analysis": analysis}) + "\n")
+            samples.append({
+                "type": record.get("type", "Programs"),
+                "llm": analysis,
+                "location": find_location(keywords),
+                "similarities": prototype_similarities(encode_queries(model, [keywords])[0], model)
+            })
+    if not samples:
+        print("No LLM analyses to calibrate against")
+        return
+
+    current = agreement(samples, get_setting("CONTEXT_SCORE_FLOOR", 0.2, float),
+                        get_setting("CONTEXT_SCORE_CEILING", 0.6, float))
+    fitted = fit(samples)
+    correlations = field_correlations(samples)
+
+    print(f"{len(samples)} keyword sets\n")
+    print(f"{'constants':<12}{'floor':>8}{'ceiling':>9}{'MAE':>8}{'top aspect':>12}{'weights cos':>13}")
+    for name, result in (("current", current), ("fitted", fitted)):
+        print(f"{name:<12}{result['floor']:>8.2f}{result['ceiling']:>9.2f}{result['mae']:>8.2f}"
+              f"{result['top_aspect_agreement']:>12.2f}{result['weight_similarity']:>13.3f}")
+    print("\nSimilarity/LLM score correlation per aspect")
+    for field, value in correlations.items():
+        print(f"  {field:<26}{value:>7.2f}" if value is not None else f"  {field:<26}{'-':>7}")
+    print(f"\nCONTEXT_SCORE_FLOOR={fitted['floor']} CONTEXT_SCORE_CEILING={fitted['ceiling']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump({"samples": len(samples), "current": current, "fitted": fitted,
+                       "correlations": correlations}, out, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Encoder evaluation: measures the query encoding latency of encoder backends
+and models against how well their retrieval agrees with the reference encoder
+(full precision all-mpnet-base-v2) on the real indices.
+
+    python -m benchmarks.encoder_eval --configs torch torch-int8 onnx onnx-int8 --threads 1 4
+    python -m benchmarks.encoder_eval --configs onnx-int8 my-distilled-mpnet:onnx --output encoders.json
+
+A config is "backend" (the reference model) or "model:backend". For every
+config and thread count it reports single-query p50/p95 latency, batch
+throughput, the cosine similarity of its query vectors to the reference
+vectors, and the mean top-k overlap and top-1 agreement of the kNN results per
+vector field. Elasticsearch (or the local backend) is read with the usual
+ES_URL / SEARCH_BACKEND settings.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from benchmarks.replay import DEFAULT_QUERIES, load_queries
+from encoder import DEFAULT_MODEL_NAME, ENCODER_BACKENDS, load_encoder, resident_memory_mb
+from es_clients import get_es_client
+from retrieval import knn_field_hits
+from search_engine import (PROGRAM_BASE_WEIGHTS, PROGRAM_SUMMARY_FIELDS, SCHOLARSHIP_BASE_WEIGHTS,
+                           SCHOLARSHIP_SUMMARY_FIELDS, ProgramindexName, ScholarshipIndexName)
+
+# Search type -> (index, vector fields, source fields)
+INDICES = {
+    "Programs": (ProgramindexName, list(PROGRAM_BASE_WEIGHTS), PROGRAM_SUMMARY_FIELDS),
+    "Scholarships": (ScholarshipIndexName, list(SCHOLARSHIP_BASE_WEIGHTS), SCHOLARSHIP_SUMMARY_FIELDS)
+}
+
+
+def parse_config(spec):
+    """
+    Split "model:backend" (or just "backend") into (model name, backend)
+    """
+    model_name, _, backend = spec.rpartition(":")
+    if backend not in ENCODER_BACKENDS:
+        raise argparse.ArgumentTypeError(f"Unknown backend {backend!r} in {spec!r}, "
+                                         f"expected one of {', '.join(ENCODER_BACKENDS)}")
+    return model_name or DEFAULT_MODEL_NAME, backend
+
+
+def retrieve(queries, vectors, k, num_candidates):
+    """
+    Return the top-k document ids per query and vector field: [{field: [ids]}]
+    """
+    results = []
+    for record, vector in zip(queries, vectors):
+        index_name, fields, source = INDICES[record.get("type", "Programs")]
+        field_hits = knn_field_hits(get_es_client(index_name), index_name, fields, vector.tolist(),
+                                    k, num_candidates, source)
+        results.append({
+            field: [hit["_id"] for hit in hits]
+            for field, hits in field_hits.items()
+            if not isinstance(hits, Exception)
+        })
+    return results
+
+
+def agreement(reference_ids, candidate_ids, k):
+    """
+    Return (mean top-k overlap, top-1 agreement) over all queries and fields
+    """
+    overlaps, top1 = [], []
+    for reference, candidate in zip(reference_ids, candidate_ids):
+        for field, expected in reference.items():
+            found = candidate.get(field)
+            if found is None or not expected:
+                continue
+            overlaps.append(len(set(expected) & set(found)) / min(k, len(expected)))
+            top1.append(bool(found) and found[0] == expected[0])
+    return (float(np.mean(overlaps)) if overlaps else None,
+            float(np.mean(top1)) if top1 else None)
+
+
+def measure_latency(model, texts, repeat):
+    """
+    Return (p50 ms, p95 ms) of single-query encodes and batch throughput in texts/s
+    """
+    samples = []
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            model.encode([text])
+            samples.append((time.perf_counter() - start) * 1000.0)
+    start = time.perf_counter()
+    model.encode(texts, batch_size=len(texts))
+    batch_seconds = time.perf_counter() - start
+    return (float(np.percentile(samples, 50)), float(np.percentile(samples, 95)),
+            len(texts) / batch_seconds if batch_seconds else 0.0)
+
+
+def encode_normalized(model, texts):
+    vectors = np.asarray(model.encode(texts, batch_size=len(texts)), dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def evaluate(model_name, backend, threads, queries, reference_vectors, reference_ids, k, num_candidates, repeat):
+    """
+    Load one encoder config and return its latency and agreement figures
+    """
+    texts = [record["query"] for record in queries]
+    memory_before = resident_memory_mb()
+    start = time.perf_counter()
+    model = load_encoder(model_name, backend, threads)
+    load_seconds = time.perf_counter() - start
+    model.encode(texts[:1])  # warm-up
+    memory_after = resident_memory_mb()
+
+    p50, p95, batch_qps = measure_latency(model, texts, repeat)
+    row = {
+        "model": model_name,
+        "backend": backend,
+        "threads": threads,
+        "dimension": model.get_sentence_embedding_dimension(),
+        "load_seconds": load_seconds,
+        "memory_mb": memory_after - memory_before if memory_before is not None and memory_after is not None else None,
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "batch_qps": batch_qps,
+        "cosine": None,
+        "overlap": None,
+        "top1": None
+    }
+    if row["dimension"] != reference_vectors.shape[1]:
+        # A different embedding space can't query vectors indexed by the reference model
+        print(f"{model_name} has dimension {row['dimension']}, the indices use {reference_vectors.shape[1]}: "
+              f"re-ingest with it to compare retrieval")
+        return row
+
+    vectors = encode_normalized(model, texts)
+    row["cosine"] = float(np.mean(np.sum(vectors * reference_vectors, axis=1)))
+    row["overlap"], row["top1"] = agreement(reference_ids, retrieve(queries, vectors, k, num_candidates), k)
+    return row
+
+
+def print_table(rows, k):
+    print(f"\n{'config':<40}{'threads':>8}{'p50 ms':>9}{'p95 ms':>9}{'batch q/s':>11}"
+          f"{'cosine':>8}{f'top-{k}':>8}{'top-1':>7}")
+    for row in rows:
+        config = f"{row['model']}:{row['backend']}"
+        agreement_columns = "".join(
+            f"{row[key]:>{width}.3f}" if row[key] is not None else f"{'-':>{width}}"
+            for key, width in (("cosine", 8), ("overlap", 8), ("top1", 7))
+        )
+        print(f"{config:<40}{row['threads']:>8}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+              f"{row['batch_qps']:>11.1f}{agreement_columns}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare query encoder latency against retrieval agreement")
+    parser.add_argument("--configs", nargs="+", type=parse_config, default=[parse_config("torch")],
+                        help="Encoders to evaluate: backend or model:backend")
+    parser.add_argument("--reference", type=parse_config, default=parse_config("torch"),
+                        help="Encoder the indices were built with")
+    parser.add_argument("--threads", nargs="+", type=int, default=[os.cpu_count() or 1],
+                        help="Intra-op thread counts to try")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="JSONL query corpus")
+    parser.add_argument("--k", type=int, default=10, help="Top-k compared per vector field")
+    parser.add_argument("--num-candidates", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3, help="Times each query is encoded for the latency")
+    parser.add_argument("--output", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    texts = [record["query"] for record in queries]
+
+    reference_name, reference_backend = args.reference
+    reference = load_encoder(reference_name, reference_backend, args.threads[0])
+    reference_vectors = encode_normalized(reference, texts)
+    reference_ids = retrieve(queries, reference_vectors, args.k, args.num_candidates)
+    del reference
+
+    rows = []
+    for model_name, backend in args.configs:
+        for threads in args.threads:
+            print(f"Evaluating {model_name}:{backend} with {threads} thread(s)")
+            rows.append(evaluate(model_name, backend, threads, queries, reference_vectors, reference_ids,
+                                 args.k, args.num_candidates, args.repeat))
+    print_table(rows, args.k)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump({"reference": f"{reference_name}:{reference_backend}", "k": args.k, "results": rows},
+                      out, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+Local stand-ins for the OpenAI and Elasticsearch HTTP APIs, used by the replay
+benchmark. Both run in-process on 127.0.0.1 with configurable latency so the
+search pipeline can be measured without network access or API keys.
+
+The fake Elasticsearch serves a synthetic corpus through the local vector
+backend (local_index.py); the fake OpenAI answers the app's prompts with
+deterministic, plausible responses.
+"""
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from ingest import INDEX_COMBINED_WEIGHTS, INDEX_VECTOR_FIELDS
+from local_index import DOCS_FILE, META_FILE, LocalSearchBackend
+from locations import resolve_location
+from retrieval import COMBINED_VECTOR_FIELD
+
+SYNTHETIC_LOCATIONS = [
+    ("United Kingdom", ["London", "Manchester", "Edinburgh"]),
+    ("Australia", ["Sydney", "Melbourne", "Brisbane"]),
+    ("Canada", ["Toronto", "Vancouver", "Montreal"]),
+    ("United States", ["Boston", "New York", "San Francisco"]),
+    ("Germany", ["Berlin", "Munich", "Hamburg"]),
+    ("Ireland", ["Dublin", "Cork", "Galway"]),
+    ("New Zealand", ["Auckland", "Wellington", "Christchurch"]),
+    ("Netherlands", ["Amsterdam", "Rotterdam", "Utrecht"])
+]
+
+SYNTHETIC_SUBJECTS = [
+    "Computer Science", "Data Science", "Business Administration", "Mechanical Engineering",
+    "Medicine", "Law", "Psychology", "Economics", "Artificial Intelligence", "Civil Engineering",
+    "Nursing", "Finance", "Architecture", "Biotechnology", "Public Health", "Marketing"
+]
+
+SYNTHETIC_QUALIFICATIONS = ["BSc", "MSc", "MBA", "PhD", "MA", "LLM"]
+
+STOPWORDS = {
+    "a", "an", "the", "in", "at", "for", "of", "to", "with", "and", "or", "on", "me", "show", "find",
+    "i", "want", "looking", "programs", "program", "courses", "course", "best", "some", "any", "that",
+    "are", "is", "there", "what", "which", "please", "study", "studying", "good", "top"
+}
+
+
+class Latency:
+    """
+    Simulated service time: mean_ms +/- jitter (a fraction of the mean)
+    """
+
+    def __init__(self, mean_ms=0.0, jitter=0.0):
+        self.mean_ms = mean_ms
+        self.jitter = jitter
+
+    def sleep(self):
+        if self.mean_ms <= 0:
+            return
+        factor = 1.0 + random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(self.mean_ms * factor, 0.0) / 1000.0)
+
+
+class HashEncoder:
+    """
+    Deterministic stand-in for the sentence transformer: hash-seeded unit vectors,
+    with optional per-batch latency. Lets the benchmark run without torch.
+    """
+
+    def __init__(self, dimension=768, latency=None):
+        self.dimension = dimension
+        self.latency = latency or Latency()
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        self.latency.sleep()
+        vectors = np.stack([self._vector(text) for text in texts]) if texts else np.zeros((0, self.dimension))
+        return vectors[0] if single else vectors
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha1(text.lower().encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+
+def _synthetic_source(index_name, i, rng):
+    location, cities = SYNTHETIC_LOCATIONS[i % len(SYNTHETIC_LOCATIONS)]
+    city = cities[rng.integers(len(cities))]
+    subject = SYNTHETIC_SUBJECTS[rng.integers(len(SYNTHETIC_SUBJECTS))]
+    qualification = SYNTHETIC_QUALIFICATIONS[rng.integers(len(SYNTHETIC_QUALIFICATIONS))]
+    university = f"University of {city} {i // len(SYNTHETIC_LOCATIONS)}"
+    if index_name == "programs":
+        return {
+            "universityName": university,
+            "courseTitle": f"{qualification} {subject}",
+            "courseDetail": f"A {qualification} degree in {subject} taught in {city}, {location}.",
+            "overview": f"{university} is a research university in {city}.",
+            "entryRequirements": "Bachelor's degree with a 2:1 or equivalent",
+            "scholarshipsFunding": f"Merit scholarships available for {subject} students",
+            "location": location,
+            "city": city,
+            "worldRanking": int(rng.integers(1, 1000)),
+            "qualification": qualification,
+            "duration": f"{int(rng.integers(1, 5))} years",
+            "nextIntake": "September",
+            "courseFee": int(rng.integers(5000, 60000)),
+            "averageStartingSalary": int(rng.integers(25000, 120000))
+        }
+    return {
+        "universityName": university,
+        "title": f"{subject} {qualification} Scholarship",
+        "fundingDetails": f"Covers tuition for {subject} students in {location}",
+        "qualification": qualification,
+        "location": location,
+        "city": city,
+        "deadline": "2025-03-31",
+        "eligibleIntake": "September",
+        "studyMode": "Full-time"
+    }
+
+
+def write_synthetic_index(root_dir, index_name, count=2000, dimension=768, seed=0):
+    """
+    Write a random corpus in the local_index.py export format to root_dir/index_name
+    """
+    rng = np.random.default_rng(seed)
+    index_dir = os.path.join(root_dir, index_name)
+    os.makedirs(index_dir, exist_ok=True)
+
+    with open(os.path.join(index_dir, DOCS_FILE), "w", encoding="utf-8") as docs_file:
+        for i in range(count):
+            doc = {"_id": f"{index_name}-{i}", "_source": _synthetic_source(index_name, i, rng)}
+            docs_file.write(json.dumps(doc) + "\n")
+
+    fields = {}
+    combined = np.zeros((count, dimension), dtype=np.float32)
+    weights = INDEX_COMBINED_WEIGHTS[index_name]
+    for field in INDEX_VECTOR_FIELDS[index_name]:
+        matrix = rng.standard_normal((count, dimension)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.save(os.path.join(index_dir, f"{field}.f32.npy"), matrix)
+        fields[field] = {"file": f"{field}.f32.npy"}
+        combined += weights[field] * matrix
+    # The combined vector ingest.py writes for the two-stage search mode
+    combined /= np.linalg.norm(combined, axis=1, keepdims=True)
+    np.save(os.path.join(index_dir, f"{COMBINED_VECTOR_FIELD}.f32.npy"), combined)
+    fields[COMBINED_VECTOR_FIELD] = {"file": f"{COMBINED_VECTOR_FIELD}.f32.npy"}
+
+    with open(os.path.join(index_dir, META_FILE), "w", encoding="utf-8") as meta_file:
+        json.dump({
+            "index": index_name,
+            "count": count,
+            "dimension": dimension,
+            "dtype": "float32",
+            "fields": fields
+        }, meta_file, indent=2)
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+
+class _ElasticsearchHandler(_JSONHandler):
+    backend = None
+    latency = Latency()
+
+    HEADERS = {
+        "Content-Type": "application/vnd.elasticsearch+json;compatible-with=8",
+        "X-Elastic-Product": "Elasticsearch"
+    }
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/":
+            self.send_json(200, {
+                "name": "fake-node",
+                "cluster_name": "fake",
+                "version": {"number": "8.15.0", "build_flavor": "default"},
+                "tagline": "You Know, for Search"
+            }, self.HEADERS)
+            return
+        match = re.fullmatch(r"/([^/]+)/_stats/indexing", self.path.split("?")[0])
+        if match:
+            index_name = match.group(1)
+            indexing = {"index_total": self.backend.version(index_name), "delete_total": 0}
+            self.send_json(200, {"indices": {index_name: {"uuid": f"fake-{index_name}",
+                                                           "primaries": {"indexing": indexing}}}}, self.HEADERS)
+            return
+        self.not_found()
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self.read_body()
+        self.latency.sleep()
+        try:
+            start = time.perf_counter()
+            if path == "/_msearch" or path.endswith("/_msearch"):
+                lines = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+                result = self.backend.msearch(lines)
+                for response in result["responses"]:
+                    response["took"] = int((time.perf_counter() - start) * 1000)
+                self.send_json(200, result, self.HEADERS)
+                return
+            match = re.fullmatch(r"/([^/]+)/_knn_search", path)
+            if match:
+                request = json.loads(body or b"{}")
+                result = self.backend.knn_search(match.group(1), request["knn"], request.get("_source"))
+                result["took"] = int((time.perf_counter() - start) * 1000)
+                self.send_json(200, result, self.HEADERS)
+                return
+            match = re.fullmatch(r"/([^/]+)/_mget", path)
+            if match:
+                request = json.loads(body or b"{}")
+                source = parse_qs(urlsplit(self.path).query).get("_source")
+                result = self.backend.mget(match.group(1), request["ids"], source[0].split(",") if source else None)
+                self.send_json(200, result, self.HEADERS)
+                return
+        except Exception as e:
+            self.send_json(400, {"error": {"type": "bad_request", "reason": str(e)}, "status": 400}, self.HEADERS)
+            return
+        self.not_found()
+
+    def not_found(self):
+        self.send_json(404, {"error": {"type": "resource_not_found_exception", "reason": self.path},
+                             "status": 404}, self.HEADERS)
+
+
+def _detect_location(text):
+    # Longest n-gram first so "New Zealand" wins over "New"
+    tokens = re.findall(r"[A-Za-z]+", text)
+    for size in (3, 2, 1):
+        for start in range(len(tokens) - size + 1):
+            gram = " ".join(tokens[start:start + size])
+            location = resolve_location(gram, fuzzy=False)
+            if location:
+                return gram, location
+    return None, None
+
+
+def _split_intents(query):
+    parts = re.split(r"\band also\b|\band\b|;|\|\|\|", query, flags=re.IGNORECASE)
+    return [part.strip() for part in parts if part.strip()] or [query]
+
+
+def _keywords(text, location_text=None):
+    if location_text:
+        text = re.sub(re.escape(location_text), " ", text, flags=re.IGNORECASE)
+    words = [word for word in re.findall(r"[A-Za-z0-9']+", text) if word.lower() not in STOPWORDS]
+    return [" ".join(words)] if words else [text.strip()]
+
+
+def _importance(text, location):
+    lowered = text.lower()
+    return {
+        "location_importance": 8 if location else 1,
+        "university_importance": 7 if "universit" in lowered else 3,
+        "course_importance": 8,
+        "ranking_importance": 7 if ("best" in lowered or "top" in lowered or "rank" in lowered) else 2,
+        "fee_importance": 7 if ("cheap" in lowered or "fee" in lowered or "afford" in lowered) else 2,
+        "salary_importance": 7 if "salary" in lowered else 1,
+        "qualification_importance": 6 if re.search(r"\b(phd|msc|mba|bsc|master|bachelor)", lowered) else 3
+    }
+
+
+def fake_completion(messages):
+    """
+    Answer one of the app's prompts from its system message and user text
+    """
+    system = messages[0]["content"]
+    user = messages[-1]["content"].split(": ", 1)[-1]
+
+    if "query analyzer" in system:
+        intents = []
+        for part in _split_intents(user):
+            location_text, location = _detect_location(part)
+            intents.append(dict(keywords=_keywords(part, location_text), detected_location=location,
+                                **_importance(part, location)))
+        return json.dumps({"intents": intents})
+
+    if "context analyzer" in system:
+        location_text, _ = _detect_location(user)
+        return json.dumps(dict(_importance(user, location_text), detected_location=location_text))
+
+    if "extracts relevant keywords" in system:
+        sets = []
+        for part in _split_intents(user):
+            location_text, _ = _detect_location(part)
+            keywords = _keywords(part, location_text)
+            if location_text:
+                keywords.append(location_text)  # abbreviations are kept as is
+            sets.append(", ".join(keywords))
+        return " ||| ".join(sets)
+
+    if "country abbreviations" in system:
+        return resolve_location(user) or user
+
+    return "{}"
+
+
+class _OpenAIHandler(_JSONHandler):
+    latency = Latency()
+
+    def do_POST(self):
+        request = json.loads(self.read_body() or b"{}")
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+        self.latency.sleep()
+        content = fake_completion(request["messages"])
+        prompt_tokens = sum(len(message["content"].split()) for message in request["messages"])
+        completion_tokens = len(content.split())
+        self.send_json(200, {
+            "id": f"chatcmpl-fake-{random.getrandbits(48):012x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }, {"Content-Type": "application/json"})
+
+
+class FakeService:
+    """
+    A stand-in HTTP server running on a background thread
+    """
+
+    def __init__(self, handler_class, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), handler_class)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_fake_elasticsearch(root_dir, latency=None, port=0):
+    """
+    Serve the local index exports under root_dir over the Elasticsearch HTTP API
+    """
+    handler = type("ElasticsearchHandler", (_ElasticsearchHandler,), {
+        "backend": LocalSearchBackend(root_dir),
+        "latency": latency or Latency()
+    })
+    return FakeService(handler, port=port).start()
+
+
+def start_fake_openai(latency=None, port=0):
+    """
+    Serve canned chat completions over the OpenAI HTTP API (base URL: <url>/v1)
+    """
+    handler = type("OpenAIHandler", (_OpenAIHandler,), {"latency": latency or Latency()})
+    return FakeService(handler, port=port).start()
@@ -0,0 +1,239 @@
+"""
+kNN tuning: measures recall@k against latency of the approximate kNN search
+per vector field and writes the per-field k and num_candidates the search
+engine loads at runtime (KNN_CONFIG, see retrieval.field_knn_query).
+
+    python -m benchmarks.knn_tuning --num-candidates 50 100 200 500 1000 --output knn_config.json
+    python -m benchmarks.knn_tuning --target-recall 0.98 --adaptive --plot knn_tuning.png --output knn_config.json
+
+For every sampled query and vector field the exact top-k (brute force over all
+documents) is the ground truth. Each num_candidates setting is scored by its
+mean recall@k and p50/p95 latency, and a field gets the smallest setting that
+reaches the target recall. A field whose deeper hits barely change the fused
+top results (with the base weights) gets a smaller k as well. Elasticsearch
+(or the local backend) is read with the usual ES_URL / SEARCH_BACKEND settings.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.encoder_eval import INDICES, encode_normalized
+from benchmarks.replay import DEFAULT_QUERIES, load_queries
+from encoder import get_model
+from es_clients import get_es_client, get_local_backend, search_backend
+from fusion import fuse_results
+from retrieval import DEFAULT_ADAPTIVE, MAX_NUM_CANDIDATES, knn_query
+from search_engine import PROGRAM_BASE_WEIGHTS, SCHOLARSHIP_BASE_WEIGHTS
+
+BASE_WEIGHTS = {"Programs": PROGRAM_BASE_WEIGHTS, "Scholarships": SCHOLARSHIP_BASE_WEIGHTS}
+
+# k multiplier given to fields whose deeper hits barely move the fused ranking
+REDUCED_K_SCALE = 0.5
+
+
+def exact_hits(index_name, field, vector, k):
+    """
+    Return the exact top-k hits of a vector field by brute force
+    """
+    if search_backend() == "local":
+        local_index = get_local_backend().index(index_name)
+        rows, similarities = local_index.knn(field, vector, k, k, exact=True)
+        return [{"_id": local_index.docs[row]["_id"], "_score": float((1.0 + similarity) / 2.0), "_source": {}}
+                for row, similarity in zip(rows, similarities)]
+    res = get_es_client(index_name).search(
+        index=index_name,
+        size=k,
+        source=False,
+        query={
+            "script_score": {
+                "query": {"exists": {"field": field}},
+                "script": {
+                    # Same scale as the kNN _score of a cosine dense_vector
+                    "source": f"(cosineSimilarity(params.query_vector, '{field}') + 1.0) / 2.0",
+                    "params": {"query_vector": vector}
+                }
+            }
+        }
+    )
+    return [{"_id": hit["_id"], "_score": hit["_score"], "_source": {}} for hit in res["hits"]["hits"]]
+
+
+def approximate_hits(index_name, field, vector, k, num_candidates):
+    """
+    Return the approximate kNN hits of a vector field and the latency in ms
+    """
+    client = get_es_client(index_name)
+    start = time.perf_counter()
+    res = client.knn_search(index=index_name, knn=knn_query(field, vector, k, num_candidates), source=[])
+    return res["hits"]["hits"], (time.perf_counter() - start) * 1000.0
+
+
+def recall(expected, found):
+    expected_ids = {hit["_id"] for hit in expected}
+    if not expected_ids:
+        return None
+    return len(expected_ids & {hit["_id"] for hit in found}) / len(expected_ids)
+
+
+def fused_ids(field_hits, weights, max_results):
+    hits, _ = fuse_results([(weights, None, field_hits)], max_results, strategy="weighted_sum")
+    return [hit["_id"] for hit in hits]
+
+
+def rank_shift(truth, weights, max_results, k_scale):
+    """
+    Share of the fused top max_results, per field, that changes when only that
+    field's k is scaled by k_scale
+    """
+    shift = {field: [] for field in weights}
+    for field_hits in truth:
+        reference = fused_ids(field_hits, weights, max_results)
+        if not reference:
+            continue
+        for field in weights:
+            truncated = dict(field_hits, **{field: field_hits[field][:max(1, round(len(field_hits[field]) * k_scale))]})
+            changed = len(set(reference) - set(fused_ids(truncated, weights, max_results)))
+            shift[field].append(changed / len(reference))
+    return {field: float(np.mean(values)) if values else 0.0 for field, values in shift.items()}
+
+
+def sweep(search_type, vectors, k, num_candidates_grid):
+    """
+    Return ({field: [row per num_candidates]}, ground truth [{field: hits}])
+    """
+    index_name, fields, _ = INDICES[search_type]
+    truth = []
+    for vector in vectors:
+        truth.append({field: exact_hits(index_name, field, vector, k) for field in fields})
+
+    rows = {field: [] for field in fields}
+    for field in fields:
+        for num_candidates in num_candidates_grid:
+            recalls, latencies = [], []
+            for vector, expected in zip(vectors, truth):
+                found, latency = approximate_hits(index_name, field, vector, k, max(num_candidates, k))
+                latencies.append(latency)
+                value = recall(expected[field], found)
+                if value is not None:
+                    recalls.append(value)
+            rows[field].append({
+                "num_candidates": num_candidates,
+                "recall": float(np.mean(recalls)) if recalls else None,
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95))
+            })
+        print(f"  {index_name}.{field}: done")
+    return rows, truth
+
+
+def choose(rows, target_recall):
+    """
+    Return the smallest num_candidates reaching the target recall, else the
+    one with the best recall
+    """
+    for row in rows:
+        if row["recall"] is None or row["recall"] >= target_recall:
+            return row
+    return max(rows, key=lambda row: row["recall"])
+
+
+def print_table(index_name, rows, k):
+    print(f"\n{index_name}")
+    print(f"{'field':<32}{'num_candidates':>15}{f'recall@{k}':>11}{'p50 ms':>9}{'p95 ms':>9}")
+    for field, field_rows in rows.items():
+        for row in field_rows:
+            value = f"{row['recall']:>11.3f}" if row["recall"] is not None else f"{'-':>11}"
+            print(f"{field:<32}{row['num_candidates']:>15}{value}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}")
+
+
+def plot(results, path, k):
+    """
+    Plot recall@k against p50 latency per field, one panel per index
+    """
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed; skipping the plot")
+        return
+    figure, axes = plt.subplots(1, len(results), figsize=(7 * len(results), 5), squeeze=False)
+    for axis, (index_name, rows) in zip(axes[0], results.items()):
+        for field, field_rows in rows.items():
+            points = [row for row in field_rows if row["recall"] is not None]
+            axis.plot([row["p50_ms"] for row in points], [row["recall"] for row in points], marker="o", label=field)
+            for row in points:
+                axis.annotate(str(row["num_candidates"]), (row["p50_ms"], row["recall"]), fontsize=7)
+        axis.set_title(index_name)
+        axis.set_xlabel("p50 latency (ms)")
+        axis.set_ylabel(f"recall@{k}")
+        axis.legend(fontsize=7)
+    figure.tight_layout()
+    figure.savefig(path)
+    print(f"Wrote {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune per-field kNN k and num_candidates against exact search")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="JSONL query corpus")
+    parser.add_argument("--sample", type=int, default=50, help="Queries sampled per search type")
+    parser.add_argument("--max-results", type=int, default=10, help="Results per search; k is twice this")
+    parser.add_argument("--num-candidates", nargs="+", type=int, default=[50, 100, 200, 500, 1000],
+                        help="num_candidates settings to compare")
+    parser.add_argument("--target-recall", type=float, default=0.95, help="Recall@k a field's setting must reach")
+    parser.add_argument("--max-rank-shift", type=float, default=0.05,
+                        help="Largest share of the fused top results that may change when a field's k is halved")
+    parser.add_argument("--types", nargs="+", choices=list(INDICES), default=list(INDICES))
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Raise num_candidates at runtime for location-filtered queries and thin results")
+    parser.add_argument("--plot", help="Save a recall/latency plot (needs matplotlib)")
+    parser.add_argument("--output", help="Write the per-field config (load it with KNN_CONFIG)")
+    args = parser.parse_args()
+
+    k = args.max_results * 2
+    grid = sorted(min(value, MAX_NUM_CANDIDATES) for value in set(args.num_candidates))
+    model = get_model()
+    records = load_queries(args.queries)
+
+    results, config = {}, {"indices": {}, "adaptive": dict(DEFAULT_ADAPTIVE, enabled=args.adaptive)}
+    for search_type in args.types:
+        index_name = INDICES[search_type][0]
+        sample = [record for record in records if record.get("type", "Programs") == search_type][:args.sample]
+        if not sample:
+            continue
+        print(f"Tuning {index_name} with {len(sample)} queries")
+        vectors = [vector.tolist() for vector in encode_normalized(model, [record["query"] for record in sample])]
+        rows, truth = sweep(search_type, vectors, k, grid)
+        results[index_name] = rows
+        shift = rank_shift(truth, BASE_WEIGHTS[search_type], args.max_results, REDUCED_K_SCALE)
+
+        config["indices"][index_name] = {}
+        for field, field_rows in rows.items():
+            chosen = choose(field_rows, args.target_recall)
+            config["indices"][index_name][field] = {
+                "k_scale": REDUCED_K_SCALE if shift[field] <= args.max_rank_shift else 1.0,
+                "num_candidates": chosen["num_candidates"],
+                "recall": chosen["recall"],
+                "rank_shift": shift[field]
+            }
+        print_table(index_name, rows, k)
+
+    print(f"\n{'field':<48}{'k':>5}{'num_candidates':>15}{'recall':>8}{'rank shift':>12}")
+    for index_name, fields in config["indices"].items():
+        for field, tuned in fields.items():
+            recall_column = f"{tuned['recall']:>8.3f}" if tuned["recall"] is not None else f"{'-':>8}"
+            print(f"{index_name + '.' + field:<48}{max(1, round(k * tuned['k_scale'])):>5}"
+                  f"{tuned['num_candidates']:>15}{recall_column}{tuned['rank_shift']:>12.3f}")
+
+    if args.plot:
+        plot(results, args.plot, k)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump({**config, "k": k, "target_recall": args.target_recall, "sweep": results}, out, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
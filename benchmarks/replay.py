@@ -0,0 +1,304 @@
+"""
+Replay benchmark: runs a corpus of natural-language queries through the search
+engine the Streamlit app and the search service use (query understanding, then
+the program or scholarship search) against local fake Elasticsearch and OpenAI
+servers, and reports throughput plus p50/p95/p99 latency per stage.
+
+    python -m benchmarks.replay --save-baseline benchmarks/baseline.json
+    python -m benchmarks.replay --baseline benchmarks/baseline.json
+
+Exits with status 1 when a stage is slower than the baseline by more than the
+tolerance, so it can gate changes in CI.
+"""
+import argparse
+import functools
+import inspect
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.fake_services import (HashEncoder, Latency, start_fake_elasticsearch, start_fake_openai,
+                                      write_synthetic_index)
+
+STAGES = ("e2e", "llm", "encode", "knn", "fusion")
+
+DEFAULT_QUERIES = os.path.join(os.path.dirname(__file__), "queries.jsonl")
+
+# Stage timings faster than this are never reported as regressions (timer noise)
+MIN_REGRESSION_MS = 1.0
+
+
+class StageTimer:
+    """
+    Collects wall-clock samples per stage from any thread
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds * 1000.0)
+
+    def wrap(self, stage, func):
+        """
+        Return func timed under stage; works for plain and async functions
+        """
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+            return timed_async
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def clear(self):
+        with self._lock:
+            self.samples.clear()
+
+    def summary(self):
+        result = {}
+        for stage in STAGES:
+            values = self.samples.get(stage)
+            if not values:
+                continue
+            values = np.asarray(values)
+            result[stage] = {
+                "count": int(len(values)),
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "p99": float(np.percentile(values, 99))
+            }
+        return result
+
+
+def instrument(engine, timer):
+    """
+    Time the pipeline stages by wrapping the functions search_engine and
+    query_understanding look up at call time
+    """
+    import query_understanding
+
+    targets = [
+        (engine, "cached_completion", "llm"),
+        (engine, "cached_completion_async", "llm"),
+        (query_understanding, "cached_completion", "llm"),
+        (query_understanding, "cached_completion_async", "llm"),
+        (engine, "encode_queries", "encode"),
+        (engine, "knn_field_hits", "knn"),
+        (engine, "knn_field_hits_async", "knn"),
+        (engine, "fuse_results", "fusion")
+    ]
+    for module, name, stage in targets:
+        setattr(module, name, timer.wrap(stage, getattr(module, name)))
+
+
+def load_queries(path):
+    """
+    Read {"query": ..., "type": "Programs" | "Scholarships"} records
+    """
+    with open(path, encoding="utf-8") as source:
+        return [json.loads(line) for line in source if line.strip()]
+
+
+def run_query(search_engine, model, record, max_results, engine):
+    """
+    Run one query the way the app does and return the number of results
+    """
+    response = search_engine.search(record["query"], record.get("type", "Programs"), max_results, model, engine)
+    return len(response["results"])
+
+
+def replay(search_engine, model, queries, timer, max_results=10, engine="async", concurrency=1, repeat=1):
+    """
+    Replay the queries and return (elapsed seconds, query count, empty result count)
+    """
+    workload = [record for _ in range(repeat) for record in queries]
+
+    def timed_query(record):
+        start = time.perf_counter()
+        try:
+            return run_query(search_engine, model, record, max_results, engine)
+        finally:
+            timer.record("e2e", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            counts = list(executor.map(timed_query, workload))
+    else:
+        counts = [timed_query(record) for record in workload]
+    return time.perf_counter() - start, len(workload), sum(1 for count in counts if count == 0)
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """
+    Return a list of regressions of report against baseline
+    """
+    regressions = []
+    for stage, base in baseline.get("stages", {}).items():
+        current = report["stages"].get(stage)
+        if current is None:
+            continue
+        for metric in ("p50", "p95", "p99"):
+            limit = base[metric] * (1 + tolerance)
+            if current[metric] > limit and current[metric] - base[metric] > MIN_REGRESSION_MS:
+                regressions.append(f"{stage} {metric}: {current[metric]:.1f} ms vs baseline "
+                                   f"{base[metric]:.1f} ms (+{current[metric] / base[metric] - 1:.0%})")
+
+    base_throughput = baseline.get("throughput_qps")
+    if base_throughput and report["throughput_qps"] < base_throughput * (1 - tolerance):
+        regressions.append(f"throughput: {report['throughput_qps']:.2f} q/s vs baseline {base_throughput:.2f} q/s")
+    return regressions
+
+
+def print_report(report):
+    print(f"\n{report['queries']} queries in {report['elapsed_seconds']:.2f}s "
+          f"({report['throughput_qps']:.2f} q/s, {report['empty_results']} with no results)\n")
+    print(f"{'stage':<8}{'calls':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}   (ms)")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<8}{stats['count']:>8}{stats['mean']:>10.1f}{stats['p50']:>10.1f}"
+              f"{stats['p95']:>10.1f}{stats['p99']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay queries against local fake Elasticsearch and OpenAI")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="JSONL query corpus")
+    parser.add_argument("--repeat", type=int, default=1, help="Times to replay the corpus")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed queries before the run")
+    parser.add_argument("--concurrency", type=int, default=1, help="Queries in flight at once")
+    parser.add_argument("--max-results", type=int, default=10)
+    parser.add_argument("--engine", choices=["async", "sync"], default="async", help="SEARCH_ENGINE to replay")
+    parser.add_argument("--search-mode", choices=["msearch", "per_field", "two_stage"], default="msearch")
+    parser.add_argument("--understanding", choices=["structured", "chained"], default="structured",
+                        help="QUERY_UNDERSTANDING to replay")
+    parser.add_argument("--llm-latency-ms", type=float, default=400.0, help="Fake OpenAI response time")
+    parser.add_argument("--es-latency-ms", type=float, default=20.0, help="Fake Elasticsearch response time")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency jitter as a fraction of the mean")
+    parser.add_argument("--docs", type=int, default=2000, help="Synthetic documents per index")
+    parser.add_argument("--encoder", choices=["model", "hash"], default="model",
+                        help="Real sentence transformer, or a hash-based stand-in (no torch needed)")
+    parser.add_argument("--with-caches", action="store_true",
+                        help="Keep the LLM, embedding and result caches enabled (repeats become cache hits)")
+    parser.add_argument("--output", help="Write the report as JSON")
+    parser.add_argument("--save-baseline", help="Write the report as the new baseline")
+    parser.add_argument("--baseline", help="Compare against a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="replay-index-")
+    dimension = 768
+    if args.encoder == "model":
+        from encoder import get_model
+        model = get_model()
+        dimension = model.get_sentence_embedding_dimension()
+    else:
+        model = HashEncoder(dimension)
+
+    for index_name in ("programs", "scholar"):
+        write_synthetic_index(data_dir, index_name, count=args.docs, dimension=dimension)
+    es_server = start_fake_elasticsearch(data_dir, Latency(args.es_latency_ms, args.jitter))
+    openai_server = start_fake_openai(Latency(args.llm_latency_ms, args.jitter))
+
+    # The engine reads these when it creates its clients and on each call
+    os.environ.update({
+        "OPENAI_API_KEY": "replay",
+        "OPENAI_BASE_URL": f"{openai_server.url}/v1",
+        "ES_URL": es_server.url,
+        "ES_API_KEY": "replay",
+        "SEARCH_BACKEND": "elasticsearch",
+        "SEARCH_ENGINE": args.engine,
+        "SEARCH_MODE": args.search_mode,
+        "QUERY_UNDERSTANDING": args.understanding
+    })
+    if not args.with_caches:
+        os.environ.update({"LLM_CACHE_MAX_ENTRIES": "0", "EMBEDDING_CACHE_MAX_ENTRIES": "0",
+                           "RESULT_CACHE_MAX_ENTRIES": "0"})
+    else:
+        # The result cache is opt-in
+        os.environ.setdefault("RESULT_CACHE_MAX_ENTRIES", "1000")
+
+    import search_engine
+
+    timer = StageTimer()
+    instrument(search_engine, timer)
+    queries = load_queries(args.queries)
+
+    for record in queries[:args.warmup]:
+        run_query(search_engine, model, record, args.max_results, args.engine)
+    timer.clear()
+
+    elapsed, count, empty = replay(search_engine, model, queries, timer, args.max_results, args.engine,
+                                   args.concurrency, args.repeat)
+    es_server.stop()
+    openai_server.stop()
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        "config": {
+            "queries": os.path.basename(args.queries),
+            "engine": args.engine,
+            "search_mode": args.search_mode,
+            "understanding": args.understanding,
+            "concurrency": args.concurrency,
+            "encoder": args.encoder,
+            "llm_latency_ms": args.llm_latency_ms,
+            "es_latency_ms": args.es_latency_ms,
+            "docs": args.docs,
+            "caches": args.with_caches,
+            "python": platform.python_version()
+        },
+        "queries": count,
+        "empty_results": empty,
+        "elapsed_seconds": elapsed,
+        "throughput_qps": count / elapsed if elapsed else 0.0,
+        "stages": timer.summary()
+    }
+    print_report(report)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as out:
+                json.dump(report, out, indent=2)
+            print(f"\nWrote {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as source:
+            baseline = json.load(source)
+        changed = {key: value for key, value in report["config"].items()
+                   if baseline.get("config", {}).get(key) != value}
+        if changed:
+            print(f"\nWarning: configuration differs from the baseline: {changed}")
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
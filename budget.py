@@ -0,0 +1,242 @@
+"""
+Latency budget and timeouts of the LLM stages of a search.
+
+Every search starts a budget (LLM_BUDGET_MS) that all of its OpenAI calls
+share. A call gets its stage timeout (LLM_TIMEOUT_<STAGE>_MS, else
+LLM_TIMEOUT_MS), capped by what is left of the budget. When it hasn't answered
+after LLM_HEDGE_MS a duplicate request is sent and the first answer wins;
+failed calls are retried (LLM_RETRIES) while the budget lasts. Timeouts are not
+retried: the search falls back to its local path instead. With a rate-limited
+service every request sent, retries and hedges included, takes a token; a
+hedge is skipped when no token is available right away. The budget follows
+the search through contextvars, like telemetry spans.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from rate_limit import rate_limit, rate_limit_async, try_rate_limit
+from settings import get_setting
+from telemetry import count, current_span
+
+
+class LLMTimeout(TimeoutError):
+    """
+    An LLM call did not answer within its timeout
+    """
+
+
+class BudgetExceeded(LLMTimeout):
+    """
+    The latency budget of the search is spent; no further LLM calls are made
+    """
+
+
+class Budget:
+    """
+    Deadline shared by the LLM calls of one search
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+_current_budget = ContextVar("current_budget", default=None)
+
+
+@contextmanager
+def start_budget(seconds=None):
+    """
+    Give the LLM calls made inside the block a shared deadline
+    """
+    if seconds is None:
+        seconds = get_setting("LLM_BUDGET_MS", 4000, float) / 1000
+    budget = Budget(seconds)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+def current_budget():
+    """
+    Return the budget of the current search, or None outside a search
+    """
+    return _current_budget.get()
+
+
+def budget_expired():
+    budget = current_budget()
+    return budget is not None and budget.expired
+
+
+def stage_timeout(stage):
+    """
+    Timeout in seconds of the next call of a stage, capped by the remaining
+    budget; raises BudgetExceeded when nothing is left
+    """
+    timeout = get_setting(f"LLM_TIMEOUT_{stage.upper()}_MS", get_setting("LLM_TIMEOUT_MS", 2500, float),
+                          float) / 1000
+    budget = current_budget()
+    if budget is not None:
+        remaining = budget.remaining()
+        if remaining <= 0:
+            count("llm_timeouts_total", stage=stage, reason="budget")
+            raise BudgetExceeded(f"LLM latency budget of {budget.seconds * 1000:.0f} ms exhausted")
+        timeout = min(timeout, remaining)
+    return timeout
+
+
+def _hedge_delay():
+    delay = get_setting("LLM_HEDGE_MS", 1500, float) / 1000
+    return delay if delay > 0 else None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_setting("LLM_CALL_THREADS", 32, int),
+                                           thread_name_prefix="llm-call")
+        return _executor
+
+
+def _record_hedge(stage):
+    count("llm_hedges_total", stage=stage)
+    current = current_span()
+    if current is not None:
+        current.set(hedged=True)
+
+
+def _timed_out(stage, timeout):
+    count("llm_timeouts_total", stage=stage, reason="timeout")
+    return LLMTimeout(f"{stage} call timed out after {timeout * 1000:.0f} ms")
+
+
+def _may_hedge(service):
+    # A hedge is optional: it is only sent when the rate limit has a token to spare
+    return service is None or try_rate_limit(service)
+
+
+def _hedged_call(request, stage, timeout, service=None):
+    # request(timeout) runs in a worker thread; the caller waits at most timeout
+    started = time.monotonic()
+    deadline = started + timeout
+    hedge_delay = _hedge_delay()
+    pending = {_get_executor().submit(request, timeout)}
+    hedged = False
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            raise _timed_out(stage, timeout)
+        wait_seconds = deadline - now
+        if hedge_delay is not None and not hedged:
+            wait_seconds = min(wait_seconds, max(started + hedge_delay - now, 0.0))
+        done, pending = wait(pending, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+        error = None
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        if not pending:
+            raise error
+        if hedge_delay is not None and not hedged and time.monotonic() >= started + hedge_delay:
+            # The slow request keeps running until its own timeout; the first answer wins
+            if _may_hedge(service):
+                pending.add(_get_executor().submit(request, deadline - time.monotonic()))
+                _record_hedge(stage)
+            hedged = True
+
+
+async def _hedged_call_async(request, stage, timeout, service=None):
+    # request(timeout) returns a coroutine; the request that loses is cancelled
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + timeout
+    hedge_delay = _hedge_delay()
+    pending = {asyncio.ensure_future(request(timeout))}
+    hedged = False
+    try:
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                raise _timed_out(stage, timeout)
+            wait_seconds = deadline - now
+            if hedge_delay is not None and not hedged:
+                wait_seconds = min(wait_seconds, max(started + hedge_delay - now, 0.0))
+            done, pending = await asyncio.wait(pending, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+            error = None
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+            if hedge_delay is not None and not hedged and loop.time() >= started + hedge_delay:
+                if _may_hedge(service):
+                    pending.add(asyncio.ensure_future(request(deadline - loop.time())))
+                    _record_hedge(stage)
+                hedged = True
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _attempts():
+    return 1 + max(get_setting("LLM_RETRIES", 1, int), 0)
+
+
+def call_llm(request, stage, service=None):
+    """
+    Run request(timeout) with the stage timeout, hedging and retries, taking a
+    token of the service's rate limit for every request sent.
+    Raises LLMTimeout (or BudgetExceeded) when the call can't finish in time.
+    """
+    attempts = _attempts()
+    for attempt in range(attempts):
+        if service is not None:
+            rate_limit(service)
+        timeout = stage_timeout(stage)
+        try:
+            return _hedged_call(request, stage, timeout, service)
+        except LLMTimeout:
+            raise
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            count("llm_retries_total", stage=stage)
+
+
+async def call_llm_async(request, stage, service=None):
+    """
+    Async call_llm; request(timeout) returns a coroutine
+    """
+    attempts = _attempts()
+    for attempt in range(attempts):
+        if service is not None:
+            await rate_limit_async(service)
+        timeout = stage_timeout(stage)
+        try:
+            return await _hedged_call_async(request, stage, timeout, service)
+        except LLMTimeout:
+            raise
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            count("llm_retries_total", stage=stage)
@@ -0,0 +1,170 @@
+"""
+Local context analysis: importance scores from the query embedding.
+
+The context analysis prompt only produces seven 0-10 importance scores per
+keyword set. This module derives them from the embedding the search already
+computes for the keyword set: every aspect has a few prototype phrases, and the
+cosine similarity of the query to its closest prototype is mapped linearly
+onto 0-10. The location comes from the gazetteer. The result has the shape of
+the LLM context analysis, so it goes through the same weight mapping
+(search_engine.apply_context_analysis) without an OpenAI round trip.
+
+This mode is experimental: the default similarity-to-score mapping
+(CONTEXT_SCORE_FLOOR/CEILING) has not been calibrated against the LLM scores,
+so it is opt-in (CONTEXT_ANALYSIS=embedding) and the LLM analysis stays the
+default. benchmarks/context_calibration.py fits the mapping to logged LLM
+analyses and reports how well the two agree.
+"""
+import json
+import threading
+
+import numpy as np
+
+from locations import find_location
+from query_understanding import IMPORTANCE_FIELDS
+from settings import get_setting
+from telemetry import span
+
+# "embedding" scores keyword sets locally, "llm" asks OpenAI for each keyword set
+CONTEXT_ANALYSIS_MODES = ("embedding", "llm")
+
+# Phrases describing what a query that cares about each aspect looks like.
+# Override with a JSON file of the same shape (CONTEXT_PROTOTYPES).
+IMPORTANCE_PROTOTYPES = {
+    "location_importance": [
+        "study in a specific country",
+        "universities in London",
+        "programs in the United States",
+        "courses located in Australia"
+    ],
+    "university_importance": [
+        "programs at a specific university",
+        "courses offered by Oxford University",
+        "Harvard University",
+        "which university offers this"
+    ],
+    "course_importance": [
+        "computer science degree",
+        "business administration program",
+        "mechanical engineering course",
+        "course subject and curriculum"
+    ],
+    "ranking_importance": [
+        "top ranked universities",
+        "best university in the world",
+        "prestigious highly ranked school",
+        "university ranking"
+    ],
+    "fee_importance": [
+        "cheap tuition fees",
+        "affordable low cost courses",
+        "how much does the course cost",
+        "tuition fee"
+    ],
+    "salary_importance": [
+        "high starting salary",
+        "good job prospects after graduation",
+        "career and employment outcomes",
+        "well paid jobs"
+    ],
+    "qualification_importance": [
+        "master's degree",
+        "bachelor's degree",
+        "PhD doctorate",
+        "postgraduate diploma"
+    ]
+}
+
+# Score given to location importance when the gazetteer finds a location
+LOCATION_MENTIONED_SCORE = 8
+
+_prototypes = {}  # id(model) -> (model, {field: normalized prototype matrix}); the model is checked on reads
+_prototypes_lock = threading.Lock()
+
+
+def context_analysis_mode():
+    """
+    Return the configured per-keyword-set context analysis mode
+    """
+    mode = get_setting("CONTEXT_ANALYSIS", "llm")
+    if mode not in CONTEXT_ANALYSIS_MODES:
+        print(f"Unknown CONTEXT_ANALYSIS {mode!r}, using llm")
+        mode = "llm"
+    return mode
+
+
+def load_prototypes():
+    """
+    Return the prototype phrases per importance field
+    """
+    path = get_setting("CONTEXT_PROTOTYPES")
+    if not path:
+        return IMPORTANCE_PROTOTYPES
+    with open(path, encoding="utf-8") as source:
+        prototypes = json.load(source)
+    missing = [field for field in IMPORTANCE_FIELDS if not prototypes.get(field)]
+    if missing:
+        raise ValueError(f"{path} has no prototypes for {', '.join(missing)}")
+    return prototypes
+
+
+def _normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def prototype_vectors(model):
+    """
+    Encode the prototypes once per model; returns {field: (phrases, dimension) matrix}
+    """
+    with _prototypes_lock:
+        cached = _prototypes.get(id(model))
+        # An id can be reused by another object once its model is gone
+        if cached is None or cached[0] is not model:
+            prototypes = load_prototypes()
+            phrases = [phrase for field in IMPORTANCE_FIELDS for phrase in prototypes[field]]
+            encoded = _normalize_rows(model.encode(phrases, batch_size=len(phrases)))
+            matrices, start = {}, 0
+            for field in IMPORTANCE_FIELDS:
+                end = start + len(prototypes[field])
+                matrices[field] = encoded[start:end]
+                start = end
+            cached = _prototypes[id(model)] = (model, matrices)
+        return cached[1]
+
+
+def prototype_similarities(query_vector, model):
+    """
+    Return {importance field: cosine similarity of the query to its closest prototype}
+    """
+    vector = _normalize_rows(query_vector)
+    return {field: float(np.max(matrix @ vector)) for field, matrix in prototype_vectors(model).items()}
+
+
+def similarity_score(similarity, floor, ceiling):
+    """
+    Map a prototype similarity linearly onto a 0-10 importance score
+    """
+    return round(float(np.clip((similarity - floor) / (ceiling - floor), 0.0, 1.0)) * 10, 1)
+
+
+def score_context(keywords, query_vector, model):
+    """
+    Return a context analysis (importance scores, detected_location, keywords)
+    for a keyword set from its query vector
+    """
+    with span("score_context") as stage:
+        floor = get_setting("CONTEXT_SCORE_FLOOR", 0.2, float)
+        ceiling = get_setting("CONTEXT_SCORE_CEILING", 0.6, float)
+        analysis = {
+            field: similarity_score(similarity, floor, ceiling)
+            for field, similarity in prototype_similarities(query_vector, model).items()
+        }
+
+        analysis["detected_location"] = find_location(keywords)
+        if analysis["detected_location"]:
+            analysis["location_importance"] = max(analysis["location_importance"], LOCATION_MENTIONED_SCORE)
+        analysis["keywords"] = keywords
+        stage.set(detected_location=analysis["detected_location"])
+    return analysis
@@ -0,0 +1,548 @@
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+
+from settings import get_setting
+from telemetry import count, gauge, observe, span
+
+DEFAULT_MODEL_NAME = 'all-mpnet-base-v2'
+
+# torch: full precision PyTorch; torch-int8: PyTorch with int8 dynamically quantized
+# Linear layers; onnx: ONNX Runtime; onnx-int8: dynamically quantized ONNX export
+ENCODER_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+# Process-wide registry: every Streamlit session, rerun and thread shares these
+_models = {}
+_model_stats = {}
+_registry_lock = threading.Lock()
+
+
+def resident_memory_mb():
+    """
+    Return the resident memory of the current process in MB (None if unavailable)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        import resource
+        import sys
+        # ru_maxrss is the peak resident size: KB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        return None
+
+
+def encoder_settings():
+    """
+    Return the configured query encoder: (model name, backend, threads)
+    """
+    backend = get_setting("ENCODER_BACKEND", "torch")
+    if backend not in ENCODER_BACKENDS:
+        print(f"Unknown ENCODER_BACKEND {backend!r}, using torch")
+        backend = "torch"
+    return get_setting("ENCODER_MODEL", DEFAULT_MODEL_NAME), backend, get_setting("ENCODER_THREADS", None, int)
+
+
+def _onnx_model_kwargs(threads):
+    import onnxruntime
+
+    session_options = onnxruntime.SessionOptions()
+    if threads:
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1
+    return {"provider": "CPUExecutionProvider", "session_options": session_options}
+
+
+def _quantized_onnx_export(model_name, quantization):
+    """
+    Return (directory, file name) of the int8 ONNX export of a model, exporting
+    and quantizing it on first use
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    export_dir = os.path.join(get_setting("ENCODER_ONNX_DIR", "onnx_models"), model_name.replace("/", "__"))
+    file_name = f"onnx/model_qint8_{quantization}.onnx"
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        print(f"Exporting {model_name} to ONNX with {quantization} int8 quantization in {export_dir}")
+        onnx_model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        onnx_model.save(export_dir)
+        export_dynamic_quantized_onnx_model(onnx_model, quantization, export_dir)
+    return export_dir, file_name
+
+
+def load_encoder(model_name=DEFAULT_MODEL_NAME, backend="torch", threads=None):
+    """
+    Load a sentence transformer for CPU inference with one of ENCODER_BACKENDS.
+    threads caps the intra-op threads; for the torch backends this is a
+    process-wide setting. The ONNX backends need sentence-transformers[onnx].
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {', '.join(ENCODER_BACKENDS)}")
+    # Imported here so tools that bring their own encoder (replay --encoder hash) run without torch
+    from sentence_transformers import SentenceTransformer
+
+    if backend in ("torch", "torch-int8"):
+        import torch
+
+        if threads:
+            torch.set_num_threads(threads)
+        if backend == "torch":
+            return SentenceTransformer(model_name)
+        # Dynamic quantization runs on the CPU only
+        model = SentenceTransformer(model_name, device="cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    model_kwargs = _onnx_model_kwargs(threads)
+    if backend == "onnx":
+        return SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+    # Instruction set the int8 kernels are tuned for: arm64, avx2, avx512 or avx512_vnni
+    export_dir, file_name = _quantized_onnx_export(model_name, get_setting("ENCODER_QUANTIZATION", "avx2"))
+    return SentenceTransformer(export_dir, device="cpu", backend="onnx",
+                               model_kwargs=dict(model_kwargs, file_name=file_name))
+
+
+def get_model(model_name=None, backend=None):
+    """
+    Load the query encoder once per process and return the shared instance;
+    arguments left out come from ENCODER_MODEL and ENCODER_BACKEND. There is one
+    instance per model and backend: ENCODER_THREADS applies when it is first
+    loaded (process-wide for the torch backends), use load_encoder to compare
+    thread counts.
+    """
+    configured_name, configured_backend, threads = encoder_settings()
+    model_name = model_name or configured_name
+    backend = backend or configured_backend
+    key = (model_name, backend)
+
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        # Another thread may have finished loading while we waited for the lock
+        model = _models.get(key)
+        if model is not None:
+            return model
+
+        memory_before = resident_memory_mb()
+        start = time.perf_counter()
+        model = load_encoder(model_name, backend, threads)
+        loaded = time.perf_counter()
+
+        # Warm up with a dummy encode so the first real query doesn't pay for it
+        model.encode("warm up")
+        warmed = time.perf_counter()
+
+        memory_after = resident_memory_mb()
+        _model_stats[key] = {
+            "model_name": model_name,
+            "backend": backend,
+            "threads": threads,
+            "load_seconds": loaded - start,
+            "warmup_seconds": warmed - loaded,
+            "resident_memory_mb": memory_after,
+            "model_memory_mb": (
+                memory_after - memory_before
+                if memory_before is not None and memory_after is not None
+                else None
+            ),
+            "loaded_at": time.time()
+        }
+        print(f"Loaded {model_name} ({backend}) in {loaded - start:.2f}s "
+              f"(warm-up {warmed - loaded:.2f}s)")
+
+        _models[key] = model
+        return model
+
+
+def model_stats(model_name=None, backend=None):
+    """
+    Return load time and memory statistics for a loaded model, by default the
+    configured encoder (empty dict if not loaded)
+    """
+    configured_name, configured_backend, _ = encoder_settings()
+    stats = dict(_model_stats.get((model_name or configured_name, backend or configured_backend), {}))
+    if stats:
+        stats["current_resident_memory_mb"] = resident_memory_mb()
+    return stats
+
+
+@contextmanager
+def _file_lock(path):
+    """
+    Hold an exclusive lock on path across processes (the search service workers
+    share one embedding store)
+    """
+    with open(path, "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def normalize_text(text):
+    """
+    Normalize query text for embedding cache keys
+    """
+    return re.sub(r"\s+", " ", str(text)).strip().lower()
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU of one model's query vectors keyed by normalized text, optionally
+    backed by a memory-mapped float32 store on disk so vectors survive restarts
+    """
+
+    def __init__(self, max_entries=10000, store_path=None, store_capacity=100000, dimension=None):
+        self.max_entries = max_entries
+        self.store_path = store_path
+        self.store_capacity = store_capacity
+        self.dimension = dimension
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        # Disk store: <path>.npy holds one row per vector, <path>.keys one key per
+        # line; the row of a key is its line number. Other processes may append
+        # to the same store, so rows are only allocated under <path>.lock.
+        self._store = None
+        self._store_rows = {}
+        self._keys_offset = 0  # bytes of the keys file already read
+        self._store_full_reported = False
+
+    def _open_store(self, dimension=None):
+        # Open the existing store, or create one once the vector dimension is known
+        dimension = dimension or self.dimension
+        if not self.store_path or self._store is not None:
+            self._check_dimension(dimension)
+            return
+        vectors_path = f"{self.store_path}.npy"
+
+        if not os.path.exists(vectors_path):
+            if dimension is None:
+                return
+            with _file_lock(f"{self.store_path}.lock"):
+                # Another process may have created it while we waited for the lock
+                if not os.path.exists(vectors_path):
+                    np.lib.format.open_memmap(
+                        vectors_path, mode="w+", dtype=np.float32, shape=(self.store_capacity, dimension)
+                    ).flush()
+        self._store = np.load(vectors_path, mmap_mode="r+")
+        self._check_dimension(dimension)
+        self._read_new_keys()
+
+    def _check_dimension(self, dimension):
+        if self._store is not None and dimension is not None and self._store.shape[1] != dimension:
+            raise ValueError(
+                f"Embedding store {self.store_path}.npy has dimension {self._store.shape[1]}, expected {dimension}"
+            )
+
+    def _read_new_keys(self):
+        # Pick up the keys appended since the last read, by this or another process
+        keys_path = f"{self.store_path}.keys"
+        if not os.path.exists(keys_path):
+            return
+        with open(keys_path, "rb") as keys_file:
+            keys_file.seek(self._keys_offset)
+            data = keys_file.read()
+        # A line being written by another process isn't complete yet
+        complete = data[:data.rfind(b"\n") + 1]
+        for key in complete.decode("utf-8").splitlines():
+            self._store_rows.setdefault(key, len(self._store_rows))
+        self._keys_offset += len(complete)
+
+    def get_many(self, texts):
+        """
+        Return {normalized text: vector} for the texts that are cached
+        """
+        found = {}
+        with self._lock:
+            for key in {normalize_text(text) for text in texts}:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    self._metrics["hits"] += 1
+                    found[key] = vector
+                    continue
+
+                self._open_store()
+                row = self._store_rows.get(key)
+                if row is None and self._store is not None:
+                    self._read_new_keys()
+                    row = self._store_rows.get(key)
+                if row is not None:
+                    vector = np.array(self._store[row])
+                    self._put(key, vector)
+                    self._metrics["disk_hits"] += 1
+                    found[key] = vector
+                else:
+                    self._metrics["misses"] += 1
+        return found
+
+    def put_many(self, vectors):
+        """
+        Cache {normalized text: vector} in memory and in the disk store
+        """
+        with self._lock:
+            for key, vector in vectors.items():
+                self._put(key, vector)
+
+            if not self.store_path or not vectors:
+                return
+            self._open_store(len(next(iter(vectors.values()))))
+            if not any(key not in self._store_rows for key in vectors):
+                return
+
+            with _file_lock(f"{self.store_path}.lock"):
+                # Rows are allocated after the keys every process has written so far
+                self._read_new_keys()
+                new_keys = [key for key in vectors if key not in self._store_rows]
+                free_rows = self.store_capacity - len(self._store_rows)
+                if free_rows < len(new_keys) and not self._store_full_reported:
+                    print(f"Embedding store {self.store_path} is full, new vectors are kept in memory only")
+                    self._store_full_reported = True
+
+                written = new_keys[:max(free_rows, 0)]
+                if not written:
+                    return
+                first_row = len(self._store_rows)
+                for row, key in enumerate(written, first_row):
+                    self._store[row] = vectors[key]
+                # Vectors are on disk before their keys make the rows visible to other processes
+                self._store.flush()
+                with open(f"{self.store_path}.keys", "ab") as keys_file:
+                    keys_file.write("".join(f"{key}\n" for key in written).encode("utf-8"))
+                self._read_new_keys()
+
+    def stats(self):
+        """
+        Return hit/miss counters and cache sizes
+        """
+        with self._lock:
+            return {
+                **self._metrics,
+                "entries": len(self._entries),
+                "stored_vectors": len(self._store_rows)
+            }
+
+    def _put(self, key, vector):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._metrics["evictions"] += 1
+
+
+_embedding_caches = {}
+_embedding_cache_lock = threading.Lock()
+
+
+def model_namespace(model=None):
+    """
+    Return the "model:backend" name a model's cached vectors are kept under, by
+    default the configured encoder's. Models not loaded by get_model (e.g. the
+    benchmark's hash encoder) use their class name and dimension.
+    """
+    if model is None:
+        model_name, backend, _ = encoder_settings()
+        return f"{model_name}:{backend}"
+    for (model_name, backend), loaded in list(_models.items()):
+        if loaded is model:
+            return f"{model_name}:{backend}"
+    return f"{type(model).__name__}:{model.get_sentence_embedding_dimension()}"
+
+
+def get_embedding_cache(model=None):
+    """
+    Return the process-wide query embedding cache of a model (by default the
+    configured encoder) configured from settings. Each model and backend has
+    its own cache and its own store next to EMBEDDING_CACHE_PATH, since their
+    vectors aren't interchangeable.
+    """
+    namespace = model_namespace(model)
+    with _embedding_cache_lock:
+        cache = _embedding_caches.get(namespace)
+        if cache is None:
+            store_path = get_setting("EMBEDDING_CACHE_PATH")
+            if store_path:
+                store_path = f"{store_path}.{re.sub(r'[^A-Za-z0-9._-]+', '_', namespace)}"
+            cache = _embedding_caches[namespace] = EmbeddingCache(
+                max_entries=get_setting("EMBEDDING_CACHE_MAX_ENTRIES", 10000, int),
+                store_path=store_path,
+                store_capacity=get_setting("EMBEDDING_CACHE_CAPACITY", 100000, int),
+                dimension=model.get_sentence_embedding_dimension() if model is not None else None
+            )
+        return cache
+
+
+class BatchingEncoder:
+    """
+    Encoder worker shared by every session and thread of the process: encode
+    requests are queued and encoded together, in batches of up to
+    max_batch_size texts collected within window_ms of the first request of
+    the batch. Callers get their vectors through futures.
+    """
+
+    def __init__(self, model, window_ms=5.0, max_batch_size=32):
+        self.model = model
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._metrics = {"requests": 0, "batches": 0, "encoded": 0, "largest_batch": 0}
+        threading.Thread(target=self._run, name="encoder-batcher", daemon=True).start()
+
+    def submit(self, text):
+        """
+        Queue one text and return a Future of its vector
+        """
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        gauge("encoder_queue_depth", self._queue.qsize())
+        return future
+
+    def encode(self, texts):
+        """
+        Encode texts through the shared batches; returns vectors in input order
+        """
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        """
+        Return request and batch counters and the current queue depth
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {
+            **metrics,
+            "mean_batch": metrics["encoded"] / metrics["batches"] if metrics["batches"] else 0.0,
+            "queue_depth": self._queue.qsize(),
+            "window_ms": self.window * 1000.0,
+            "max_batch_size": self.max_batch_size
+        }
+
+    def _next_batch(self):
+        # Block for the first request, then collect more until the window closes
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                # Once the window is over, still take what is already waiting
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            gauge("encoder_queue_depth", self._queue.qsize())
+            started = time.perf_counter()
+            for _, _, queued_at in batch:
+                observe("encoder_queue_wait_seconds", started - queued_at)
+
+            # Sessions often send the same text at once: encode it once
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            observe("encoder_batch_size", len(texts))
+            with self._lock:
+                self._metrics["requests"] += len(batch)
+                self._metrics["batches"] += 1
+                self._metrics["encoded"] += len(texts)
+                self._metrics["largest_batch"] = max(self._metrics["largest_batch"], len(texts))
+            try:
+                vectors = dict(zip(texts, self.model.encode(texts, batch_size=len(texts))))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for text, future, _ in batch:
+                future.set_result(vectors[text])
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(model):
+    """
+    Return the process-wide batching worker of a model
+    """
+    with _batchers_lock:
+        batcher = _batchers.get(id(model))
+        if batcher is None or batcher.model is not model:
+            batcher = _batchers[id(model)] = BatchingEncoder(
+                model,
+                window_ms=get_setting("ENCODER_BATCH_WINDOW_MS", 5.0, float),
+                max_batch_size=get_setting("ENCODER_MAX_BATCH_SIZE", 32, int)
+            )
+        return batcher
+
+
+def batcher_stats():
+    """
+    Return the statistics of every batching worker, by model
+    """
+    names = {id(model): f"{model_name} ({backend})" for (model_name, backend), model in _models.items()}
+    with _batchers_lock:
+        batchers = list(_batchers.values())
+    return {names.get(id(batcher.model), type(batcher.model).__name__): batcher.stats() for batcher in batchers}
+
+
+def encode_queries(model, texts):
+    """
+    Encode query texts in one batch, reusing cached vectors; returns vectors in input order
+    """
+    with span("encode", texts=len(texts)) as stage:
+        cache = get_embedding_cache(model)
+        keys = [normalize_text(text) for text in texts]
+        vectors = cache.get_many(texts)
+
+        # Encode each distinct uncached text once, in a single batched call
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        stage.set(cache_hits=len(vectors), encoded=len(missing))
+        count("cache_requests_total", len(vectors), cache="embedding", result="hit")
+        count("cache_requests_total", len(missing), cache="embedding", result="miss")
+        if missing:
+            if get_setting("ENCODER_BATCHING", True, bool):
+                # Batched with the encode requests of other sessions
+                encoded = get_batcher(model).encode(list(missing.values()))
+            else:
+                encoded = model.encode(list(missing.values()), batch_size=len(missing))
+            new_vectors = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, encoded)}
+            cache.put_many(new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[key] for key in keys]
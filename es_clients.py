@@ -0,0 +1,157 @@
+import threading
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+
+from settings import get_setting
+
+# Secret holding the API key for each index; ES_API_KEY is used when an index has no own key
+INDEX_API_KEY_SETTINGS = {
+    "programs": "ES_PROGRAMS_API_KEY",
+    "scholar": "ES_SCHOLARSHIPS_API_KEY"
+}
+
+# One long-lived client (and keep-alive connection pool) per index, shared by all sessions
+_clients = {}
+_async_clients = {}
+_local_backend = None
+_clients_lock = threading.Lock()
+
+
+def client_options():
+    """
+    Connection pool, retry and timeout options for Elasticsearch clients
+    """
+    return {
+        "connections_per_node": get_setting("ES_CONNECTIONS_PER_NODE", 10, int),
+        "max_retries": get_setting("ES_MAX_RETRIES", 3, int),
+        "retry_on_timeout": get_setting("ES_RETRY_ON_TIMEOUT", True, bool),
+        "request_timeout": get_setting("ES_REQUEST_TIMEOUT", 10.0, float),
+        "http_compress": get_setting("ES_HTTP_COMPRESS", True, bool)
+    }
+
+
+def connection_settings(index_name):
+    """
+    Return the Elasticsearch endpoint and API key configured for an index
+    """
+    url = get_setting("ES_URL")
+    api_key = get_setting(INDEX_API_KEY_SETTINGS.get(index_name, "ES_API_KEY")) or get_setting("ES_API_KEY")
+    if not url or not api_key:
+        raise ValueError(
+            f"Elasticsearch is not configured for index '{index_name}': "
+            f"set ES_URL and {INDEX_API_KEY_SETTINGS.get(index_name, 'ES_API_KEY')}"
+        )
+    return url, api_key
+
+
+def search_backend():
+    """
+    Return the configured search backend: "elasticsearch" or "local"
+    """
+    backend = get_setting("SEARCH_BACKEND", "elasticsearch")
+    if backend not in ("elasticsearch", "local"):
+        print(f"Unknown SEARCH_BACKEND {backend!r}, using elasticsearch")
+        backend = "elasticsearch"
+    return backend
+
+
+def get_local_backend():
+    """
+    Return the shared local vector index backend (see local_index.py)
+    """
+    global _local_backend
+    with _clients_lock:
+        if _local_backend is None:
+            from local_index import LocalSearchBackend
+            _local_backend = LocalSearchBackend(get_setting("LOCAL_INDEX_DIR", "local_index"))
+        return _local_backend
+
+
+def get_es_client(index_name):
+    """
+    Return the search client for an index: the pooled Elasticsearch client,
+    or the local vector index when SEARCH_BACKEND=local
+    """
+    if search_backend() == "local":
+        return get_local_backend()
+    return get_elasticsearch_client(index_name)
+
+
+def get_elasticsearch_client(index_name):
+    """
+    Return the pooled Elasticsearch client for an index, creating it on first use
+    """
+    es = _clients.get(index_name)
+    if es is not None:
+        return es
+
+    with _clients_lock:
+        es = _clients.get(index_name)
+        if es is None:
+            url, api_key = connection_settings(index_name)
+            es = Elasticsearch(url, api_key=api_key, **client_options())
+            _clients[index_name] = es
+        return es
+
+
+def get_async_es_client(index_name):
+    """
+    Return the pooled AsyncElasticsearch client for an index, creating it on first use.
+    Only use it from the shared event loop (see event_loop.run_coroutine).
+    """
+    if search_backend() == "local":
+        from local_index import AsyncLocalSearchBackend
+        return AsyncLocalSearchBackend(get_local_backend())
+
+    es = _async_clients.get(index_name)
+    if es is not None:
+        return es
+
+    with _clients_lock:
+        es = _async_clients.get(index_name)
+        if es is None:
+            url, api_key = connection_settings(index_name)
+            es = AsyncElasticsearch(url, api_key=api_key, **client_options())
+            _async_clients[index_name] = es
+        return es
+
+
+def index_version(index_name):
+    """
+    Return a token that changes whenever documents of an index are written or
+    deleted, or the index is recreated
+    """
+    if search_backend() == "local":
+        return get_local_backend().version(index_name)
+    stats = get_elasticsearch_client(index_name).indices.stats(index=index_name, metric="indexing")
+    # index_name may be an alias: combine every index behind it
+    return sorted(
+        (info.get("uuid"), info["primaries"]["indexing"]["index_total"], info["primaries"]["indexing"]["delete_total"])
+        for info in stats["indices"].values()
+    )
+
+
+def pool_stats():
+    """
+    Report connection pool statistics for every Elasticsearch client created so far
+    """
+    stats = {}
+    clients = [(index_name, es) for index_name, es in _clients.items()]
+    clients += [(f"{index_name} (async)", es) for index_name, es in _async_clients.items()]
+    for index_name, es in clients:
+        nodes = []
+        node_pool = getattr(es.transport, "node_pool", None)
+        for node in (node_pool.all() if node_pool is not None else []):
+            http_pool = getattr(node, "pool", None)
+            idle_queue = getattr(http_pool, "pool", None)
+            nodes.append({
+                "node": str(getattr(node, "base_url", node)),
+                "connections_opened": getattr(http_pool, "num_connections", None),
+                "requests_sent": getattr(http_pool, "num_requests", None),
+                "idle_connections": idle_queue.qsize() if idle_queue is not None else None
+            })
+        stats[index_name] = {
+            "options": client_options(),
+            "nodes": nodes
+        }
+    return stats
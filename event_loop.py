@@ -0,0 +1,28 @@
+import asyncio
+import threading
+
+# A single background event loop per process. Async clients (AsyncElasticsearch,
+# AsyncOpenAI) bind to the loop they first run on, so they must always share it.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+    Return the process-wide background event loop, starting it on first use
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="search-event-loop", daemon=True)
+            thread.start()
+            _loop = loop
+        return _loop
+
+
+def run_coroutine(coro, timeout=None):
+    """
+    Run a coroutine on the background loop and block the calling thread until it finishes
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result(timeout)
@@ -0,0 +1,150 @@
+import numpy as np
+
+from settings import get_setting
+
+FUSION_STRATEGIES = ("weighted_sum", "rrf", "max")
+
+# Score multiplier for hits in the detected location
+LOCATION_BOOST = 2.0
+
+# Rank constant of reciprocal rank fusion
+RRF_K = 60
+
+
+def fusion_strategy():
+    """
+    Return the configured fusion strategy
+    """
+    strategy = get_setting("FUSION_STRATEGY", "weighted_sum")
+    if strategy not in FUSION_STRATEGIES:
+        print(f"Unknown FUSION_STRATEGY {strategy!r}, using weighted_sum")
+        strategy = "weighted_sum"
+    return strategy
+
+
+def location_matches(source, location):
+    """
+    Return True if a document's location or city contains the location
+    """
+    location = location.lower()
+    return (location in str(source.get('location', '')).lower() or
+            location in str(source.get('city', '')).lower())
+
+
+def top_k_indices(scores, k):
+    """
+    Indices of the k highest scores, best first, using a partial selection
+    """
+    if k <= 0 or len(scores) == 0:
+        return np.array([], dtype=np.int64)
+    if k < len(scores):
+        candidates = np.sort(np.argpartition(-scores, k - 1)[:k])
+    else:
+        candidates = np.arange(len(scores))
+    # Stable sort keeps first-seen order between equal scores
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def fuse_results(intent_results, max_results=10, strategy=None, location_mode="boost"):
+    """
+    Fuse per-field kNN hits of every intent into one ranking.
+
+    intent_results is a list of (adjusted_weights, detected_location, field_hits).
+    location_mode "filter" keeps only documents in the detected location (programs),
+    "boost" keeps everything and boosts location matches (scholarships).
+    Returns (hits, missing_location): missing_location is the detected location
+    when nothing was found there, else None.
+    """
+    strategy = strategy or fusion_strategy()
+
+    doc_positions = {}  # _id -> position in docs
+    docs = []
+    doc_index, scores, ranks, weights, matched, located = [], [], [], [], [], []
+    match_cache = {}
+    detected_location = None
+    location_hit_count = {}
+
+    for adjusted_weights, detected_location, field_hits in intent_results:
+        for field, hits in field_hits.items():
+            if isinstance(hits, Exception) or not hits:
+                continue
+            weight = adjusted_weights[field]
+            for rank, hit in enumerate(hits):
+                position = doc_positions.get(hit['_id'])
+                if position is None:
+                    position = doc_positions[hit['_id']] = len(docs)
+                    docs.append(hit)
+
+                is_match = False
+                if detected_location:
+                    cache_key = (position, detected_location)
+                    is_match = match_cache.get(cache_key)
+                    if is_match is None:
+                        is_match = match_cache[cache_key] = location_matches(hit['_source'], detected_location)
+                    location_hit_count[detected_location] = location_hit_count.get(detected_location, 0) + 1
+
+                doc_index.append(position)
+                scores.append(hit['_score'])
+                ranks.append(rank)
+                weights.append(weight)
+                matched.append(is_match)
+                located.append(bool(detected_location))
+
+    if not docs:
+        return [], detected_location
+
+    doc_index = np.asarray(doc_index, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    ranks = np.asarray(ranks, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    matched = np.asarray(matched, dtype=bool)
+    located = np.asarray(located, dtype=bool)
+
+    if strategy == "rrf":
+        contributions = weights / (RRF_K + ranks + 1)
+    else:
+        contributions = scores * weights
+    contributions = np.where(matched, contributions * LOCATION_BOOST, contributions)
+
+    if location_mode == "filter":
+        # Hits of a located intent only count if they are in that location
+        keep = ~located | matched
+        doc_index, contributions = doc_index[keep], contributions[keep]
+
+    fused = np.zeros(len(docs), dtype=np.float64)
+    present = np.zeros(len(docs), dtype=bool)
+    present[doc_index] = True
+    if strategy == "max":
+        fused.fill(-np.inf)
+        np.maximum.at(fused, doc_index, contributions)
+    else:
+        np.add.at(fused, doc_index, contributions)
+
+    if location_mode == "filter" and detected_location:
+        # Only return documents found in a requested location
+        location_docs = np.zeros(len(docs), dtype=bool)
+        location_docs[np.asarray([position for (position, _), is_match in match_cache.items() if is_match],
+                                 dtype=np.int64)] = True
+        if not location_docs.any():
+            return [], detected_location
+        present &= location_docs
+
+    candidates = np.flatnonzero(present)
+    best = candidates[top_k_indices(fused[candidates], max_results)]
+
+    missing_location = None
+    if location_mode == "boost" and detected_location and not location_hit_count.get(detected_location):
+        missing_location = detected_location
+    return [docs[position] for position in best], missing_location
+
+
+def failed_fields(intent_results):
+    """
+    Return (field, error) for every field query that failed
+    """
+    return [
+        (field, hits)
+        for _, _, field_hits in intent_results
+        for field, hits in field_hits.items()
+        if isinstance(hits, Exception)
+    ]
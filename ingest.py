@@ -0,0 +1,405 @@
+"""
+Bulk ingestion of programs and scholarships into their Elasticsearch indices.
+
+Streams records from a JSONL or CSV file, encodes every text field with the
+search model in large batches and indexes them with parallel bulk requests.
+Progress is checkpointed so an interrupted run resumes where it stopped, and
+documents whose text hasn't changed (same content hash) are not re-encoded:
+only their other fields (fees, rankings, deadlines, ...) are updated.
+Every document also gets a combined vector, the weighted sum of its field
+vectors, for the two-stage retrieval mode (see retrieval.py).
+
+    python ingest.py programs data/programs.jsonl
+    python ingest.py scholar data/scholarships.csv --batch-size 512 --workers 4
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from elasticsearch import helpers
+
+from encoder import get_model
+from es_clients import get_elasticsearch_client
+from retrieval import COMBINED_VECTOR_FIELD
+from search_engine import PROGRAM_BASE_WEIGHTS, SCHOLARSHIP_BASE_WEIGHTS
+
+# Vector field -> source text field, per index
+INDEX_VECTOR_FIELDS = {
+    "programs": {
+        "courseDetailVector": "courseDetail",
+        "overviewVector": "overview",
+        "entryRequirementsVector": "entryRequirements",
+        "scholarshipsFundingVector": "scholarshipsFunding",
+        "courseTitleVector": "courseTitle",
+        "universityNameVector": "universityName",
+        "locationVector": "location"
+    },
+    "scholar": {
+        "universityNameVector": "universityName",
+        "titleVector": "title",
+        "fundingDetailsVector": "fundingDetails",
+        "qualificationVector": "qualification",
+        "locationVector": "location"
+    }
+}
+
+# Weights of the field vectors in the combined vector: the base weights of the
+# search, so the single kNN of the first stage ranks like the fused field queries
+INDEX_COMBINED_WEIGHTS = {
+    "programs": PROGRAM_BASE_WEIGHTS,
+    "scholar": SCHOLARSHIP_BASE_WEIGHTS
+}
+
+# Fields identifying a document when the source has no id column
+INDEX_KEY_FIELDS = {
+    "programs": ["universityName", "courseTitle"],
+    "scholar": ["universityName", "title"]
+}
+
+CONTENT_HASH_FIELD = "contentHash"
+
+# CSV columns read as numbers; every other column (ids included) stays a string
+INDEX_NUMERIC_FIELDS = {
+    "programs": {"worldRanking", "courseFee", "averageStartingSalary", "entryScore", "jobPlacementRatio"},
+    "scholar": set()
+}
+
+
+def _csv_number(value):
+    # CSV has no types: restore the numeric columns so fees, salaries and rankings
+    # stay numeric. Values that aren't finite numbers are left out (NaN and
+    # infinity aren't valid JSON for Elasticsearch).
+    for cast in (int, float):
+        try:
+            number = cast(value)
+        except (TypeError, ValueError):
+            continue
+        return number if np.isfinite(number) else None
+    return None
+
+
+def read_records(path, numeric_fields=()):
+    """
+    Stream records from a JSONL or CSV file; CSV values are strings except in
+    numeric_fields
+    """
+    with open(path, encoding="utf-8", newline="") as source:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(source):
+                record = {}
+                for key, value in row.items():
+                    if value == "":
+                        continue
+                    if key in numeric_fields:
+                        value = _csv_number(value)
+                        if value is None:
+                            continue
+                    record[key] = value
+                yield record
+        else:
+            for line in source:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def batched(records, batch_size):
+    """
+    Group an iterator of records into lists of batch_size
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def document_id(record, index_name, id_field):
+    """
+    Use the record's id field, or a stable hash of its key fields
+    """
+    if record.get(id_field):
+        return str(record[id_field])
+    key = "|".join(str(record.get(field, "")) for field in INDEX_KEY_FIELDS[index_name])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def content_hash(record, text_fields):
+    """
+    Hash of the text that feeds the vector fields
+    """
+    payload = json.dumps({field: record.get(field) for field in sorted(text_fields)}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(path, source_path):
+    """
+    Return the number of records already indexed from source_path
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path, encoding="utf-8") as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint.get("source") != os.path.abspath(source_path):
+        print(f"Checkpoint {path} belongs to {checkpoint.get('source')}, starting from the beginning")
+        return 0
+    return checkpoint.get("records_done", 0)
+
+
+def save_checkpoint(path, source_path, records_done):
+    """
+    Atomically record how many records have been indexed
+    """
+    if not path:
+        return
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump({
+            "source": os.path.abspath(source_path),
+            "records_done": records_done,
+            "updated_at": time.time()
+        }, checkpoint_file)
+    os.replace(temp_path, path)
+
+
+def combined_vector(field_vectors, weights):
+    """
+    Normalized weighted sum of a document's normalized field vectors, or None
+    when it has none. q . sum(w * v) equals the weighted sum of the per-field
+    similarities that fusion computes.
+    """
+    total = None
+    for field, vector in field_vectors.items():
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm or not weights.get(field):
+            continue
+        part = vector * (weights[field] / norm)
+        total = part if total is None else total + part
+    if total is None:
+        return None
+    norm = np.linalg.norm(total)
+    return total / norm if norm else None
+
+
+def _vector_mapping(dimension):
+    return {"type": "dense_vector", "dims": dimension, "index": True, "similarity": "cosine"}
+
+
+def create_index(es, index_name, dimension):
+    """
+    Create the index with dense_vector mappings for every vector field if it doesn't exist
+    """
+    if es.indices.exists(index=index_name):
+        return
+    properties = {field: _vector_mapping(dimension) for field in INDEX_VECTOR_FIELDS[index_name]}
+    properties[COMBINED_VECTOR_FIELD] = _vector_mapping(dimension)
+    properties[CONTENT_HASH_FIELD] = {"type": "keyword"}
+    es.indices.create(index=index_name, mappings={"properties": properties})
+    print(f"Created index {index_name}")
+
+
+def ensure_combined_mapping(es, index_name, dimension):
+    """
+    Add the combined vector field to an index created before it existed;
+    without a mapping Elasticsearch would map the vectors as plain floats
+    """
+    mappings = es.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    if COMBINED_VECTOR_FIELD not in mappings.get("properties", {}):
+        es.indices.put_mapping(index=index_name, properties={COMBINED_VECTOR_FIELD: _vector_mapping(dimension)})
+        print(f"Added {COMBINED_VECTOR_FIELD} to {index_name}; "
+              f"re-ingest with --force to fill it for existing documents")
+
+
+def existing_hashes(es, index_name, ids):
+    """
+    Return {id: content hash} for documents already in the index
+    """
+    res = es.mget(index=index_name, ids=ids, source=[CONTENT_HASH_FIELD])
+    return {
+        doc["_id"]: doc["_source"].get(CONTENT_HASH_FIELD)
+        for doc in res["docs"]
+        if doc.get("found")
+    }
+
+
+def prepare_actions(batch, index_name, model, es, id_field, encode_batch_size, force=False):
+    """
+    Encode the records of a batch whose text changed and return (bulk actions,
+    count of records not re-encoded). Records with unchanged text become partial
+    updates that keep the stored vectors.
+    """
+    vector_fields = INDEX_VECTOR_FIELDS[index_name]
+    text_fields = list(vector_fields.values())
+
+    docs = []
+    for record in batch:
+        docs.append((document_id(record, index_name, id_field), record, content_hash(record, text_fields)))
+
+    unchanged = set()
+    if not force:
+        known = existing_hashes(es, index_name, [doc_id for doc_id, _, _ in docs])
+        unchanged = {doc_id for doc_id, _, digest in docs if known.get(doc_id) == digest}
+    updates = [
+        {"_op_type": "update", "_index": index_name, "_id": doc_id,
+         "doc": {k: v for k, v in record.items() if k != id_field}}
+        for doc_id, record, _ in docs if doc_id in unchanged
+    ]
+    docs = [doc for doc in docs if doc[0] not in unchanged]
+
+    # Encode every text field of every changed document in one batched call
+    texts, targets = [], []
+    for position, (_, record, _) in enumerate(docs):
+        for vector_field, text_field in vector_fields.items():
+            text = record.get(text_field)
+            if text not in (None, ""):
+                texts.append(str(text))
+                targets.append((position, vector_field))
+
+    vectors = model.encode(texts, batch_size=encode_batch_size) if texts else []
+
+    sources = [dict(record, **{CONTENT_HASH_FIELD: digest}) for _, record, digest in docs]
+    sources = [{k: v for k, v in source.items() if k != id_field} for source in sources]
+    field_vectors = [{} for _ in sources]
+    for (position, vector_field), vector in zip(targets, vectors):
+        sources[position][vector_field] = vector.tolist()
+        field_vectors[position][vector_field] = vector
+
+    weights = INDEX_COMBINED_WEIGHTS[index_name]
+    for source, doc_vectors in zip(sources, field_vectors):
+        combined = combined_vector(doc_vectors, weights)
+        if combined is not None:
+            source[COMBINED_VECTOR_FIELD] = combined.tolist()
+
+    actions = [
+        {"_op_type": "index", "_index": index_name, "_id": doc_id, "_source": source}
+        for (doc_id, _, _), source in zip(docs, sources)
+    ]
+    return actions + updates, len(unchanged)
+
+
+def bulk_index(es, actions, workers, chunk_size):
+    """
+    Index actions with parallel bulk requests; returns (indexed, failed)
+    """
+    indexed, failed = 0, 0
+    for ok, item in helpers.parallel_bulk(
+        es,
+        actions,
+        thread_count=workers,
+        chunk_size=chunk_size,
+        queue_size=workers,  # bounded queue: producers wait for the cluster
+        raise_on_error=False,
+        raise_on_exception=False
+    ):
+        if ok:
+            indexed += 1
+        else:
+            failed += 1
+            if failed <= 5:
+                print(f"Failed to index document: {item}")
+    return indexed, failed
+
+
+def ingest(index_name, source_path, batch_size=256, encode_batch_size=64, workers=4, chunk_size=200,
+           id_field="id", checkpoint_path=None, force=False, create=False):
+    """
+    Stream, encode and bulk index a source file, resuming from the checkpoint
+    """
+    if index_name not in INDEX_VECTOR_FIELDS:
+        raise ValueError(f"Unknown index {index_name!r}, expected one of {', '.join(INDEX_VECTOR_FIELDS)}")
+
+    es = get_elasticsearch_client(index_name)
+    # Documents are always encoded at full precision; quantized backends are for queries
+    model = get_model(backend="torch")
+    if create:
+        create_index(es, index_name, model.get_sentence_embedding_dimension())
+    elif es.indices.exists(index=index_name):
+        ensure_combined_mapping(es, index_name, model.get_sentence_embedding_dimension())
+
+    records_done = load_checkpoint(checkpoint_path, source_path)
+    if records_done:
+        print(f"Resuming after {records_done} records")
+
+    records = read_records(source_path, INDEX_NUMERIC_FIELDS[index_name] - {id_field})
+    for _ in range(records_done):
+        next(records, None)
+
+    totals = {"indexed": 0, "failed": 0, "unchanged": 0}
+    start = time.perf_counter()
+
+    # Encode the next batch while the previous one is being indexed; at most one
+    # bulk batch is in flight so memory stays bounded
+    with ThreadPoolExecutor(max_workers=1) as bulk_executor:
+        pending = None
+        for batch in batched(records, batch_size):
+            actions, unchanged = prepare_actions(batch, index_name, model, es, id_field, encode_batch_size, force)
+            totals["unchanged"] += unchanged
+
+            if pending is not None:
+                records_done = _finish_batch(pending, totals, checkpoint_path, source_path, start)
+            pending = (bulk_executor.submit(bulk_index, es, actions, workers, chunk_size), records_done + len(batch))
+
+        if pending is not None:
+            _finish_batch(pending, totals, checkpoint_path, source_path, start)
+
+    es.indices.refresh(index=index_name)
+    print(f"Done: {totals['indexed']} indexed ({totals['unchanged']} with unchanged text), {totals['failed']} failed "
+          f"in {time.perf_counter() - start:.1f}s")
+    return totals
+
+
+def _finish_batch(pending, totals, checkpoint_path, source_path, start):
+    future, records_done = pending
+    indexed, failed = future.result()
+    totals["indexed"] += indexed
+    totals["failed"] += failed
+    # The checkpoint is a count of records from the start of the file: once a
+    # batch had failures it stays before that batch, so --resume retries it
+    if not totals["failed"]:
+        save_checkpoint(checkpoint_path, source_path, records_done)
+    elif failed:
+        print(f"{failed} documents failed; the checkpoint is not advanced past this batch")
+    elapsed = time.perf_counter() - start
+    print(f"{records_done} records processed ({totals['indexed'] / elapsed:.0f} docs/s indexed)")
+    return records_done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode and bulk index programs or scholarships")
+    parser.add_argument("index", choices=sorted(INDEX_VECTOR_FIELDS), help="Target index")
+    parser.add_argument("source", help="JSONL or CSV file with one record per line/row")
+    parser.add_argument("--batch-size", type=int, default=256, help="Records encoded per batch")
+    parser.add_argument("--encode-batch-size", type=int, default=64, help="Texts per model forward pass")
+    parser.add_argument("--workers", type=int, default=4, help="Parallel bulk threads")
+    parser.add_argument("--chunk-size", type=int, default=200, help="Documents per bulk request")
+    parser.add_argument("--id-field", default="id", help="Record field used as document id")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <source>.checkpoint)")
+    parser.add_argument("--force", action="store_true", help="Re-encode documents even if unchanged")
+    parser.add_argument("--create-index", action="store_true", help="Create the index with vector mappings")
+    args = parser.parse_args()
+
+    ingest(
+        args.index,
+        args.source,
+        batch_size=args.batch_size,
+        encode_batch_size=args.encode_batch_size,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        id_field=args.id_field,
+        checkpoint_path=args.checkpoint or f"{args.source}.checkpoint",
+        force=args.force,
+        create=args.create_index
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from budget import call_llm, call_llm_async
+from settings import get_setting
+from telemetry import count, span
+
+
+def cache_key(model, messages, **params):
+    """
+    Build a stable cache key from the model, prompt messages and request parameters
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    In-memory LRU cache with TTL and size-based eviction, optionally backed by SQLite
+    """
+
+    def __init__(self, max_entries=2048, max_bytes=8 * 1024 * 1024, ttl_seconds=7 * 24 * 3600, db_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (value, created_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - ttl_seconds,))
+            self._db.commit()
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self._metrics["hits"] += 1
+                    return value
+                self._remove(key)
+                self._metrics["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    self._metrics["disk_hits"] += 1
+                    self._store(key, row[0], row[1])
+                    return row[0]
+
+            self._metrics["misses"] += 1
+            return None
+
+    def set(self, key, value):
+        """
+        Cache a value in memory and, if configured, on disk
+        """
+        created_at = time.time()
+        with self._lock:
+            self._store(key, value, created_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, value, created_at)
+                )
+                self._db.commit()
+
+    def clear(self):
+        """
+        Drop every cached entry (memory and disk)
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+                self._db.commit()
+
+    def stats(self):
+        """
+        Return hit/miss counters and current cache size
+        """
+        with self._lock:
+            lookups = self._metrics["hits"] + self._metrics["disk_hits"] + self._metrics["misses"]
+            return {
+                **self._metrics,
+                "hit_rate": (self._metrics["hits"] + self._metrics["disk_hits"]) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "persistent": self._db is not None
+            }
+
+    def _store(self, key, value, created_at):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, created_at)
+        self._bytes += len(value.encode("utf-8"))
+
+        # Evict least recently used entries until both limits are respected
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self._metrics["evictions"] += 1
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value.encode("utf-8"))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """
+    Return the process-wide LLM response cache configured from settings
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache(
+                max_entries=get_setting("LLM_CACHE_MAX_ENTRIES", 2048, int),
+                max_bytes=get_setting("LLM_CACHE_MAX_BYTES", 8 * 1024 * 1024, int),
+                ttl_seconds=get_setting("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600, float),
+                db_path=get_setting("LLM_CACHE_DB")
+            )
+        return _cache
+
+
+def _cached(cache, key, stage):
+    content = cache.get(key)
+    hit = content is not None
+    stage.set(cache_hit=hit)
+    count("cache_requests_total", cache="llm", result="hit" if hit else "miss")
+    return content
+
+
+def _store_response(cache, key, response, stage):
+    content = response.choices[0].message.content
+    # A reply without text (e.g. a refusal) isn't cached; the parsers reject "" and fall back
+    if content is not None:
+        cache.set(key, content)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        stage.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+        count("llm_tokens_total", usage.prompt_tokens, kind="prompt")
+        count("llm_tokens_total", usage.completion_tokens, kind="completion")
+    return content or ""
+
+
+def cached_completion(client, model, messages, stage="llm", **params):
+    """
+    Return the text of a chat completion, served from the cache when possible.
+    Calls get the timeout, hedging and retries of their stage (see budget.py).
+    """
+    cache = get_llm_cache()
+    key = cache_key(model, messages, **params)
+    with span("llm", model=model, stage=stage) as llm_span:
+        content = _cached(cache, key, llm_span)
+        if content is None:
+            response = call_llm(
+                lambda timeout: client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+                    model=model, messages=messages, **params
+                ),
+                stage,
+                service="llm"
+            )
+            content = _store_response(cache, key, response, llm_span)
+    return content
+
+
+async def cached_completion_async(async_client, model, messages, stage="llm", **params):
+    """
+    Async cached_completion for AsyncOpenAI clients
+    """
+    cache = get_llm_cache()
+    key = cache_key(model, messages, **params)
+    with span("llm", model=model, stage=stage) as llm_span:
+        content = _cached(cache, key, llm_span)
+        if content is None:
+            response = await call_llm_async(
+                lambda timeout: async_client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+                    model=model, messages=messages, **params
+                ),
+                stage,
+                service="llm"
+            )
+            content = _store_response(cache, key, response, llm_span)
+    return content
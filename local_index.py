@@ -0,0 +1,464 @@
+"""
+Embedded vector index backend: an alternative to the Elasticsearch cluster for
+catalogs that fit on one node.
+
+An index export stores every vector field as a memory-mapped float32 (or int8)
+matrix of normalized vectors next to the documents, with a mask of the rows
+that have the field (documents without it are never returned). Top-k uses an HNSW graph
+when hnswlib is installed, and exact brute force otherwise (and for filtered
+queries). The backend answers the same knn_search/msearch calls the search
+functions send to Elasticsearch, including the script_score rescore of the
+two-stage search.
+
+    python local_index.py export programs --out local_index --hnsw
+    python local_index.py export scholar --out local_index --dtype int8
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+META_FILE = "meta.json"
+DOCS_FILE = "docs.jsonl"
+
+# Rows scored per block in brute-force search, to bound temporary memory
+BRUTE_FORCE_BLOCK = 65536
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _quantize_int8(matrix):
+    # Symmetric per-row quantization: row ~= int8_row * scale
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def export_index(es, index_name, out_dir, vector_fields, dtype="float32", build_hnsw=False, batch_size=1000):
+    """
+    Export documents and vector fields of an Elasticsearch index to out_dir/index_name
+    """
+    from elasticsearch import helpers
+
+    if dtype not in ("float32", "int8"):
+        raise ValueError(f"Unsupported dtype {dtype!r}, expected float32 or int8")
+
+    index_dir = os.path.join(out_dir, index_name)
+    os.makedirs(index_dir, exist_ok=True)
+    count = es.count(index=index_name)["count"]
+
+    matrices = {}
+    present = {}
+    dimension = None
+    rows = 0
+    with open(os.path.join(index_dir, DOCS_FILE), "w", encoding="utf-8") as docs_file:
+        for doc in helpers.scan(es, index=index_name, size=batch_size, query={"query": {"match_all": {}}}):
+            if rows >= count:
+                break  # documents added during the export are left for the next one
+            source = doc["_source"]
+            for field in vector_fields:
+                vector = source.pop(field, None)
+                if vector is None:
+                    continue
+                if dimension is None:
+                    dimension = len(vector)
+                if field not in matrices:
+                    matrices[field] = np.lib.format.open_memmap(
+                        os.path.join(index_dir, f"{field}.f32.npy"), mode="w+", dtype=np.float32,
+                        shape=(count, dimension)
+                    )
+                    present[field] = np.zeros(count, dtype=bool)
+                matrices[field][rows] = vector
+                present[field][rows] = True
+            docs_file.write(json.dumps({"_id": doc["_id"], "_source": source}) + "\n")
+            rows += 1
+
+    fields = {}
+    for field in list(matrices):
+        matrix = matrices.pop(field)
+        for start in range(0, rows, BRUTE_FORCE_BLOCK):
+            matrix[start:start + BRUTE_FORCE_BLOCK] = _normalize_rows(matrix[start:start + BRUTE_FORCE_BLOCK])
+        matrix.flush()
+        float_path = os.path.join(index_dir, f"{field}.f32.npy")
+
+        if dtype == "int8":
+            quantized, scales = _quantize_int8(np.asarray(matrix[:rows]))
+            np.save(os.path.join(index_dir, f"{field}.i8.npy"), quantized)
+            np.save(os.path.join(index_dir, f"{field}.scales.npy"), scales)
+            fields[field] = {"file": f"{field}.i8.npy", "scales": f"{field}.scales.npy"}
+        else:
+            fields[field] = {"file": f"{field}.f32.npy"}
+        np.save(os.path.join(index_dir, f"{field}.present.npy"), present[field][:rows])
+        fields[field]["present"] = f"{field}.present.npy"
+
+        if build_hnsw:
+            if hnswlib is None:
+                print("hnswlib is not installed, skipping HNSW graphs (brute force will be used)")
+                build_hnsw = False
+            else:
+                labels = np.flatnonzero(present[field][:rows])
+                graph = _build_hnsw(np.asarray(matrix[labels]), labels)
+                graph.save_index(os.path.join(index_dir, f"{field}.hnsw"))
+                fields[field]["hnsw"] = f"{field}.hnsw"
+
+        del matrix
+        if dtype == "int8":
+            os.remove(float_path)
+
+    with open(os.path.join(index_dir, META_FILE), "w", encoding="utf-8") as meta_file:
+        json.dump({
+            "index": index_name,
+            "count": rows,
+            "dimension": dimension,
+            "dtype": dtype,
+            "fields": fields
+        }, meta_file, indent=2)
+    print(f"Exported {rows} documents of {index_name} to {index_dir}")
+
+
+def _build_hnsw(matrix, labels, m=16, ef_construction=200):
+    # Only rows that have the field are added, labelled with their row number
+    graph = hnswlib.Index(space="ip", dim=matrix.shape[1])
+    graph.init_index(max_elements=max(len(matrix), 1), M=m, ef_construction=ef_construction)
+    if len(matrix):
+        graph.add_items(matrix, labels)
+    return graph
+
+
+def _filter_mask(docs, query):
+    """
+    Evaluate the kNN filter shapes the search sends (bool/should of match_phrase
+    or term clauses) against document sources; returns a boolean row mask
+    """
+    if "bool" in query:
+        should = query["bool"].get("should", [])
+        mask = np.zeros(len(docs), dtype=bool) if should else np.ones(len(docs), dtype=bool)
+        for clause in should:
+            mask |= _filter_mask(docs, clause)
+        for clause in query["bool"].get("filter", []) + query["bool"].get("must", []):
+            mask &= _filter_mask(docs, clause)
+        return mask
+
+    if "match_phrase" in query:
+        (field, value), = query["match_phrase"].items()
+        value = str(value).lower()
+        return np.fromiter((value in str(doc["_source"].get(field, "")).lower() for doc in docs),
+                           dtype=bool, count=len(docs))
+
+    if "term" in query:
+        (field, condition), = query["term"].items()
+        field = field[:-len(".keyword")] if field.endswith(".keyword") else field
+        value = condition["value"] if isinstance(condition, dict) else condition
+        if isinstance(condition, dict) and condition.get("case_insensitive"):
+            value = str(value).lower()
+            return np.fromiter((str(doc["_source"].get(field, "")).lower() == value for doc in docs),
+                               dtype=bool, count=len(docs))
+        return np.fromiter((doc["_source"].get(field) == value for doc in docs), dtype=bool, count=len(docs))
+
+    raise ValueError(f"Unsupported filter for the local index: {query}")
+
+
+class LocalVectorIndex:
+    """
+    One exported index: documents plus a memory-mapped matrix per vector field
+    """
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as meta_file:
+            self.meta = json.load(meta_file)
+        with open(os.path.join(index_dir, DOCS_FILE), encoding="utf-8") as docs_file:
+            self.docs = [json.loads(line) for line in docs_file]
+
+        self.matrices = {}
+        self.present = {}  # field -> boolean row mask of documents that have the field
+        self._present_rows = {}  # field -> row numbers, only when some rows lack the field
+        self.scales = {}
+        self.graphs = {}
+        for field, info in self.meta["fields"].items():
+            # The export may have reserved more rows than it wrote
+            matrix = np.load(os.path.join(index_dir, info["file"]), mmap_mode="r")
+            self.matrices[field] = matrix[:self.meta["count"]]
+            if "present" in info:
+                self.present[field] = np.load(os.path.join(index_dir, info["present"]))
+            else:
+                # Exports without a mask: a missing vector was left as a zero row
+                self.present[field] = np.concatenate([
+                    self.matrices[field][start:start + BRUTE_FORCE_BLOCK].any(axis=1)
+                    for start in range(0, self.meta["count"], BRUTE_FORCE_BLOCK)
+                ] or [np.zeros(0, dtype=bool)])
+            if not self.present[field].all():
+                self._present_rows[field] = np.flatnonzero(self.present[field])
+            if "scales" in info:
+                self.scales[field] = np.load(os.path.join(index_dir, info["scales"]))
+            if "hnsw" in info and hnswlib is not None:
+                graph = hnswlib.Index(space="ip", dim=self.meta["dimension"])
+                graph.load_index(os.path.join(index_dir, info["hnsw"]), max_elements=self.meta["count"])
+                self.graphs[field] = graph
+        self._filter_cache = {}
+        self._positions = None  # _id -> row, built on the first lookup by id
+        self._lock = threading.Lock()
+
+    def _filter_rows(self, query):
+        key = json.dumps(query, sort_keys=True)
+        with self._lock:
+            rows = self._filter_cache.get(key)
+            if rows is None:
+                rows = np.flatnonzero(_filter_mask(self.docs, query))
+                if len(self._filter_cache) > 256:
+                    self._filter_cache.clear()
+                self._filter_cache[key] = rows
+            return rows
+
+    def _exact(self, field, query_vector, k, rows=None):
+        matrix = self.matrices[field]
+        scales = self.scales.get(field)
+        total = len(matrix) if rows is None else len(rows)
+
+        best_rows, best_scores = [], []
+        for start in range(0, total, BRUTE_FORCE_BLOCK):
+            if rows is None:
+                block_rows = np.arange(start, min(start + BRUTE_FORCE_BLOCK, total))
+                block = matrix[start:start + BRUTE_FORCE_BLOCK]
+            else:
+                block_rows = rows[start:start + BRUTE_FORCE_BLOCK]
+                block = matrix[block_rows]
+            scores = block.astype(np.float32) @ query_vector
+            if scales is not None:
+                scores *= scales[block_rows]
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                block_rows, scores = block_rows[top], scores[top]
+            best_rows.append(block_rows)
+            best_scores.append(scores)
+
+        if not best_rows:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        best_rows, best_scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        order = np.argsort(-best_scores, kind="stable")[:k]
+        return best_rows[order], best_scores[order]
+
+    def knn(self, field, query_vector, k, num_candidates, filter=None, exact=False):
+        """
+        Return the top-k (row, cosine similarity) pairs for a vector field;
+        exact skips the HNSW graph (ground truth for benchmarks/knn_tuning.py)
+        """
+        if field not in self.matrices:
+            raise KeyError(f"Field {field} is not in the local index {self.meta['index']}")
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm:
+            query_vector = query_vector / norm
+
+        if filter is not None:
+            # Filtered sets are small enough for exact search
+            rows = self._filter_rows(filter)
+            return self._exact(field, query_vector, k, rows[self.present[field][rows]])
+
+        graph = None if exact else self.graphs.get(field)
+        if graph is not None:
+            with self._lock:
+                graph.set_ef(max(num_candidates, k))
+                labels, distances = graph.knn_query(query_vector, k=min(k, graph.get_current_count()))
+            labels = labels[0].astype(np.int64)
+            # Graphs built before the presence mask may hold zero rows
+            keep = self.present[field][labels]
+            # "ip" distance is 1 - inner product
+            return labels[keep], 1.0 - distances[0][keep]
+        return self._exact(field, query_vector, k, self._present_rows.get(field))
+
+    def vector(self, row, field):
+        """
+        Return the stored (normalized) vector of a field as a list, or None when
+        the document had none
+        """
+        if not self.present[field][row]:
+            return None
+        vector = self.matrices[field][row].astype(np.float32)
+        if field in self.scales:
+            vector *= self.scales[field][row]
+        return vector.tolist()
+
+    def get(self, doc_id, source=None):
+        """
+        Return a document's source by id, or None when it isn't in the index.
+        Vector fields named in source are read from their matrices, like the
+        vectors Elasticsearch keeps in _source.
+        """
+        row = self._row(doc_id)
+        if row is None:
+            return None
+        doc_source = self.docs[row]["_source"]
+        if source is not None:
+            doc_source = {key: doc_source[key] for key in source if key in doc_source}
+            for field in source:
+                if field in self.matrices:
+                    vector = self.vector(row, field)
+                    if vector is not None:
+                        doc_source[field] = vector
+        return doc_source
+
+    def _row(self, doc_id):
+        with self._lock:
+            if self._positions is None:
+                self._positions = {doc["_id"]: row for row, doc in enumerate(self.docs)}
+        return self._positions.get(doc_id)
+
+    def hits(self, knn, source=None):
+        """
+        Run one kNN clause and return Elasticsearch-style hits
+        """
+        rows, similarities = self.knn(
+            knn["field"], knn["query_vector"], knn["k"], knn.get("num_candidates", knn["k"]), knn.get("filter")
+        )
+        return self._hits(rows, similarities, source)
+
+    def script_score_hits(self, query, size, source=None):
+        """
+        Answer the two-stage rescore (retrieval.rescore_body): exact cosine
+        similarity of the listed ids that have the field
+        """
+        try:
+            clauses = query["script_score"]["query"]["bool"]["filter"]
+            ids = next(clause["ids"]["values"] for clause in clauses if "ids" in clause)
+            field = next(clause["exists"]["field"] for clause in clauses if "exists" in clause)
+            query_vector = query["script_score"]["script"]["params"]["query_vector"]
+        except (KeyError, StopIteration):
+            raise ValueError(f"Unsupported query for the local index: {query}")
+        if field not in self.matrices:
+            raise KeyError(f"Field {field} is not in the local index {self.meta['index']}")
+
+        rows = np.array([row for row in map(self._row, ids) if row is not None], dtype=np.int64)
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm:
+            query_vector = query_vector / norm
+        rows, similarities = self._exact(field, query_vector, size, rows[self.present[field][rows]])
+        return self._hits(rows, similarities, source)
+
+    def _hits(self, rows, similarities, source):
+        hits = []
+        for row, similarity in zip(rows, similarities):
+            doc = self.docs[row]
+            doc_source = doc["_source"]
+            if source is False:
+                doc_source = {}
+            elif source is not None:
+                doc_source = {key: doc_source[key] for key in source if key in doc_source}
+            hits.append({
+                "_index": self.meta["index"],
+                "_id": doc["_id"],
+                "_score": float((1.0 + similarity) / 2.0),  # same scale as ES cosine similarity
+                "_source": doc_source
+            })
+        return hits
+
+
+class LocalSearchBackend:
+    """
+    Drop-in for the Elasticsearch client calls made by retrieval.py
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def index(self, index_name):
+        with self._lock:
+            local_index = self._indices.get(index_name)
+            if local_index is None:
+                local_index = LocalVectorIndex(os.path.join(self.root_dir, index_name))
+                self._indices[index_name] = local_index
+            return local_index
+
+    def version(self, index_name):
+        """
+        Change token of an exported index: the modification time of its metadata
+        """
+        return os.stat(os.path.join(self.root_dir, index_name, META_FILE)).st_mtime_ns
+
+    def knn_search(self, index, knn, source=None, **kwargs):
+        return {"hits": {"hits": self.index(index).hits(knn, source)}}
+
+    def msearch(self, searches, **kwargs):
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                local_index = self.index(header["index"])
+                if "knn" in body:
+                    hits = local_index.hits(body["knn"], body.get("_source"))
+                else:
+                    hits = local_index.script_score_hits(body["query"], body.get("size", 10), body.get("_source"))
+                responses.append({"hits": {"hits": hits[:body.get("size", len(hits))]}})
+            except Exception as e:
+                responses.append({"error": {"type": type(e).__name__, "reason": str(e)}})
+        return {"responses": responses}
+
+    def mget(self, index, ids, source=None, **kwargs):
+        local_index = self.index(index)
+        docs = []
+        for doc_id in ids:
+            doc_source = local_index.get(doc_id, source)
+            if doc_source is None:
+                docs.append({"_index": index, "_id": doc_id, "found": False})
+            else:
+                docs.append({"_index": index, "_id": doc_id, "found": True, "_source": doc_source})
+        return {"docs": docs}
+
+
+class AsyncLocalSearchBackend:
+    """
+    Async wrapper so the concurrent search engine can use the local backend
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def knn_search(self, *args, **kwargs):
+        return await asyncio.to_thread(self.backend.knn_search, *args, **kwargs)
+
+    async def msearch(self, *args, **kwargs):
+        return await asyncio.to_thread(self.backend.msearch, *args, **kwargs)
+
+    async def mget(self, *args, **kwargs):
+        return await asyncio.to_thread(self.backend.mget, *args, **kwargs)
+
+
+def main():
+    from es_clients import get_elasticsearch_client
+    from ingest import INDEX_VECTOR_FIELDS
+    from retrieval import COMBINED_VECTOR_FIELD
+
+    parser = argparse.ArgumentParser(description="Export Elasticsearch indices for the local vector backend")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Export an index to local files")
+    export_parser.add_argument("index", choices=sorted(INDEX_VECTOR_FIELDS))
+    export_parser.add_argument("--out", default="local_index", help="Output directory")
+    export_parser.add_argument("--dtype", choices=["float32", "int8"], default="float32")
+    export_parser.add_argument("--hnsw", action="store_true", help="Build HNSW graphs (requires hnswlib)")
+    args = parser.parse_args()
+
+    export_index(
+        get_elasticsearch_client(args.index),
+        args.index,
+        args.out,
+        list(INDEX_VECTOR_FIELDS[args.index]) + [COMBINED_VECTOR_FIELD],
+        dtype=args.dtype,
+        build_hnsw=args.hnsw
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import difflib
+import re
+
+# Canonical location name -> aliases (abbreviations, alternative names and spellings).
+# Only unambiguous names are listed: codes such as "IT", "IN", "CA" or "FIN" collide with
+# common search terms, and parts of a country ("Scotland") or names that could mean several
+# places ("America", "Gulf", "Korea") would be widened to the wrong canonical name, so both
+# are left to the LLM fallback.
+LOCATION_ALIASES = {
+    # Countries
+    "United Kingdom": ["uk", "u.k.", "gb", "gbr", "great britain", "britain"],
+    "United States": ["us", "u.s.", "usa", "u.s.a.", "united states of america", "the states"],
+    "Australia": ["au", "aus", "oz"],
+    "Canada": [],
+    "New Zealand": ["nz", "nzl", "aotearoa"],
+    "Ireland": ["irl", "republic of ireland", "eire"],
+    "Germany": ["deu", "ger", "deutschland"],
+    "France": ["fra"],
+    "Netherlands": ["nl", "nld", "holland", "the netherlands"],
+    "Belgium": ["bel"],
+    "Switzerland": ["che", "swiss"],
+    "Austria": ["aut"],
+    "Sweden": ["swe"],
+    "Norway": [],
+    "Denmark": ["dk", "dnk"],
+    "Finland": [],
+    "Spain": ["esp", "espana"],
+    "Italy": ["ita", "italia"],
+    "Portugal": ["prt"],
+    "Poland": [],
+    "Czech Republic": ["cz", "cze", "czechia"],
+    "Hungary": ["hun"],
+    "Greece": ["grc"],
+    "Turkey": ["tur", "turkiye"],
+    "Russia": ["rus", "russian federation"],
+    "United Arab Emirates": ["uae", "u.a.e.", "emirates"],
+    "Saudi Arabia": ["ksa", "sau"],
+    "Qatar": ["qat"],
+    "Israel": ["isr"],
+    "Egypt": ["egy"],
+    "South Africa": ["rsa", "zaf"],
+    "Nigeria": ["nga"],
+    "Kenya": ["ken"],
+    "Ghana": ["gha"],
+    "India": ["ind", "bharat"],
+    "Pakistan": ["pk", "pak"],
+    "Bangladesh": ["bd", "bgd"],
+    "Sri Lanka": ["lka"],
+    "Nepal": ["npl"],
+    "China": ["prc", "chn", "mainland china"],
+    "Hong Kong": ["hk", "hkg"],
+    "Taiwan": ["twn"],
+    "Japan": ["jp", "jpn"],
+    "South Korea": ["kr", "kor", "republic of korea"],
+    "Singapore": ["sg", "sgp"],
+    "Malaysia": ["mys"],
+    "Indonesia": ["idn"],
+    "Thailand": ["tha"],
+    "Vietnam": ["vn", "vnm", "viet nam"],
+    "Philippines": ["phl"],
+    "Brazil": ["bra", "brasil"],
+    "Mexico": ["mx", "mex"],
+    "Argentina": ["arg"],
+    "Chile": ["chl"],
+    "Colombia": [],
+    # Regions
+    "Europe": ["eu", "european union"],
+    "Asia": [],
+    "Middle East": ["mena"],
+    "Scandinavia": ["nordics", "nordic countries"],
+    "North America": [],
+    "Latin America": ["latam"],
+    "South America": [],
+    "Africa": [],
+    "Oceania": ["australasia"],
+    # Cities with large university populations
+    "London": [],
+    "Manchester": [],
+    "Edinburgh": [],
+    "Birmingham": [],
+    "Glasgow": [],
+    "Oxford": [],
+    "Cambridge": [],
+    "New York": ["nyc", "new york city"],
+    "Boston": [],
+    "San Francisco": [],
+    "Los Angeles": [],
+    "Chicago": [],
+    "Toronto": [],
+    "Vancouver": [],
+    "Montreal": [],
+    "Sydney": [],
+    "Melbourne": [],
+    "Brisbane": [],
+    "Perth": [],
+    "Auckland": [],
+    "Dublin": [],
+    "Berlin": [],
+    "Munich": ["munchen"],
+    "Paris": [],
+    "Amsterdam": [],
+    "Zurich": [],
+    "Stockholm": [],
+    "Dubai": [],
+    "Tokyo": [],
+    "Seoul": [],
+    "Kuala Lumpur": ["kl"],
+}
+
+
+def _normalize_key(text):
+    # Lowercase, drop dots ("U.K." -> "uk") and collapse whitespace
+    text = str(text).lower().replace(".", "")
+    text = re.sub(r"[^\w\s-]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _build_index():
+    index = {}
+    for canonical, aliases in LOCATION_ALIASES.items():
+        for name in [canonical] + aliases:
+            index[_normalize_key(name)] = canonical
+    return index
+
+
+# Normalized alias -> canonical name, for O(1) lookups
+LOCATION_INDEX = _build_index()
+_FUZZY_CANDIDATES = [key for key in LOCATION_INDEX if len(key) >= 4]
+
+
+def resolve_location(text, fuzzy=True, cutoff=0.85):
+    """
+    Resolve a location name, abbreviation or misspelling to its canonical name.
+    Returns None when the text is not a known location.
+    """
+    key = _normalize_key(text)
+    if not key:
+        return None
+
+    canonical = LOCATION_INDEX.get(key)
+    if canonical is not None:
+        return canonical
+
+    # Fuzzy matching only for longer tokens; short ones are too ambiguous
+    if fuzzy and len(key) >= 4:
+        matches = difflib.get_close_matches(key, _FUZZY_CANDIDATES, n=1, cutoff=cutoff)
+        if matches:
+            return LOCATION_INDEX[matches[0]]
+    return None
+
+
+def find_location(text, max_words=3):
+    """
+    Return the canonical name of the first known location mentioned in free
+    text, preferring longer names ("New Zealand" over "Zealand"), or None.
+    Exact gazetteer matches only; short aliases such as "us" or "kl" only
+    count when written in capitals.
+    """
+    words = re.findall(r"[\w.'-]+", str(text))
+    for size in range(max_words, 0, -1):
+        for start in range(len(words) - size + 1):
+            phrase = words[start:start + size]
+            key = _normalize_key(" ".join(phrase))
+            canonical = LOCATION_INDEX.get(key)
+            if canonical is None:
+                continue
+            if size == 1 and len(key) <= 3 and not phrase[0].isupper():
+                continue
+            return canonical
+    return None
@@ -0,0 +1,144 @@
+import json
+
+from llm_cache import cached_completion, cached_completion_async
+from locations import resolve_location
+
+IMPORTANCE_FIELDS = [
+    "location_importance",
+    "university_importance",
+    "course_importance",
+    "ranking_importance",
+    "fee_importance",
+    "salary_importance",
+    "qualification_importance"
+]
+
+QUERY_UNDERSTANDING_PROMPT = """
+    You are a query analyzer for an educational program and scholarship search engine.
+    Split the user's query into its distinct searches (intents). A query such as
+    "MBA in Australia and computer science in the UK" has two intents.
+    For each intent output:
+    - keywords: list of the essential search keywords
+    - detected_location: the location of that intent as a full name (e.g. "UK" -> "United Kingdom"), or null if none
+    - location_importance, university_importance, course_importance, ranking_importance,
+      fee_importance, salary_importance, qualification_importance: importance of each aspect
+      for that intent, a number from 0 to 10 where 10 is highest priority
+    Respond with a JSON object only: {"intents": [{...}, ...]}
+    """
+
+_SCORE_SCHEMA = {"type": "number", "minimum": 0, "maximum": 10}
+
+QUERY_UNDERSTANDING_SCHEMA = {
+    "type": "object",
+    "required": ["intents"],
+    "properties": {
+        "intents": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["keywords", "detected_location"] + IMPORTANCE_FIELDS,
+                "properties": {
+                    "keywords": {"type": "array", "minItems": 1, "items": {"type": "string"}},
+                    "detected_location": {"type": ["string", "null"]},
+                    **{field: _SCORE_SCHEMA for field in IMPORTANCE_FIELDS}
+                }
+            }
+        }
+    }
+}
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "null": type(None)
+}
+
+
+def validate_schema(value, schema, path="$"):
+    """
+    Validate a value against the JSON schema subset used here; raises ValueError on mismatch
+    """
+    types = schema.get("type")
+    if types is not None:
+        types = types if isinstance(types, list) else [types]
+        # bool is an int subclass but never a valid score
+        if isinstance(value, bool) or not any(isinstance(value, _JSON_TYPES[t]) for t in types):
+            raise ValueError(f"{path}: expected {' or '.join(types)}, got {type(value).__name__}")
+
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                raise ValueError(f"{path}: missing required field '{key}'")
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in value:
+                validate_schema(value[key], sub_schema, f"{path}.{key}")
+
+    if isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            raise ValueError(f"{path}: expected at least {schema['minItems']} items")
+        if "items" in schema:
+            for i, item in enumerate(value):
+                validate_schema(item, schema["items"], f"{path}[{i}]")
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if "minimum" in schema and value < schema["minimum"]:
+            raise ValueError(f"{path}: {value} is below {schema['minimum']}")
+        if "maximum" in schema and value > schema["maximum"]:
+            raise ValueError(f"{path}: {value} is above {schema['maximum']}")
+
+
+def parse_understanding(response_text):
+    """
+    Validate the structured response and return one context analysis per intent.
+    Each analysis carries a "keywords" string plus the fields analyze_search_context uses.
+    """
+    data = json.loads(response_text)
+    validate_schema(data, QUERY_UNDERSTANDING_SCHEMA)
+
+    intents = []
+    for intent in data["intents"]:
+        keywords = [k.strip() for k in intent["keywords"] if k.strip()]
+        if not keywords:
+            raise ValueError("$.intents: intent without keywords")
+
+        detected_location = intent["detected_location"]
+        if detected_location:
+            detected_location = resolve_location(detected_location) or detected_location.strip()
+
+        analysis = {field: intent[field] for field in IMPORTANCE_FIELDS}
+        analysis["detected_location"] = detected_location or None
+        analysis["keywords"] = ', '.join(keywords)
+        intents.append(analysis)
+    return intents
+
+
+def _understanding_request(query):
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [
+            {"role": "system", "content": QUERY_UNDERSTANDING_PROMPT},
+            {"role": "user", "content": f"Analyze this search query: {query}"}
+        ],
+        "temperature": 0,
+        "response_format": {"type": "json_object"}
+    }
+
+
+def understand_query(query, client):
+    """
+    Split a query into intents with keywords, normalized locations and importance scores
+    using a single structured LLM call
+    """
+    return parse_understanding(cached_completion(client, stage="query_understanding", **_understanding_request(query)))
+
+
+async def understand_query_async(query, async_client):
+    """
+    Async understand_query for AsyncOpenAI clients
+    """
+    return parse_understanding(await cached_completion_async(
+        async_client, stage="query_understanding", **_understanding_request(query)
+    ))
@@ -0,0 +1,102 @@
+"""
+Process-wide request rate limits for the external services.
+
+Each service ("llm", "es") gets a token bucket configured by
+<NAME>_RATE_LIMIT in requests per second (unset or 0: unlimited) and
+<NAME>_RATE_BURST. Callers take a token before each request and wait when the
+bucket is empty, so bulk runs stay under the provider's rate limits.
+"""
+import asyncio
+import threading
+import time
+
+from settings import get_setting
+from telemetry import observe
+
+
+class RateLimiter:
+    """
+    Token bucket of rate requests per second with bursts of up to burst requests
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token and return the seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def try_reserve(self):
+        """
+        Take a token only if one is available now; returns whether it was taken
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+_limiters = {}  # name -> RateLimiter, or None when unlimited
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name):
+    """
+    Return the limiter of a service configured from settings, or None when unlimited
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            rate = get_setting(f"{name.upper()}_RATE_LIMIT", 0, float)
+            burst = get_setting(f"{name.upper()}_RATE_BURST", None, float)
+            _limiters[name] = RateLimiter(rate, burst) if rate > 0 else None
+        return _limiters[name]
+
+
+def rate_limit(name):
+    """
+    Block until a request to the service may be sent
+    """
+    limiter = get_rate_limiter(name)
+    if limiter is None:
+        return
+    wait = limiter.reserve()
+    observe("rate_limit_wait_seconds", wait, service=name)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def try_rate_limit(name):
+    """
+    Take a token for an optional request (e.g. a hedge) without waiting;
+    returns False when the request should not be sent
+    """
+    limiter = get_rate_limiter(name)
+    return limiter is None or limiter.try_reserve()
+
+
+async def rate_limit_async(name):
+    """
+    Async rate_limit; waits without blocking the event loop
+    """
+    limiter = get_rate_limiter(name)
+    if limiter is None:
+        return
+    wait = limiter.reserve()
+    observe("rate_limit_wait_seconds", wait, service=name)
+    if wait > 0:
+        await asyncio.sleep(wait)
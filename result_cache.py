@@ -0,0 +1,237 @@
+"""
+Semantic cache of fused search results.
+
+Results are keyed on the embedding of the whole query: a query reuses the
+results of a cached query of the same search type and exact-match key (the
+location the query names) when the cosine similarity of the two embeddings
+reaches the threshold, so rephrasings skip the LLM,
+encoding and kNN stages. Entries expire after a TTL, the least recently used
+entry is evicted when the cache is full, and every entry of an index is dropped
+when that index is rewritten (see es_clients.index_version).
+
+A sample of cache hits is re-checked against a live search in the background,
+which measures how often cached and live results disagree. The cache is off
+by default (RESULT_CACHE_MAX_ENTRIES=0) until that rate has been measured.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from settings import get_setting
+from telemetry import count
+
+
+class SemanticResultCache:
+    """
+    Bounded LRU of search results with TTL, looked up by embedding similarity.
+
+    The embeddings of all entries live in one matrix with a row per slot, so a
+    lookup is a single matrix-vector product; at cache sizes of a few thousand
+    entries that is faster than maintaining a graph index.
+    """
+
+    def __init__(self, max_entries=0, ttl_seconds=3600, threshold=0.95, verify_rate=0.05,
+                 version_check_seconds=60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.verify_rate = verify_rate
+        self.version_check_seconds = version_check_seconds
+        self._entries = OrderedDict()  # slot -> entry, least recently used first
+        self._vectors = None           # (max_entries, dimension) normalized embeddings
+        self._namespaces = np.empty(max_entries, dtype=object)
+        self._keys = np.empty(max_entries, dtype=object)
+        self._created = np.zeros(max_entries, dtype=np.float64)
+        self._max_results = np.zeros(max_entries, dtype=np.int64)
+        self._occupied = np.zeros(max_entries, dtype=bool)
+        self._versions = {}            # namespace -> (index version or None, checked at)
+        self._version_error_reported = False
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0,
+                         "checked": 0, "disagreements": 0, "overlap_sum": 0.0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def check_version(self, namespace, load_version):
+        """
+        Drop the entries of namespace when load_version() reports a different
+        index version than before; the index is asked at most every
+        version_check_seconds. When the version can't be read (e.g. an API key
+        without the monitor privilege) the failure is remembered for as long,
+        and entries live until their TTL.
+        """
+        now = time.time()
+        with self._lock:
+            known = self._versions.get(namespace)
+            if known is not None and now - known[1] < self.version_check_seconds:
+                return
+        try:
+            version = load_version()
+        except Exception as e:
+            count("result_cache_version_errors_total")
+            with self._lock:
+                known = self._versions.get(namespace)
+                self._versions[namespace] = (known[0] if known is not None else None, now)
+                reported, self._version_error_reported = self._version_error_reported, True
+            if not reported:
+                print(f"Could not read the index version for the result cache, entries expire by TTL only: {e}")
+            return
+        with self._lock:
+            known = self._versions.get(namespace)
+            self._versions[namespace] = (version, now)
+            if known is not None and known[0] is not None and known[0] != version:
+                self._invalidate(namespace)
+
+    def lookup(self, namespace, vector, max_results, key=""):
+        """
+        Return (entry, similarity) for the most similar live entry of namespace
+        stored for the same max_results and key, or None on a miss. Retrieval
+        depth follows max_results, so other sizes don't give the same ranking.
+        """
+        vector = _normalize(vector)
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._metrics["misses"] += 1
+                return None
+
+            expired = np.flatnonzero(self._occupied & (now - self._created > self.ttl_seconds))
+            for slot in expired:
+                self._remove(int(slot))
+                self._metrics["expired"] += 1
+
+            slots = np.flatnonzero(self._occupied & (self._namespaces == namespace) & (self._keys == key) &
+                                   (self._max_results == max_results))
+            if len(slots):
+                similarities = self._vectors[slots] @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    slot = int(slots[best])
+                    self._entries.move_to_end(slot)
+                    self._metrics["hits"] += 1
+                    return self._entries[slot], float(similarities[best])
+
+            self._metrics["misses"] += 1
+            return None
+
+    def store(self, namespace, vector, query, max_results, payload, key=""):
+        """
+        Cache the payload of a search run with max_results; only lookups with
+        the same key can return it
+        """
+        vector = _normalize(vector)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                self._clear()
+
+            free = np.flatnonzero(~self._occupied)
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = next(iter(self._entries))
+                self._remove(slot)
+                self._metrics["evictions"] += 1
+
+            self._vectors[slot] = vector
+            self._namespaces[slot] = namespace
+            self._keys[slot] = key
+            self._created[slot] = time.time()
+            self._max_results[slot] = max_results
+            self._occupied[slot] = True
+            self._entries[slot] = {"namespace": namespace, "query": query, "payload": payload}
+
+    def should_verify(self):
+        """
+        Return True for the sample of hits that get re-checked against a live search
+        """
+        return random.random() < self.verify_rate
+
+    def record_check(self, cached_ids, live_ids):
+        """
+        Record how a cached result list compares with the live one
+        """
+        overlap = len(set(cached_ids) & set(live_ids)) / max(len(cached_ids), len(live_ids), 1)
+        agree = list(cached_ids) == list(live_ids)
+        with self._lock:
+            self._metrics["checked"] += 1
+            self._metrics["overlap_sum"] += overlap
+            if not agree:
+                self._metrics["disagreements"] += 1
+        count("result_cache_checks_total", outcome="agree" if agree else "disagree")
+
+    def invalidate(self, namespace=None):
+        """
+        Drop the entries of one namespace, or every entry
+        """
+        with self._lock:
+            self._invalidate(namespace)
+
+    def stats(self):
+        """
+        Return hit rate, disagreement rate and current cache size
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+            entries = len(self._entries)
+        lookups = metrics["hits"] + metrics["misses"]
+        checked = metrics["checked"]
+        overlap_sum = metrics.pop("overlap_sum")
+        return {
+            **metrics,
+            "hit_rate": metrics["hits"] / lookups if lookups else 0.0,
+            "disagreement_rate": metrics["disagreements"] / checked if checked else 0.0,
+            "mean_overlap": overlap_sum / checked if checked else None,
+            "entries": entries,
+            "threshold": self.threshold
+        }
+
+    def _invalidate(self, namespace):
+        slots = [slot for slot, entry in self._entries.items() if namespace in (None, entry["namespace"])]
+        for slot in slots:
+            self._remove(slot)
+        self._metrics["invalidations"] += len(slots)
+
+    def _remove(self, slot):
+        del self._entries[slot]
+        self._occupied[slot] = False
+        self._namespaces[slot] = None
+        self._keys[slot] = None
+
+    def _clear(self):
+        self._entries.clear()
+        self._occupied[:] = False
+        self._namespaces[:] = None
+        self._keys[:] = None
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    Return the process-wide semantic result cache configured from settings
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticResultCache(
+                max_entries=get_setting("RESULT_CACHE_MAX_ENTRIES", 0, int),
+                ttl_seconds=get_setting("RESULT_CACHE_TTL_SECONDS", 3600, float),
+                threshold=get_setting("RESULT_CACHE_THRESHOLD", 0.95, float),
+                verify_rate=get_setting("RESULT_CACHE_VERIFY_RATE", 0.05, float),
+                version_check_seconds=get_setting("RESULT_CACHE_VERSION_CHECK_SECONDS", 60, float)
+            )
+        return _cache
@@ -0,0 +1,487 @@
+import asyncio
+import json
+import threading
+
+import numpy as np
+
+from es_clients import get_local_backend
+from fusion import top_k_indices
+from rate_limit import rate_limit, rate_limit_async
+from settings import get_setting
+from telemetry import observe, span
+
+# "msearch" sends every vector field in one _msearch round trip,
+# "per_field" sends one knn_search request per field, "two_stage" sends one
+# knn_search on the combined document vector and reranks its candidates per field
+SEARCH_MODES = ("msearch", "per_field", "two_stage")
+
+# Where two_stage scores the candidates per field: "es" runs an exact
+# script_score over the candidate ids in the search backend (one _msearch, no
+# vectors leave the cluster), "local" reads their vectors from the local export
+RERANK_MODES = ("es", "local")
+
+# Weighted sum of a document's field vectors, written at ingest (see ingest.py)
+COMBINED_VECTOR_FIELD = "combinedVector"
+
+# Largest num_candidates Elasticsearch accepts
+MAX_NUM_CANDIDATES = 10000
+
+# Adaptive num_candidates: multiplier for location-filtered queries, and for
+# re-querying a field that returned fewer hits than its k
+DEFAULT_ADAPTIVE = {"enabled": False, "filtered_factor": 2.0, "thin_factor": 4.0}
+
+_knn_config = None
+_knn_config_lock = threading.Lock()
+
+# "prefilter" restricts the kNN queries to the detected location inside Elasticsearch,
+# "postfilter" retrieves the global top-k and drops non-matching hits afterwards
+LOCATION_FILTER_MODES = ("prefilter", "postfilter")
+
+
+def search_mode():
+    """
+    Return the configured kNN request mode
+    """
+    mode = get_setting("SEARCH_MODE", "msearch")
+    if mode not in SEARCH_MODES:
+        print(f"Unknown SEARCH_MODE {mode!r}, using msearch")
+        mode = "msearch"
+    return mode
+
+
+def location_filter_mode():
+    """
+    Return the configured location filtering mode
+    """
+    mode = get_setting("LOCATION_FILTER_MODE", "prefilter")
+    if mode not in LOCATION_FILTER_MODES:
+        print(f"Unknown LOCATION_FILTER_MODE {mode!r}, using prefilter")
+        mode = "prefilter"
+    return mode
+
+
+def location_filter(location):
+    """
+    Build a kNN pre-filter that keeps documents whose location or city matches the location
+    """
+    fields = [field.strip() for field in get_setting("LOCATION_FILTER_FIELDS", "location,city").split(",")]
+    if get_setting("LOCATION_FILTER_QUERY", "match_phrase") == "term":
+        # Exact match, for keyword fields such as location.keyword
+        clauses = [{"term": {field: {"value": location, "case_insensitive": True}}} for field in fields]
+    else:
+        # Phrase match on analyzed text, like the substring check of the post-filter
+        clauses = [{"match_phrase": {field: location}} for field in fields]
+    return {"bool": {"should": clauses, "minimum_should_match": 1}}
+
+
+def knn_query(field, query_vector, k, num_candidates, filter=None):
+    """
+    Build the kNN clause for one vector field
+    """
+    query = {
+        "field": field,
+        "query_vector": query_vector,
+        "k": k,
+        "num_candidates": num_candidates
+    }
+    if filter is not None:
+        query["filter"] = filter
+    return query
+
+
+def knn_config():
+    """
+    Per-field kNN parameters from the KNN_CONFIG file written by
+    benchmarks/knn_tuning.py; {} when there is none
+    """
+    global _knn_config
+    with _knn_config_lock:
+        if _knn_config is None:
+            _knn_config = {}
+            path = get_setting("KNN_CONFIG")
+            if path:
+                try:
+                    with open(path, encoding="utf-8") as source:
+                        _knn_config = json.load(source)
+                except (OSError, ValueError) as e:
+                    print(f"Could not load KNN_CONFIG {path}: {e}")
+        return _knn_config
+
+
+def adaptive_settings():
+    """
+    Return the adaptive num_candidates factors, or None when adaptive mode is
+    off (KNN_ADAPTIVE overrides the tuned config)
+    """
+    adaptive = dict(DEFAULT_ADAPTIVE, **knn_config().get("adaptive", {}))
+    if not get_setting("KNN_ADAPTIVE", adaptive["enabled"], bool):
+        return None
+    return adaptive
+
+
+def field_knn_query(index_name, field, query_vector, k, num_candidates, filter=None, widen=1.0):
+    """
+    Build the kNN clause for one vector field with its tuned parameters:
+    k_scale scales the requested k and num_candidates replaces the default.
+    Adaptive mode raises num_candidates for location-filtered queries; widen
+    raises it further for a retry.
+    """
+    tuned = knn_config().get("indices", {}).get(index_name, {}).get(field)
+    if tuned:
+        k = max(1, round(k * tuned.get("k_scale", 1.0)))
+        num_candidates = tuned.get("num_candidates", num_candidates)
+    adaptive = adaptive_settings()
+    if adaptive and filter is not None:
+        num_candidates *= adaptive["filtered_factor"]
+    num_candidates = int(min(max(num_candidates * widen, k), MAX_NUM_CANDIDATES))
+    return knn_query(field, query_vector, k, num_candidates, filter)
+
+
+def thin_fields(field_hits, index_name, k, num_candidates, filter):
+    """
+    Fields that returned fewer hits than they asked for and can still ask for
+    more candidates; empty unless adaptive mode is on
+    """
+    adaptive = adaptive_settings()
+    if not adaptive:
+        return []
+    thin = []
+    for field, hits in field_hits.items():
+        if isinstance(hits, Exception):
+            continue
+        knn = field_knn_query(index_name, field, None, k, num_candidates, filter)
+        if len(hits) < knn["k"] and knn["num_candidates"] < MAX_NUM_CANDIDATES:
+            thin.append(field)
+    return thin
+
+
+def knn_field_hits(es, index_name, fields, query_vector, k, num_candidates, source, mode=None, filter=None,
+                   on_hits=None):
+    """
+    Run a kNN query for each vector field and return {field: hits}.
+    A field whose query failed maps to the exception instead of a hit list.
+    In adaptive mode, fields with thin results are re-queried once with more candidates.
+    on_hits, when given, is called with the hits received so far as they come
+    back (per field in "per_field" mode) and with the complete hits at the end.
+    """
+    mode = mode or search_mode()
+    if mode == "two_stage":
+        field_hits = _two_stage_hits(es, index_name, fields, query_vector, k, num_candidates, source, filter)
+    else:
+        field_hits = _field_hits(es, index_name, fields, query_vector, k, num_candidates, source, mode, filter,
+                                 on_hits=on_hits)
+        thin = thin_fields(field_hits, index_name, k, num_candidates, filter)
+        if thin:
+            retried = _field_hits(es, index_name, thin, query_vector, k, num_candidates, source, mode, filter,
+                                  adaptive_settings()["thin_factor"])
+            field_hits.update({field: hits for field, hits in retried.items() if not isinstance(hits, Exception)})
+    if on_hits is not None:
+        on_hits(field_hits)
+    return field_hits
+
+
+def _field_hits(es, index_name, fields, query_vector, k, num_candidates, source, mode, filter, widen=1.0,
+                on_hits=None):
+    if mode == "per_field":
+        return _per_field_hits(es, index_name, fields, query_vector, k, num_candidates, source, filter, widen,
+                               on_hits)
+    return _msearch_hits(es, index_name, fields, query_vector, k, num_candidates, source, filter, widen)
+
+
+def record_took(stage, res):
+    """
+    Attach the server-side time Elasticsearch reports ("took", in ms) to a span
+    """
+    took = res["took"] if "took" in res else None
+    if took is None and "responses" in res:
+        # msearch reports took per response
+        took = max((response["took"] for response in res["responses"] if "took" in response), default=None)
+    if took is not None:
+        stage.set(took_ms=took)
+        observe("es_took_seconds", took / 1000)
+
+
+def _per_field_hits(es, index_name, fields, query_vector, k, num_candidates, source, filter, widen=1.0,
+                    on_hits=None):
+    field_hits = {}
+    for field in fields:
+        knn = field_knn_query(index_name, field, query_vector, k, num_candidates, filter, widen)
+        try:
+            rate_limit("es")
+            with span("knn", index=index_name, field=field, k=knn["k"], num_candidates=knn["num_candidates"],
+                      filtered=filter is not None) as stage:
+                res = es.knn_search(index=index_name, knn=knn, source=source)
+                record_took(stage, res)
+            field_hits[field] = res["hits"]["hits"]
+        except Exception as e:
+            field_hits[field] = e
+        if on_hits is not None and len(field_hits) < len(fields):
+            on_hits(dict(field_hits))
+    return field_hits
+
+
+def _msearch_body(index_name, fields, query_vector, k, num_candidates, source, filter, widen=1.0):
+    # One header/body pair per field; each response keeps that field's own scores
+    searches = []
+    for field in fields:
+        knn = field_knn_query(index_name, field, query_vector, k, num_candidates, filter, widen)
+        searches.append({"index": index_name})
+        searches.append({
+            "knn": knn,
+            "size": knn["k"],
+            "_source": source
+        })
+    return searches
+
+
+def _msearch_field_hits(fields, res):
+    field_hits = {}
+    for field, response in zip(fields, res["responses"]):
+        if "error" in response:
+            error = response["error"]
+            reason = error.get("reason", error) if isinstance(error, dict) else error
+            field_hits[field] = RuntimeError(f"{reason}")
+        else:
+            field_hits[field] = response["hits"]["hits"]
+    return field_hits
+
+
+def _msearch_span_attributes(searches):
+    # k and num_candidates as sent, per field in query order, after knn_config() and widening
+    knns = [search["knn"] for search in searches[1::2]]
+    return {"k": [knn["k"] for knn in knns], "num_candidates": [knn["num_candidates"] for knn in knns]}
+
+
+def _msearch_hits(es, index_name, fields, query_vector, k, num_candidates, source, filter, widen=1.0):
+    try:
+        searches = _msearch_body(index_name, fields, query_vector, k, num_candidates, source, filter, widen)
+        rate_limit("es")
+        with span("knn", index=index_name, fields=len(fields), filtered=filter is not None, widened=widen != 1.0,
+                  **_msearch_span_attributes(searches)) as stage:
+            res = es.msearch(searches=searches)
+            record_took(stage, res)
+    except Exception as e:
+        return {field: e for field in fields}
+    return _msearch_field_hits(fields, res)
+
+
+def two_stage_candidates(k):
+    """
+    Candidates the first stage retrieves for a final per-field top-k
+    """
+    return k * get_setting("TWO_STAGE_CANDIDATE_FACTOR", 5, int)
+
+
+def rerank_vector_store():
+    """
+    Local export the rerank reads field vectors from (RERANK_VECTORS=local),
+    or None to rescore the candidates in the search backend
+    """
+    mode = get_setting("RERANK_VECTORS", "es")
+    if mode not in RERANK_MODES:
+        print(f"Unknown RERANK_VECTORS {mode!r}, using es")
+        mode = "es"
+    return get_local_backend() if mode == "local" else None
+
+
+def rescore_body(index_name, fields, query_vector, ids, k, source):
+    """
+    One _msearch header/body pair per field scoring the candidate ids by exact
+    cosine similarity, on the kNN _score scale ((1 + cos) / 2). Documents
+    without the field get no hit for it, as in the per-field kNN.
+    """
+    searches = []
+    for field in fields:
+        searches.append({"index": index_name})
+        searches.append({
+            "size": k,
+            "_source": source,
+            "query": {
+                "script_score": {
+                    "query": {"bool": {"filter": [{"ids": {"values": ids}}, {"exists": {"field": field}}]}},
+                    "script": {
+                        "source": f"(cosineSimilarity(params.query_vector, '{field}') + 1.0) / 2.0",
+                        "params": {"query_vector": list(query_vector)}
+                    }
+                }
+            }
+        })
+    return searches
+
+
+def rerank_field_hits(candidates, field_vectors, fields, query_vector, k):
+    """
+    Score candidate hits by exact cosine similarity against each field vector
+    and return {field: top-k hits} scored like Elasticsearch ((1 + cos) / 2).
+    field_vectors is {_id: {field: vector}}; a document without a field vector
+    gets no hit for that field, as in the per-field kNN.
+    """
+    query = np.asarray(query_vector, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    if norm:
+        query = query / norm
+
+    field_hits = {}
+    for field in fields:
+        hits, vectors = [], []
+        for hit in candidates:
+            vector = field_vectors.get(hit["_id"], {}).get(field)
+            if vector is not None:
+                hits.append(hit)
+                vectors.append(vector)
+        if not hits:
+            field_hits[field] = []
+            continue
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1.0
+        scores = (1.0 + (matrix @ query) / norms) / 2.0
+        field_hits[field] = [dict(hits[i], _score=float(scores[i])) for i in top_k_indices(scores, k)]
+    return field_hits
+
+
+def _combined_knn(query_vector, k, num_candidates, filter):
+    candidates = two_stage_candidates(k)
+    return knn_query(COMBINED_VECTOR_FIELD, query_vector, candidates, max(num_candidates, candidates), filter)
+
+
+def _two_stage_hits(es, index_name, fields, query_vector, k, num_candidates, source, filter):
+    knn = _combined_knn(query_vector, k, num_candidates, filter)
+    store = rerank_vector_store()
+    try:
+        rate_limit("es")
+        with span("knn", index=index_name, field=COMBINED_VECTOR_FIELD, k=knn["k"],
+                  filtered=filter is not None) as stage:
+            # Rescored hits bring their own _source, so the candidates only need ids
+            res = es.knn_search(index=index_name, knn=knn, source=source if store is not None else False)
+            record_took(stage, res)
+        candidates = res["hits"]["hits"]
+        ids = [hit["_id"] for hit in candidates]
+        if store is None:
+            if not candidates:
+                return {field: [] for field in fields}
+            rate_limit("es")
+            with span("rerank", index=index_name, candidates=len(candidates), fields=len(fields)) as stage:
+                res = es.msearch(searches=rescore_body(index_name, fields, query_vector, ids, k, source))
+                record_took(stage, res)
+            return _msearch_field_hits(fields, res)
+        field_vectors = fetch_sources(store, index_name, ids, fields)
+    except Exception as e:
+        return {field: e for field in fields}
+    with span("rerank", candidates=len(candidates), fields=len(fields)):
+        return rerank_field_hits(candidates, field_vectors, fields, query_vector, k)
+
+
+async def _two_stage_hits_async(es, index_name, fields, query_vector, k, num_candidates, source, semaphore, filter):
+    knn = _combined_knn(query_vector, k, num_candidates, filter)
+    store = rerank_vector_store()
+    try:
+        async with semaphore:
+            await rate_limit_async("es")
+            with span("knn", index=index_name, field=COMBINED_VECTOR_FIELD, k=knn["k"],
+                      filtered=filter is not None) as stage:
+                res = await es.knn_search(index=index_name, knn=knn, source=source if store is not None else False)
+                record_took(stage, res)
+        candidates = res["hits"]["hits"]
+        ids = [hit["_id"] for hit in candidates]
+        if store is None:
+            if not candidates:
+                return {field: [] for field in fields}
+            async with semaphore:
+                await rate_limit_async("es")
+                with span("rerank", index=index_name, candidates=len(candidates), fields=len(fields)) as stage:
+                    res = await es.msearch(searches=rescore_body(index_name, fields, query_vector, ids, k, source))
+                    record_took(stage, res)
+            return _msearch_field_hits(fields, res)
+        field_vectors = await asyncio.to_thread(fetch_sources, store, index_name, ids, fields)
+    except Exception as e:
+        return {field: e for field in fields}
+    with span("rerank", candidates=len(candidates), fields=len(fields)):
+        return rerank_field_hits(candidates, field_vectors, fields, query_vector, k)
+
+
+async def knn_field_hits_async(es, index_name, fields, query_vector, k, num_candidates, source,
+                               semaphore, mode=None, filter=None, on_hits=None):
+    """
+    Async knn_field_hits for AsyncElasticsearch. In "per_field" mode the field
+    queries run concurrently; the semaphore bounds in-flight requests.
+    """
+    mode = mode or search_mode()
+    if mode == "two_stage":
+        field_hits = await _two_stage_hits_async(es, index_name, fields, query_vector, k, num_candidates, source,
+                                                 semaphore, filter)
+    else:
+        field_hits = await _field_hits_async(es, index_name, fields, query_vector, k, num_candidates, source,
+                                             semaphore, mode, filter, on_hits=on_hits)
+        thin = thin_fields(field_hits, index_name, k, num_candidates, filter)
+        if thin:
+            retried = await _field_hits_async(es, index_name, thin, query_vector, k, num_candidates, source,
+                                              semaphore, mode, filter, adaptive_settings()["thin_factor"])
+            field_hits.update({field: hits for field, hits in retried.items() if not isinstance(hits, Exception)})
+    if on_hits is not None:
+        on_hits(field_hits)
+    return field_hits
+
+
+async def _field_hits_async(es, index_name, fields, query_vector, k, num_candidates, source, semaphore, mode,
+                            filter, widen=1.0, on_hits=None):
+    if mode == "per_field":
+        received = {}
+
+        async def field_query(field):
+            knn = field_knn_query(index_name, field, query_vector, k, num_candidates, filter, widen)
+            try:
+                async with semaphore:
+                    await rate_limit_async("es")
+                    with span("knn", index=index_name, field=field, k=knn["k"],
+                              num_candidates=knn["num_candidates"], filtered=filter is not None) as stage:
+                        res = await es.knn_search(index=index_name, knn=knn, source=source)
+                        record_took(stage, res)
+                hits = res["hits"]["hits"]
+            except Exception as e:
+                hits = e
+            received[field] = hits
+            if on_hits is not None and len(received) < len(fields):
+                on_hits(dict(received))
+            return hits
+
+        results = await asyncio.gather(*(field_query(field) for field in fields))
+        return dict(zip(fields, results))
+
+    try:
+        searches = _msearch_body(index_name, fields, query_vector, k, num_candidates, source, filter, widen)
+        async with semaphore:
+            await rate_limit_async("es")
+            with span("knn", index=index_name, fields=len(fields), filtered=filter is not None,
+                      widened=widen != 1.0, **_msearch_span_attributes(searches)) as stage:
+                res = await es.msearch(searches=searches)
+                record_took(stage, res)
+    except Exception as e:
+        return {field: e for field in fields}
+    return _msearch_field_hits(fields, res)
+
+
+def fetch_sources(es, index_name, ids, source):
+    """
+    Load the given source fields of documents in one mget round trip and
+    return {_id: _source}; missing documents are left out
+    """
+    if not ids:
+        return {}
+    rate_limit("es")
+    with span("mget", index=index_name, docs=len(ids)) as stage:
+        res = es.mget(index=index_name, ids=list(ids), source=source)
+        docs = _found_sources(res)
+        stage.set(found=len(docs))
+    return docs
+
+
+def _found_sources(res):
+    return {doc["_id"]: doc.get("_source", {}) for doc in res["docs"] if doc.get("found")}
+
+
+def has_hits(field_hits):
+    """
+    Return True if any field query returned at least one hit
+    """
+    return any(isinstance(hits, list) and hits for hits in field_hits.values())
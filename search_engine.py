@@ -0,0 +1,1297 @@
+"""
+The search engine behind the Streamlit UI and the HTTP search service.
+
+Nothing here touches Streamlit: warnings and errors are collected in a
+SearchReport and returned with the results, so any client can decide how to
+show them. search() runs a query in-process, search_async() is for callers
+that already run an event loop, and remote_search() calls a search service.
+search_stream() (and its async and remote variants) also yields provisional
+rankings while the search runs. Results carry summary fields only;
+fetch_details() loads the rest for the results being shown.
+"""
+import asyncio
+import functools
+import json
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextvars import ContextVar, copy_context
+
+from openai import AsyncOpenAI, OpenAI
+
+from budget import budget_expired, start_budget
+from context_scorer import context_analysis_mode, score_context
+from encoder import encode_queries, get_model
+from es_clients import get_async_es_client, get_es_client, index_version
+from event_loop import get_event_loop, run_coroutine
+from fusion import failed_fields, fuse_results
+from llm_cache import cached_completion, cached_completion_async
+from locations import find_location, resolve_location
+from query_understanding import IMPORTANCE_FIELDS, understand_query, understand_query_async
+from result_cache import get_result_cache
+from retrieval import (SEARCH_MODES, fetch_sources, has_hits, knn_field_hits, knn_field_hits_async, location_filter,
+                       location_filter_mode)
+from settings import get_setting
+from telemetry import count, observe, span
+
+ProgramindexName = "programs"
+ScholarshipIndexName = "scholar"
+
+SEARCH_TYPES = ("Programs", "Scholarships")
+
+CONTEXT_ANALYSIS_PROMPT = """
+    You are a search context analyzer for an educational program search engine.
+    Analyze the search query and identify the importance of different aspects (score 0-10, where 10 is highest priority).
+    Output a JSON object with these fields:
+    - location_importance: score for location relevance
+    - university_importance: score for university name relevance
+    - course_importance: score for course/program relevance
+    - ranking_importance: score for university ranking relevance
+    - fee_importance: score for course fee relevance
+    - salary_importance: score for salary/career relevance
+    - qualification_importance: score for degree qualification relevance
+    - detected_location: the location mentioned in the query or null if none
+    """
+
+LOCATION_NORMALIZATION_PROMPT = """
+    You are a helper that converts country abbreviations to their full names.
+    Only respond with the full country name.
+    If the input is already a full country name, return it as is.
+    If the input is not a recognized country or abbreviation, return it as is.
+    """
+
+KEYWORD_EXTRACTION_PROMPT = """
+    You are a helper that extracts relevant keywords from natural language queries about educational programs and scholarships.
+    If the query contains multiple distinct searches, separate them with '|||'.
+    For each search, provide essential keywords separated by commas.
+    Keep location abbreviations as is - they will be processed separately.
+    """
+
+PROGRAM_BASE_WEIGHTS = {
+    "courseDetailVector": 1.0,
+    "overviewVector": 0.9,
+    "entryRequirementsVector": 0.7,
+    "scholarshipsFundingVector": 0.6,
+    "courseTitleVector": 1.0,
+    "universityNameVector": 0.8,
+    "locationVector": 1.2
+}
+
+# Fields returned with every kNN hit: what a collapsed result shows, plus the
+# location fields fusion matches on. The rest is loaded for the page shown.
+PROGRAM_SUMMARY_FIELDS = ['universityName', 'courseTitle', 'location', 'city', 'worldRanking']
+
+PROGRAM_DETAIL_FIELDS = ['overview', 'courseDetail', 'qualification', 'duration', 'nextIntake',
+                         'averageStartingSalary', 'jobPlacementRatio', 'topHiringCompanies',
+                         'entryRequirements', 'entryScore', 'courseFee', 'howToApply']
+
+SCHOLARSHIP_BASE_WEIGHTS = {
+    "universityNameVector": 0.8,
+    "titleVector": 1.0,
+    "fundingDetailsVector": 0.9,
+    "qualificationVector": 0.7,
+    "locationVector": 0.6
+}
+
+SCHOLARSHIP_SUMMARY_FIELDS = ['title', 'universityName', 'location', 'city']
+
+SCHOLARSHIP_DETAIL_FIELDS = ['fundingDetails', 'qualification', 'studyMode', 'eligibleIntake', 'deadline']
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Called with (keywords_list, intent_results) as the hits of a streamed search
+# come back; see search_stream()
+_progress_listener = ContextVar("progress_listener", default=None)
+
+
+class SearchReport:
+    """
+    Warnings, errors, the detected location and the serving path of one search,
+    returned to the caller instead of being shown directly
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.detected_location = None
+        # "structured", "chained", "local" (LLM budget spent) or "cache"
+        self.path = None
+
+    def _add(self, level, code, message):
+        self.messages.append({"level": level, "code": code, "message": message})
+
+    def error(self, code, message):
+        self._add("error", code, message)
+
+    def warning(self, code, message):
+        self._add("warning", code, message)
+
+    def info(self, code, message):
+        self._add("info", code, message)
+
+
+def get_openai_client():
+    """
+    Process-wide OpenAI client
+    """
+    with _clients_lock:
+        if "openai" not in _clients:
+            _clients["openai"] = OpenAI(api_key=get_setting("OPENAI_API_KEY"))
+        return _clients["openai"]
+
+
+def get_async_openai_client():
+    """
+    Process-wide AsyncOpenAI client for the concurrent search engine
+    """
+    with _clients_lock:
+        if "async_openai" not in _clients:
+            _clients["async_openai"] = AsyncOpenAI(api_key=get_setting("OPENAI_API_KEY"))
+        return _clients["async_openai"]
+
+
+def parse_context_analysis(response_text):
+    """
+    Parse the JSON object returned by the context analysis prompt
+    """
+    try:
+        # Handle case where response might be already formatted as JSON
+        return json.loads(response_text)
+    except json.JSONDecodeError:
+        # If the response contains explanation text, try to extract JSON portion
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
+        if start_idx != -1 and end_idx != 0:
+            json_str = response_text[start_idx:end_idx]
+            return json.loads(json_str)
+        else:
+            raise ValueError("Could not extract JSON from response")
+
+
+def local_context_analysis(keywords):
+    """
+    Context analysis without the LLM: base field weights and the location the
+    gazetteer finds in the keywords
+    """
+    analysis = {field: 0 for field in IMPORTANCE_FIELDS}
+    analysis["detected_location"] = find_location(keywords)
+    analysis["keywords"] = keywords
+    return analysis
+
+
+def apply_context_analysis(context_analysis, field_weights):
+    """
+    Scale field weights by the importance scores of a context analysis
+    """
+    # Map importance scores to field weight adjustments
+    field_importance_mapping = {
+        "location": {
+            "fields": ["location", "locationVector", "city"],
+            "score": context_analysis["location_importance"]
+        },
+        "university": {
+            "fields": ["universityName", "universityNameVector"],
+            "score": context_analysis["university_importance"]
+        },
+        "course": {
+            "fields": ["courseTitle", "courseTitleVector", "courseDetail", "courseDetailVector"],
+            "score": context_analysis["course_importance"]
+        },
+        "ranking": {
+            "fields": ["worldRanking"],
+            "score": context_analysis["ranking_importance"]
+        },
+        "fee": {
+            "fields": ["courseFee"],
+            "score": context_analysis["fee_importance"]
+        },
+        "salary": {
+            "fields": ["averageStartingSalary"],
+            "score": context_analysis["salary_importance"]
+        },
+        "qualification": {
+            "fields": ["qualification", "qualificationVector"],
+            "score": context_analysis["qualification_importance"]
+        }
+    }
+
+    # Adjust weights based on importance scores
+    adjusted_weights = field_weights.copy()
+    for importance_info in field_importance_mapping.values():
+        boost_factor = 1 + (importance_info["score"] / 10)  # Convert 0-10 score to multiplier
+        for field in importance_info["fields"]:
+            if field in adjusted_weights:
+                adjusted_weights[field] *= boost_factor
+
+    return adjusted_weights, context_analysis.get("detected_location")
+
+
+def analyze_search_context(keywords, field_weights, client, context_analysis=None, report=None):
+    """
+    Use OpenAI to analyze search context and adjust field weights intelligently.
+    A precomputed context_analysis (e.g. from understand_query) skips the OpenAI call.
+    """
+    report = report or SearchReport()
+    try:
+        with span("analyze_search_context", precomputed=context_analysis is not None):
+            if context_analysis is None:
+                response_text = cached_completion(
+                    client,
+                    model="gpt-3.5-turbo",
+                    messages=[
+                        {"role": "system", "content": CONTEXT_ANALYSIS_PROMPT},
+                        {"role": "user", "content": f"Analyze this search query: {keywords}"}
+                    ],
+                    stage="context_analysis",
+                    temperature=0
+                )
+
+                # Extract and parse the JSON from the response
+                context_analysis = parse_context_analysis(response_text)
+
+            adjusted_weights, detected_location = apply_context_analysis(context_analysis, field_weights)
+
+        if detected_location:
+            report.detected_location = detected_location
+
+        return adjusted_weights, detected_location
+
+    except TimeoutError as e:
+        report.path = "local"
+        report.warning("budget_exceeded", f"Context analysis skipped, using base field weights: {e}")
+        adjusted_weights, detected_location = apply_context_analysis(local_context_analysis(keywords), field_weights)
+        if detected_location:
+            report.detected_location = detected_location
+        return adjusted_weights, detected_location
+
+    except Exception as e:
+        report.error("context_analysis_failed", f"Error in context analysis: {e}")
+        return field_weights, None
+
+
+def normalize_location(location, client):
+    """
+    Normalize location abbreviations to full country names, using OpenAI only
+    for locations the local gazetteer can't resolve
+    """
+    with span("normalize_location", location=location) as stage:
+        resolved_location = resolve_location(location)
+        stage.set(source="gazetteer" if resolved_location else "llm")
+        if resolved_location:
+            return resolved_location
+
+        user_prompt = f"Convert this location if it's an abbreviation: {location}"
+
+        try:
+            response_text = cached_completion(
+                client,
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": LOCATION_NORMALIZATION_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ],
+                stage="normalize_location",
+                temperature=0,
+                max_tokens=50
+            )
+            return response_text.strip()
+        except Exception as e:
+            print(f"Error normalizing location: {e}")
+            return location
+
+
+def extract_multiple_keywords(query, client=None, report=None):
+    """
+    Extract relevant keywords for multiple search queries using OpenAI
+    """
+    client = client or get_openai_client()
+    report = report or SearchReport()
+    user_prompt = f"Extract search keywords for each distinct search from this query: {query}"
+
+    try:
+        response_text = cached_completion(
+            client,
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": KEYWORD_EXTRACTION_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            stage="keyword_extraction",
+            temperature=0.3,
+            max_tokens=200
+        )
+
+        keywords_sets = response_text.strip().split('|||')
+        normalized_keywords_sets = []
+
+        for keyword_set in keywords_sets:
+            keywords = [k.strip() for k in keyword_set.split(',')]
+            normalized_keywords = []
+
+            for keyword in keywords:
+                # Check if keyword might be a location (simple heuristic)
+                if len(keyword) <= 3 or keyword.upper() == keyword:
+                    normalized_location = normalize_location(keyword, client)
+                    normalized_keywords.append(normalized_location)
+                else:
+                    normalized_keywords.append(keyword)
+
+            normalized_keywords_sets.append(', '.join(normalized_keywords))
+
+        return normalized_keywords_sets
+
+    except TimeoutError as e:
+        report.warning("budget_exceeded", f"Keyword extraction skipped, searching the query as typed: {e}")
+        return [query]
+
+    except Exception as e:
+        report.error("keyword_extraction_failed", f"Error in keyword extraction: {e}")
+        return [query]
+
+
+def local_understanding(query, report, reason):
+    """
+    Understanding without the LLM, for when its calls time out or the latency
+    budget is spent: the query as typed with base weights
+    """
+    report.path = "local"
+    report.warning("budget_exceeded", f"Query analysis skipped, searching the query as typed: {reason}")
+    return [query], [local_context_analysis(query)]
+
+
+def chained_understanding(keywords_list, report):
+    """
+    Result of the step-by-step path; the context analyses are left to the
+    searches unless the budget is already spent
+    """
+    if budget_expired():
+        report.path = "local"
+        return keywords_list, [local_context_analysis(keywords) for keywords in keywords_list]
+    report.path = "chained"
+    return keywords_list, None
+
+
+def understand_search_query(query, client=None, report=None):
+    """
+    Get keyword sets and their context analyses from one structured OpenAI call,
+    falling back to the step-by-step keyword extraction and context analysis,
+    or to the local path when the LLM is too slow for the latency budget
+    """
+    client = client or get_openai_client()
+    report = report or SearchReport()
+    mode = get_setting("QUERY_UNDERSTANDING", "structured")
+    with span("query_understanding", mode=mode) as stage:
+        if mode == "structured":
+            try:
+                context_analyses = understand_query(query, client)
+                stage.set(intents=len(context_analyses), path="structured")
+                report.path = "structured"
+                return [analysis["keywords"] for analysis in context_analyses], context_analyses
+            except TimeoutError as e:
+                stage.set(fallback=str(e), path="local")
+                return local_understanding(query, report, e)
+            except Exception as e:
+                stage.set(fallback=str(e))
+                report.warning("understanding_fallback",
+                               f"Structured query analysis failed, analyzing step by step: {e}")
+
+        keywords_list, context_analyses = chained_understanding(extract_multiple_keywords(query, client, report),
+                                                                report)
+        stage.set(intents=len(keywords_list), path=report.path)
+        return keywords_list, context_analyses
+
+
+async def understand_search_query_async(query, async_client, report):
+    """
+    Async understand_search_query; the step-by-step fallback runs in a worker thread
+    """
+    mode = get_setting("QUERY_UNDERSTANDING", "structured")
+    with span("query_understanding", mode=mode) as stage:
+        if mode == "structured":
+            try:
+                context_analyses = await understand_query_async(query, async_client)
+                stage.set(intents=len(context_analyses), path="structured")
+                report.path = "structured"
+                return [analysis["keywords"] for analysis in context_analyses], context_analyses
+            except TimeoutError as e:
+                stage.set(fallback=str(e), path="local")
+                return local_understanding(query, report, e)
+            except Exception as e:
+                stage.set(fallback=str(e))
+                report.warning("understanding_fallback",
+                               f"Structured query analysis failed, analyzing step by step: {e}")
+
+        keywords_list, context_analyses = chained_understanding(
+            await asyncio.to_thread(extract_multiple_keywords, query, get_openai_client(), report), report
+        )
+        stage.set(intents=len(keywords_list), path=report.path)
+        return keywords_list, context_analyses
+
+
+def knn_location_filter(detected_location):
+    """
+    kNN pre-filter for the detected location, or None when there is no location
+    or location filtering happens after retrieval (LOCATION_FILTER_MODE=postfilter)
+    """
+    if detected_location and location_filter_mode() == "prefilter":
+        return location_filter(detected_location)
+    return None
+
+
+def streamed_search_mode():
+    """
+    kNN request mode of a streamed search when STREAM_SEARCH_MODE is set (e.g.
+    per_field, so the ranking refines field by field), or None for SEARCH_MODE
+    """
+    if _progress_listener.get() is None:
+        return None
+    mode = get_setting("STREAM_SEARCH_MODE")
+    if mode is not None and mode not in SEARCH_MODES:
+        print(f"Unknown STREAM_SEARCH_MODE {mode!r}, using SEARCH_MODE")
+        mode = None
+    return mode
+
+
+def progress_callback(keywords_list, partial, position, adjusted_weights, detected_location):
+    """
+    on_hits callback of the intent at position: stores its hits so far in
+    partial and passes every intent received so far to the listener of a
+    streamed search. None when the search isn't streamed.
+    """
+    listener = _progress_listener.get()
+    if listener is None:
+        return None
+
+    def on_hits(field_hits):
+        partial[position] = (adjusted_weights, detected_location, field_hits)
+        listener(keywords_list, [intent_result for intent_result in partial if intent_result is not None])
+    return on_hits
+
+
+def report_failed_fields(intent_results, report):
+    """
+    Warn about field queries that failed; the remaining fields are still used
+    """
+    for field, error in failed_fields(intent_results):
+        report.warning("field_search_failed", f"Warning: Search failed for field {field}: {str(error)}")
+
+
+def fuse_program_results(intent_results, max_results=10, report=None):
+    """
+    Fuse per-field scores across intents, keeping only location matches
+    """
+    report = report or SearchReport()
+    report_failed_fields(intent_results, report)
+    with span("fusion", intents=len(intent_results), location_mode="filter"):
+        results, missing_location = fuse_results(intent_results, max_results, location_mode="filter")
+    if missing_location:
+        report.warning("location_not_found", f"⚠️ No programs found in {missing_location}.")
+    return results
+
+
+def fuse_scholarship_results(intent_results, max_results=10, report=None):
+    """
+    Fuse per-field scores across intents, boosting location matches
+    """
+    report = report or SearchReport()
+    report_failed_fields(intent_results, report)
+    with span("fusion", intents=len(intent_results), location_mode="boost"):
+        results, missing_location = fuse_results(intent_results, max_results, location_mode="boost")
+    if missing_location:
+        report.warning("location_not_found",
+                       f"⚠️ No scholarships found in {missing_location}. Showing results from other locations.")
+    return results
+
+
+def search_programs(input_keywords_list, model, client, max_results=10, context_analyses=None, report=None):
+    """
+    Enhanced semantic search for programs with location-specific filtering.
+    context_analyses optionally holds one precomputed analysis per keyword set.
+    """
+    report = report or SearchReport()
+    base_weights = PROGRAM_BASE_WEIGHTS
+    vector_fields = list(base_weights.keys())
+
+    try:
+        # Long-lived pooled client, shared across searches and sessions
+        client1 = get_es_client(ProgramindexName)
+    except Exception as e:
+        report.error("connection_failed", f"Error connecting to Elasticsearch: {e}")
+        return []
+
+    # Encode every keyword set in one batch (cached vectors are reused)
+    query_vectors = encode_queries(model, input_keywords_list)
+
+    intent_results = []
+    partial = [None] * len(input_keywords_list)
+    for i, keywords in enumerate(input_keywords_list):
+        context_analysis = context_analyses[i] if context_analyses else None
+        if context_analysis is None and context_analysis_mode() == "embedding":
+            # Importance scores from the query vector instead of an OpenAI call
+            context_analysis = score_context(keywords, query_vectors[i], model)
+
+        # Get context-adjusted weights and detected location
+        adjusted_weights, detected_location = analyze_search_context(
+            keywords, base_weights, client, context_analysis, report
+        )
+        vector_of_input_keyword = query_vectors[i]
+
+        # If location is detected, normalize it (structured analyses are already normalized)
+        if detected_location and context_analysis is None:
+            detected_location = normalize_location(detected_location, client)
+
+        # All vector fields in a single round trip (see retrieval.search_mode)
+        field_hits = knn_field_hits(
+            client1,
+            ProgramindexName,
+            vector_fields,
+            vector_of_input_keyword,
+            k=max_results * 2,
+            num_candidates=1000,
+            source=PROGRAM_SUMMARY_FIELDS,
+            mode=streamed_search_mode(),
+            filter=knn_location_filter(detected_location),
+            on_hits=progress_callback(input_keywords_list, partial, i, adjusted_weights, detected_location)
+        )
+        intent_results.append((adjusted_weights, detected_location, field_hits))
+
+    return fuse_program_results(intent_results, max_results, report)
+
+
+def search_scholarships(input_keywords_list, model, client, max_results=10, context_analyses=None, report=None):
+    """
+    Enhanced semantic search for scholarships with OpenAI context analysis.
+    context_analyses optionally holds one precomputed analysis per keyword set.
+    """
+    report = report or SearchReport()
+    base_weights = SCHOLARSHIP_BASE_WEIGHTS
+    vector_fields = list(base_weights.keys())
+
+    try:
+        # Long-lived pooled client for scholarships
+        client2 = get_es_client(ScholarshipIndexName)
+    except Exception as e:
+        report.error("connection_failed", f"Error connecting to Elasticsearch: {e}")
+        return []
+
+    query_vectors = encode_queries(model, input_keywords_list)
+
+    intent_results = []
+    partial = [None] * len(input_keywords_list)
+    for i, keywords in enumerate(input_keywords_list):
+        context_analysis = context_analyses[i] if context_analyses else None
+        if context_analysis is None and context_analysis_mode() == "embedding":
+            context_analysis = score_context(keywords, query_vectors[i], model)
+        adjusted_weights, detected_location = analyze_search_context(
+            keywords, base_weights, client, context_analysis, report
+        )
+        vector_of_input_keyword = query_vectors[i]
+
+        # Normalize like the program search so both pre-filter on the same location names
+        if detected_location and context_analysis is None:
+            detected_location = normalize_location(detected_location, client)
+
+        knn_filter = knn_location_filter(detected_location)
+        on_hits = progress_callback(input_keywords_list, partial, i, adjusted_weights, detected_location)
+        field_hits = knn_field_hits(
+            client2,
+            ScholarshipIndexName,
+            vector_fields,
+            vector_of_input_keyword,
+            k=max_results * 2,
+            num_candidates=1000,
+            source=SCHOLARSHIP_SUMMARY_FIELDS,
+            mode=streamed_search_mode(),
+            filter=knn_filter,
+            on_hits=on_hits
+        )
+        if knn_filter and not has_hits(field_hits):
+            # Nothing in that location: show results from other locations instead
+            field_hits = knn_field_hits(
+                client2,
+                ScholarshipIndexName,
+                vector_fields,
+                vector_of_input_keyword,
+                k=max_results * 2,
+                num_candidates=1000,
+                source=SCHOLARSHIP_SUMMARY_FIELDS,
+                mode=streamed_search_mode(),
+                on_hits=on_hits
+            )
+        intent_results.append((adjusted_weights, detected_location, field_hits))
+
+    return fuse_scholarship_results(intent_results, max_results, report)
+
+
+async def analyze_search_context_async(keywords, field_weights, async_client, semaphore, context_analysis=None):
+    """
+    Async analyze_search_context; returns (adjusted_weights, detected_location, message)
+    where message is None or the (level, code, text) to report
+    """
+    try:
+        with span("analyze_search_context", precomputed=context_analysis is not None):
+            if context_analysis is None:
+                async with semaphore:
+                    response_text = await cached_completion_async(
+                        async_client,
+                        model="gpt-3.5-turbo",
+                        messages=[
+                            {"role": "system", "content": CONTEXT_ANALYSIS_PROMPT},
+                            {"role": "user", "content": f"Analyze this search query: {keywords}"}
+                        ],
+                        stage="context_analysis",
+                        temperature=0
+                    )
+                context_analysis = parse_context_analysis(response_text)
+            adjusted_weights, detected_location = apply_context_analysis(context_analysis, field_weights)
+        return adjusted_weights, detected_location, None
+    except TimeoutError as e:
+        adjusted_weights, detected_location = apply_context_analysis(local_context_analysis(keywords), field_weights)
+        return adjusted_weights, detected_location, (
+            "warning", "budget_exceeded", f"Context analysis skipped, using base field weights: {e}"
+        )
+    except Exception as e:
+        return field_weights, None, ("error", "context_analysis_failed", f"Error in context analysis: {e}")
+
+
+async def normalize_location_async(location, async_client, semaphore):
+    """
+    Async normalize_location
+    """
+    with span("normalize_location", location=location) as stage:
+        resolved_location = resolve_location(location)
+        stage.set(source="gazetteer" if resolved_location else "llm")
+        if resolved_location:
+            return resolved_location
+
+        try:
+            async with semaphore:
+                response_text = await cached_completion_async(
+                    async_client,
+                    model="gpt-3.5-turbo",
+                    messages=[
+                        {"role": "system", "content": LOCATION_NORMALIZATION_PROMPT},
+                        {"role": "user", "content": f"Convert this location if it's an abbreviation: {location}"}
+                    ],
+                    stage="normalize_location",
+                    temperature=0,
+                    max_tokens=50
+                )
+            return response_text.strip()
+        except Exception as e:
+            print(f"Error normalizing location: {e}")
+            return location
+
+
+async def search_intent_async(keywords, query_vectors, position, async_client, es, index_name, base_weights,
+                              source_fields, max_results, location_fallback, semaphore, context_analysis=None,
+                              model=None, progress=None):
+    """
+    Analyze one keyword set and run its field queries; query_vectors is the
+    batched encoding task shared by all keyword sets of the search.
+    progress(adjusted_weights, detected_location) returns the on_hits callback
+    of a streamed search.
+    """
+    with span("intent", position=position, keywords=keywords):
+        if context_analysis is None and model is not None and context_analysis_mode() == "embedding":
+            # Scored from the query vector, so the analysis waits for the encoding
+            vectors = await query_vectors
+            context_analysis = await asyncio.to_thread(score_context, keywords, vectors[position], model)
+        # Context analysis and encoding don't depend on each other
+        (adjusted_weights, detected_location, message), vectors = await asyncio.gather(
+            analyze_search_context_async(keywords, base_weights, async_client, semaphore, context_analysis),
+            query_vectors
+        )
+        vector_of_input_keyword = vectors[position]
+
+        if detected_location and context_analysis is None:
+            detected_location = await normalize_location_async(detected_location, async_client, semaphore)
+
+        knn_filter = knn_location_filter(detected_location)
+        on_hits = progress(adjusted_weights, detected_location) if progress else None
+        field_hits = await knn_field_hits_async(
+            es,
+            index_name,
+            list(base_weights.keys()),
+            vector_of_input_keyword,
+            k=max_results * 2,
+            num_candidates=1000,
+            source=source_fields,
+            semaphore=semaphore,
+            mode=streamed_search_mode(),
+            filter=knn_filter,
+            on_hits=on_hits
+        )
+        if knn_filter and location_fallback and not has_hits(field_hits):
+            # Nothing in that location: fall back to results from other locations
+            field_hits = await knn_field_hits_async(
+                es,
+                index_name,
+                list(base_weights.keys()),
+                vector_of_input_keyword,
+                k=max_results * 2,
+                num_candidates=1000,
+                source=source_fields,
+                semaphore=semaphore,
+                mode=streamed_search_mode(),
+                on_hits=on_hits
+            )
+        return (adjusted_weights, detected_location, field_hits), message
+
+
+async def run_concurrent_search(input_keywords_list, model, index_name, base_weights, source_fields,
+                                max_results, location_fallback, report, context_analyses=None):
+    """
+    Run every keyword set concurrently and collect the intent results
+    """
+    es = get_async_es_client(index_name)
+    async_client = get_async_openai_client()
+
+    # Bounds the number of in-flight LLM and Elasticsearch requests for this search
+    semaphore = asyncio.Semaphore(get_setting("SEARCH_CONCURRENCY", 8, int))
+    # One batched encode for all keyword sets, overlapping with the context analyses
+    query_vectors = asyncio.ensure_future(asyncio.to_thread(encode_queries, model, input_keywords_list))
+    partial = [None] * len(input_keywords_list)
+    outcomes = await asyncio.gather(*[
+        search_intent_async(keywords, query_vectors, i, async_client, es, index_name, base_weights,
+                            source_fields, max_results, location_fallback, semaphore,
+                            context_analyses[i] if context_analyses else None, model,
+                            functools.partial(progress_callback, input_keywords_list, partial, i))
+        for i, keywords in enumerate(input_keywords_list)
+    ])
+
+    intent_results = []
+    for intent_result, message in outcomes:
+        if message:
+            report._add(*message)
+            if message[1] == "budget_exceeded":
+                report.path = "local"
+        if intent_result[1]:
+            report.detected_location = intent_result[1]
+        intent_results.append(intent_result)
+    return intent_results
+
+
+async def search_programs_async(input_keywords_list, model, max_results=10, context_analyses=None, report=None):
+    """
+    Program search that runs all intents and field queries concurrently
+    """
+    report = report or SearchReport()
+    try:
+        intent_results = await run_concurrent_search(
+            input_keywords_list, model, ProgramindexName, PROGRAM_BASE_WEIGHTS, PROGRAM_SUMMARY_FIELDS,
+            max_results, location_fallback=False, report=report, context_analyses=context_analyses
+        )
+    except Exception as e:
+        report.error("connection_failed", f"Error connecting to Elasticsearch: {e}")
+        return []
+    return fuse_program_results(intent_results, max_results, report)
+
+
+async def search_scholarships_async(input_keywords_list, model, max_results=10, context_analyses=None, report=None):
+    """
+    Scholarship search that runs all intents and field queries concurrently
+    """
+    report = report or SearchReport()
+    try:
+        intent_results = await run_concurrent_search(
+            input_keywords_list, model, ScholarshipIndexName, SCHOLARSHIP_BASE_WEIGHTS, SCHOLARSHIP_SUMMARY_FIELDS,
+            max_results, location_fallback=True, report=report, context_analyses=context_analyses
+        )
+    except Exception as e:
+        report.error("connection_failed", f"Error connecting to Elasticsearch: {e}")
+        return []
+    return fuse_scholarship_results(intent_results, max_results, report)
+
+
+def search_response(query, search_type, keywords_list, results, report, start):
+    """
+    The JSON-serializable result of a search
+    """
+    return {
+        "query": query,
+        "type": search_type,
+        "keywords": keywords_list,
+        "detected_location": report.detected_location,
+        "results": results,
+        "messages": report.messages,
+        "path": report.path,
+        "took_ms": round((time.perf_counter() - start) * 1000, 1)
+    }
+
+
+def cacheable(messages):
+    """
+    Only complete searches are cached: no errors, no failed field queries and
+    no LLM stages skipped for the latency budget
+    """
+    return not any(message["level"] == "error" or message["code"] in ("field_search_failed", "budget_exceeded")
+                   for message in messages)
+
+
+def lookup_cached_search(cache, query, query_vector, search_type, max_results):
+    """
+    Return the search response of a cached similar query, or None
+    """
+    index_name = ProgramindexName if search_type == "Programs" else ScholarshipIndexName
+    with span("result_cache", threshold=cache.threshold) as stage:
+        # Drops the cached results of an index that was rewritten since they were stored
+        cache.check_version(search_type, lambda: index_version(index_name))
+        found = cache.lookup(search_type, query_vector, max_results, result_cache_key(query))
+        stage.set(cache_hit=found is not None)
+        if found is not None:
+            stage.set(similarity=round(found[1], 4))
+    count("cache_requests_total", cache="result", result="hit" if found is not None else "miss")
+    if found is None:
+        return None
+
+    entry, similarity = found
+    payload = entry["payload"]
+    report = SearchReport()
+    report.messages = list(payload["messages"])
+    report.detected_location = payload["detected_location"]
+    report.path = "cache"
+    response = search_response(query, search_type, payload["keywords"], payload["results"], report, time.perf_counter())
+    response["cached_from"] = {"query": entry["query"], "similarity": round(similarity, 4)}
+    return response
+
+
+def result_cache_key(query):
+    """
+    Exact-match part of a result cache key: the location the query names
+    (gazetteer, no LLM call). Queries that differ only in the location embed
+    almost identically, and must not get each other's filtered results.
+    """
+    return find_location(query) or ""
+
+
+def store_cached_search(cache, query_vector, response, max_results):
+    """
+    Cache what a search answered, for similar queries of the same search type
+    and location
+    """
+    cache.store(response["type"], query_vector, response["query"], max_results, {
+        "keywords": response["keywords"],
+        "detected_location": response["detected_location"],
+        "results": response["results"],
+        "messages": response["messages"]
+    }, key=result_cache_key(response["query"]))
+
+
+def check_cached_search(cache, cached_response, live_response):
+    """
+    Compare a cached answer with a live search of the same query
+    """
+    if not cacheable(live_response["messages"]):
+        return
+    cache.record_check([hit["_id"] for hit in cached_response["results"]],
+                       [hit["_id"] for hit in live_response["results"]])
+
+
+async def run_search_async(query, search_type, max_results, model, report):
+    """
+    Query understanding, retrieval and fusion with the concurrent engine;
+    returns (keywords_list, results)
+    """
+    # The LLM stages of the search share one latency budget (see budget.py)
+    with start_budget():
+        keywords_list, context_analyses = await understand_search_query_async(
+            query, get_async_openai_client(), report
+        )
+        search = search_programs_async if search_type == "Programs" else search_scholarships_async
+        return keywords_list, await search(keywords_list, model, max_results, context_analyses, report)
+
+
+async def verify_cached_search_async(cache, cached_response, max_results, model):
+    """
+    Re-run a query answered from the cache and record whether the answers agree
+    """
+    # The task copied the context of the search that hit the cache: a streamed
+    # search's listener must not get the rankings of this background search
+    _progress_listener.set(None)
+    report = SearchReport()
+    try:
+        keywords_list, results = await run_search_async(cached_response["query"], cached_response["type"],
+                                                        max_results, model, report)
+    except Exception as e:
+        print(f"Result cache check failed: {e}")
+        return
+    live_response = search_response(cached_response["query"], cached_response["type"], keywords_list, results,
+                                    report, time.perf_counter())
+    check_cached_search(cache, cached_response, live_response)
+
+
+# Background cache checks; referenced until done so they aren't garbage collected
+_verifications = set()
+
+
+async def search_async(query, search_type="Programs", max_results=10, model=None):
+    """
+    Run a search with the concurrent engine; never raises, failures are
+    returned as error messages
+    """
+    start = time.perf_counter()
+    report = SearchReport()
+    keywords_list, results = [], []
+    cache = get_result_cache()
+    query_vector = None
+    try:
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f"Unknown search type {search_type!r}, expected one of {', '.join(SEARCH_TYPES)}")
+        model = model or await asyncio.to_thread(get_model)
+        if cache.enabled:
+            query_vector = (await asyncio.to_thread(encode_queries, model, [query]))[0]
+            cached = lookup_cached_search(cache, query, query_vector, search_type, max_results)
+            if cached is not None:
+                if cache.should_verify():
+                    task = asyncio.ensure_future(verify_cached_search_async(cache, cached, max_results, model))
+                    _verifications.add(task)
+                    task.add_done_callback(_verifications.discard)
+                cached["took_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                return cached
+        keywords_list, results = await run_search_async(query, search_type, max_results, model, report)
+    except Exception as e:
+        report.error("search_failed", f"An error occurred during search: {str(e)}")
+    response = search_response(query, search_type, keywords_list, results, report, start)
+    if query_vector is not None and cacheable(report.messages):
+        store_cached_search(cache, query_vector, response, max_results)
+    return response
+
+
+def run_search(query, search_type, max_results, model, report):
+    """
+    Query understanding, retrieval and fusion, one keyword set after another;
+    returns (keywords_list, results)
+    """
+    client = get_openai_client()
+    with start_budget():
+        keywords_list, context_analyses = understand_search_query(query, client, report)
+        search_function = search_programs if search_type == "Programs" else search_scholarships
+        return keywords_list, search_function(keywords_list, model, client, max_results, context_analyses, report)
+
+
+def verify_cached_search(cache, cached_response, max_results, model):
+    """
+    verify_cached_search_async for the sync engine
+    """
+    report = SearchReport()
+    try:
+        keywords_list, results = run_search(cached_response["query"], cached_response["type"], max_results,
+                                            model, report)
+    except Exception as e:
+        print(f"Result cache check failed: {e}")
+        return
+    live_response = search_response(cached_response["query"], cached_response["type"], keywords_list, results,
+                                    report, time.perf_counter())
+    check_cached_search(cache, cached_response, live_response)
+
+
+def search(query, search_type="Programs", max_results=10, model=None, engine=None):
+    """
+    Run a search in this process and return the search response.
+    engine "async" (default, SEARCH_ENGINE) runs all intents and field queries
+    concurrently on the shared event loop; "sync" runs them one after another.
+    Similar queries are answered from the result cache (see result_cache.py).
+    """
+    engine = engine or get_setting("SEARCH_ENGINE", "async")
+    if engine == "async":
+        return run_coroutine(search_async(query, search_type, max_results, model))
+
+    start = time.perf_counter()
+    report = SearchReport()
+    keywords_list, results = [], []
+    cache = get_result_cache()
+    query_vector = None
+    try:
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f"Unknown search type {search_type!r}, expected one of {', '.join(SEARCH_TYPES)}")
+        model = model or get_model()
+        if cache.enabled:
+            query_vector = encode_queries(model, [query])[0]
+            cached = lookup_cached_search(cache, query, query_vector, search_type, max_results)
+            if cached is not None:
+                if cache.should_verify():
+                    threading.Thread(target=verify_cached_search, args=(cache, cached, max_results, model),
+                                     name="result-cache-check", daemon=True).start()
+                cached["took_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                return cached
+        keywords_list, results = run_search(query, search_type, max_results, model, report)
+    except Exception as e:
+        report.error("search_failed", f"An error occurred during search: {str(e)}")
+    response = search_response(query, search_type, keywords_list, results, report, start)
+    if query_vector is not None and cacheable(report.messages):
+        store_cached_search(cache, query_vector, response, max_results)
+    return response
+
+
+class ProvisionalRanking:
+    """
+    Fuses the partial intent results of a streamed search and publishes a
+    provisional response whenever its top results change
+    """
+
+    def __init__(self, query, search_type, max_results, publish):
+        self.query = query
+        self.search_type = search_type
+        self.max_results = max_results
+        self.publish = publish
+        self.start = time.perf_counter()
+        # Set once the understood search reports; preview rankings are dropped from then on
+        self.refining = False
+        self._last_ids = None
+        self._lock = threading.Lock()
+
+    def update(self, keywords_list, intent_results):
+        self._fuse(keywords_list, intent_results, "partial")
+
+    def preview(self, keywords_list, intent_results):
+        self._fuse(keywords_list, intent_results, "preview")
+
+    def _fuse(self, keywords_list, intent_results, stage):
+        with self._lock:
+            if stage == "preview" and self.refining:
+                return
+            self.refining = self.refining or stage == "partial"
+            location_mode = "filter" if self.search_type == "Programs" else "boost"
+            results, _ = fuse_results(intent_results, self.max_results, location_mode=location_mode)
+            ids = [hit["_id"] for hit in results]
+            if not ids or ids == self._last_ids:
+                return
+            if self._last_ids is None:
+                observe("search_first_result_seconds", time.perf_counter() - self.start, stage=stage)
+            self._last_ids = ids
+
+            report = SearchReport()
+            report.detected_location = next(
+                (location for _, location, _ in reversed(intent_results) if location), None
+            )
+            response = search_response(self.query, self.search_type, keywords_list, results, report, self.start)
+            response.update(final=False, stage=stage)
+        self.publish(response)
+
+
+async def preview_search_async(query, search_type, max_results, model, ranking):
+    """
+    Search the query as typed with the base weights and the gazetteer location
+    and report to ranking.preview: a first ranking without any LLM call, shown
+    while the query is being understood
+    """
+    _progress_listener.set(ranking.preview)
+    if search_type == "Programs":
+        index_name, base_weights, source_fields = ProgramindexName, PROGRAM_BASE_WEIGHTS, PROGRAM_SUMMARY_FIELDS
+    else:
+        index_name, base_weights, source_fields = (ScholarshipIndexName, SCHOLARSHIP_BASE_WEIGHTS,
+                                                   SCHOLARSHIP_SUMMARY_FIELDS)
+    try:
+        with span("preview_search"):
+            model = model or await asyncio.to_thread(get_model)
+            await run_concurrent_search(
+                [query], model, index_name, base_weights, source_fields, max_results,
+                location_fallback=search_type == "Scholarships", report=SearchReport(),
+                context_analyses=[local_context_analysis(query)]
+            )
+    except Exception as e:
+        print(f"Preview search failed: {e}")
+
+
+def stream_error_response(query, search_type, start, reason):
+    """
+    Final response of a streamed search that ended without the response of search()
+    """
+    report = SearchReport()
+    report.error("search_failed", f"An error occurred during search: {reason}")
+    return dict(search_response(query, search_type, [], [], report, start), final=True, stage="final")
+
+
+async def search_stream_async(query, search_type="Programs", max_results=10, model=None):
+    """
+    Async search_stream: yields provisional responses ("final": False) as the
+    hits come back, then the response of search_async ("final": True)
+    """
+    updates = asyncio.Queue()
+    ranking = ProvisionalRanking(query, search_type, max_results, updates.put_nowait)
+
+    async def run():
+        _progress_listener.set(ranking.update)
+        final = None
+        try:
+            final = dict(await search_async(query, search_type, max_results, model), final=True, stage="final")
+        except Exception as e:
+            final = stream_error_response(query, search_type, ranking.start, e)
+        finally:
+            # The stream always ends with a final response, so readers never wait forever
+            updates.put_nowait(final or stream_error_response(query, search_type, ranking.start,
+                                                              "the search was cancelled"))
+
+    tasks = [asyncio.ensure_future(run())]
+    # The preview costs a full search with the base weights: opt-in
+    if search_type in SEARCH_TYPES and get_setting("STREAM_PREVIEW", False, bool):
+        tasks.append(asyncio.ensure_future(preview_search_async(query, search_type, max_results, model, ranking)))
+    try:
+        while True:
+            response = await updates.get()
+            # Skip provisional rankings that a newer one replaced while the caller was busy
+            while not response["final"] and not updates.empty():
+                response = updates.get_nowait()
+            yield response
+            if response["final"]:
+                return
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def search_stream(query, search_type="Programs", max_results=10, model=None, engine=None):
+    """
+    Run a search in this process and yield its rankings as they improve.
+    Provisional responses ("final": False, "stage": "preview" or "partial")
+    come first: with the async engine and STREAM_PREVIEW a preview of the
+    query as typed, then rankings fused from the intents (and fields) received
+    so far. The last response is the one search() returns, with "final": True,
+    or an error response when the search failed.
+    """
+    engine = engine or get_setting("SEARCH_ENGINE", "async")
+    start = time.perf_counter()
+    updates = queue.Queue()
+    if engine == "async":
+        async def run():
+            final = None
+            try:
+                async for response in search_stream_async(query, search_type, max_results, model):
+                    if response["final"]:
+                        final = response
+                    else:
+                        updates.put(response)
+            except Exception as e:
+                final = stream_error_response(query, search_type, start, e)
+            finally:
+                updates.put(final or stream_error_response(query, search_type, start, "the search was cancelled"))
+        asyncio.run_coroutine_threadsafe(run(), get_event_loop())
+    else:
+        ranking = ProvisionalRanking(query, search_type, max_results, updates.put)
+
+        def run():
+            _progress_listener.set(ranking.update)
+            final = None
+            try:
+                final = dict(search(query, search_type, max_results, model, engine), final=True, stage="final")
+            except Exception as e:
+                final = stream_error_response(query, search_type, start, e)
+            finally:
+                updates.put(final or stream_error_response(query, search_type, start, "the search was cancelled"))
+        # The copied context keeps the caller's trace for the spans of the search
+        threading.Thread(target=copy_context().run, args=(run,), name="search-stream", daemon=True).start()
+
+    while True:
+        response = updates.get()
+        while not response["final"] and not updates.empty():
+            response = updates.get_nowait()
+        yield response
+        if response["final"]:
+            return
+
+
+def fetch_details(search_type, ids):
+    """
+    Load the detail fields of the results being shown with one batched mget;
+    never raises, returns {"type", "documents": {_id: fields}, "messages"}
+    """
+    report = SearchReport()
+    documents = {}
+    if search_type == "Programs":
+        index_name, detail_fields = ProgramindexName, PROGRAM_DETAIL_FIELDS
+    else:
+        index_name, detail_fields = ScholarshipIndexName, SCHOLARSHIP_DETAIL_FIELDS
+    try:
+        documents = fetch_sources(get_es_client(index_name), index_name, ids, detail_fields)
+    except Exception as e:
+        report.warning("details_failed", f"Could not load the result details: {str(e)}")
+    return {"type": search_type, "documents": documents, "messages": report.messages}
+
+
+def _post_service(service_url, path, payload, timeout=None):
+    # JSON request to the search service; request errors come back as a JSON body
+    request = urllib.request.Request(
+        service_url.rstrip("/") + path,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    timeout = timeout or get_setting("SEARCH_SERVICE_TIMEOUT", 30, float)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as res:
+            return json.loads(res.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        try:
+            return json.loads(e.read().decode("utf-8"))
+        except ValueError:
+            raise RuntimeError(f"HTTP {e.code}") from e
+
+
+def remote_search(service_url, query, search_type="Programs", max_results=10, include_trace=False, timeout=None):
+    """
+    Run a search on a search service (search_service.py); never raises,
+    failures are returned as error messages
+    """
+    payload = {"query": query, "type": search_type, "max_results": max_results, "trace": include_trace}
+    start = time.perf_counter()
+    try:
+        with span("remote_search", url=service_url):
+            return _post_service(service_url, "/search", payload, timeout)
+    except Exception as e:
+        report = SearchReport()
+        report.error("service_unavailable", f"Search service unavailable: {str(e)}")
+        return search_response(query, search_type, [], [], report, start)
+
+
+def remote_search_stream(service_url, query, search_type="Programs", max_results=10, include_trace=False,
+                         timeout=None):
+    """
+    search_stream on a search service (POST /search/stream, one JSON response
+    per line); never raises, failures end the stream with an error response
+    """
+    payload = {"query": query, "type": search_type, "max_results": max_results, "trace": include_trace}
+    request = urllib.request.Request(
+        service_url.rstrip("/") + "/search/stream",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    timeout = timeout or get_setting("SEARCH_SERVICE_TIMEOUT", 30, float)
+    start = time.perf_counter()
+    report = SearchReport()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as res:
+            for line in res:
+                if not line.strip():
+                    continue
+                response = json.loads(line.decode("utf-8"))
+                yield response
+                if response.get("final", True):
+                    return
+        report.error("service_unavailable", "Search service closed the stream before the final results")
+    except urllib.error.HTTPError as e:
+        try:
+            # Invalid requests are answered with a single JSON response
+            yield dict(json.loads(e.read().decode("utf-8")), final=True, stage="final")
+            return
+        except ValueError:
+            report.error("service_unavailable", f"Search service unavailable: HTTP {e.code}")
+    except Exception as e:
+        report.error("service_unavailable", f"Search service unavailable: {str(e)}")
+    yield dict(search_response(query, search_type, [], [], report, start), final=True, stage="final")
+
+
+def remote_fetch_details(service_url, search_type, ids, timeout=None):
+    """
+    fetch_details on a search service; never raises
+    """
+    try:
+        with span("remote_details", url=service_url, docs=len(ids)):
+            return _post_service(service_url, "/details", {"type": search_type, "ids": list(ids)}, timeout)
+    except Exception as e:
+        report = SearchReport()
+        report.warning("details_failed", f"Could not load the result details: {str(e)}")
+        return {"type": search_type, "documents": {}, "messages": report.messages}
@@ -0,0 +1,217 @@
+"""
+Stateless HTTP/JSON search service built on search_engine, so search workers
+can be scaled separately from the Streamlit UI sessions.
+
+    python search_service.py --port 8080 --workers 4
+
+POST /search with {"query": "...", "type": "Programs" | "Scholarships",
+"max_results": 10, "trace": false} returns the search response: results,
+keywords, detected location and any warnings or errors as messages. Results
+carry summary fields; POST /details with {"type": ..., "ids": [...]} loads the
+remaining fields of the results a client shows. POST /search/stream takes the
+same body and streams provisional rankings as they improve, one JSON response
+per line, ending with the final one.
+GET /health reports readiness and GET /metrics serves Prometheus metrics.
+
+Each worker is a separate process with its own model and connection pools;
+all workers accept connections on the same port (SO_REUSEPORT).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+from aiohttp import web
+
+from encoder import get_model, model_stats
+from search_engine import (SEARCH_TYPES, SearchReport, fetch_details, search_async, search_response,
+                           search_stream_async, stream_error_response)
+from telemetry import prometheus_text, start_trace, waterfall
+
+MAX_RESULTS_LIMIT = 50
+
+# Results a client can ask details for at once (one page)
+MAX_DETAIL_IDS = 100
+
+
+def parse_search_request(payload):
+    """
+    Validate a /search request body; raises ValueError with a readable reason
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("Request body must be a JSON object")
+
+    query = payload.get("query")
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError("'query' must be a non-empty string")
+
+    search_type = payload.get("type", "Programs")
+    if search_type not in SEARCH_TYPES:
+        raise ValueError(f"'type' must be one of {', '.join(SEARCH_TYPES)}")
+
+    max_results = payload.get("max_results", 10)
+    if isinstance(max_results, bool) or not isinstance(max_results, int) or not 1 <= max_results <= MAX_RESULTS_LIMIT:
+        raise ValueError(f"'max_results' must be an integer from 1 to {MAX_RESULTS_LIMIT}")
+
+    return query.strip(), search_type, max_results, bool(payload.get("trace", False))
+
+
+def parse_details_request(payload):
+    """
+    Validate a /details request body; raises ValueError with a readable reason
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("Request body must be a JSON object")
+
+    search_type = payload.get("type", "Programs")
+    if search_type not in SEARCH_TYPES:
+        raise ValueError(f"'type' must be one of {', '.join(SEARCH_TYPES)}")
+
+    ids = payload.get("ids")
+    if not isinstance(ids, list) or not all(isinstance(doc_id, str) for doc_id in ids):
+        raise ValueError("'ids' must be a list of document ids")
+    if len(ids) > MAX_DETAIL_IDS:
+        raise ValueError(f"At most {MAX_DETAIL_IDS} ids can be requested at once")
+
+    return search_type, ids
+
+
+async def handle_search(request):
+    start = time.perf_counter()
+    try:
+        payload = await request.json()
+        query, search_type, max_results, include_trace = parse_search_request(payload)
+    except ValueError as e:
+        # Also covers malformed JSON (json.JSONDecodeError is a ValueError)
+        report = SearchReport()
+        report.error("invalid_request", str(e))
+        return web.json_response(search_response(None, None, [], [], report, start), status=400)
+
+    with start_trace("search", search_type=search_type, max_results=max_results, service=True) as trace:
+        response = await search_async(query, search_type, max_results, request.app["model"])
+    response["trace_id"] = trace.trace_id
+    if include_trace:
+        response["trace"] = waterfall(trace)
+    return web.json_response(response)
+
+
+async def handle_search_stream(request):
+    start = time.perf_counter()
+    try:
+        payload = await request.json()
+        query, search_type, max_results, include_trace = parse_search_request(payload)
+    except ValueError as e:
+        report = SearchReport()
+        report.error("invalid_request", str(e))
+        return web.json_response(search_response(None, None, [], [], report, start), status=400)
+
+    stream = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await stream.prepare(request)
+    response = None
+    with start_trace("search", search_type=search_type, max_results=max_results, service=True,
+                     stream=True) as trace:
+        async for update in search_stream_async(query, search_type, max_results, request.app["model"]):
+            if update["final"]:
+                response = update
+            else:
+                await stream.write((json.dumps(update) + "\n").encode("utf-8"))
+    if response is None:
+        response = stream_error_response(query, search_type, start, "the search ended without final results")
+    # The final response is sent after the trace ends, so it can carry the waterfall
+    response["trace_id"] = trace.trace_id
+    if include_trace:
+        response["trace"] = waterfall(trace)
+    await stream.write((json.dumps(response) + "\n").encode("utf-8"))
+    await stream.write_eof()
+    return stream
+
+
+async def handle_details(request):
+    try:
+        search_type, ids = parse_details_request(await request.json())
+    except ValueError as e:
+        report = SearchReport()
+        report.error("invalid_request", str(e))
+        return web.json_response({"type": None, "documents": {}, "messages": report.messages}, status=400)
+
+    # mget uses the blocking client, keep it off the event loop
+    return web.json_response(await asyncio.to_thread(fetch_details, search_type, ids))
+
+
+async def handle_health(request):
+    return web.json_response({
+        "status": "ok" if request.app["model"] is not None else "starting",
+        "pid": os.getpid(),
+        "model": model_stats()
+    })
+
+
+async def handle_metrics(request):
+    return web.Response(text=prometheus_text(), content_type="text/plain", charset="utf-8")
+
+
+async def load_model(app):
+    # Load before accepting searches so the first request doesn't pay for it
+    app["model"] = await asyncio.to_thread(get_model)
+
+
+def create_app():
+    """
+    Build the aiohttp application
+    """
+    app = web.Application()
+    app["model"] = None
+    app.on_startup.append(load_model)
+    app.router.add_post("/search", handle_search)
+    app.router.add_post("/search/stream", handle_search_stream)
+    app.router.add_post("/details", handle_details)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def serve(host, port, reuse_port=False):
+    """
+    Run one worker until interrupted
+    """
+    web.run_app(create_app(), host=host, port=port, reuse_port=reuse_port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the HTTP/JSON search service")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes sharing the port")
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not available on this platform, running a single worker")
+        workers = 1
+
+    print(f"Search service listening on http://{args.host}:{args.port} with {workers} worker(s)")
+    if workers == 1:
+        serve(args.host, args.port)
+        return
+
+    processes = [
+        multiprocessing.Process(target=serve, args=(args.host, args.port, True), name=f"search-worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import os
+
+
+def get_setting(name, default=None, cast=None):
+    """
+    Read a setting from the environment, falling back to Streamlit secrets
+    """
+    value = os.environ.get(name)
+
+    if value is None:
+        try:
+            import streamlit as st
+            value = st.secrets.get(name)
+        except Exception:
+            # No secrets file (or not running under Streamlit)
+            value = None
+
+    if value is None or value == "":
+        return default
+
+    if cast is bool and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if cast is not None:
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            print(f"Invalid value for setting {name}: {value!r}, using {default!r}")
+            return default
+    return value
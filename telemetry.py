@@ -0,0 +1,399 @@
+"""
+Per-stage instrumentation for the search pipeline.
+
+Stages record spans (name, start, duration, attributes) into the trace of the
+current search, and feed process-wide Prometheus metrics. Spans nest through
+contextvars, so they follow asyncio tasks and asyncio.to_thread calls.
+Completed traces are kept in memory for the debug panel and can be exported as
+OTLP/JSON to a collector or a file.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from settings import get_setting
+
+# Upper bounds (seconds) of the stage latency histogram buckets
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Histograms of something other than seconds
+METRIC_BUCKETS = {
+    "encoder_batch_size": (1, 2, 4, 8, 16, 32, 64, 128)
+}
+
+METRIC_HELP = {
+    "search_stage_seconds": ("histogram", "Duration of each search pipeline stage"),
+    "search_seconds": ("histogram", "End-to-end duration of a search"),
+    "es_took_seconds": ("histogram", "Server-side time Elasticsearch reported for a kNN request"),
+    "llm_tokens_total": ("counter", "OpenAI tokens used, by kind"),
+    "llm_timeouts_total": ("counter", "LLM calls given up on, by stage and reason (timeout or budget)"),
+    "llm_hedges_total": ("counter", "Duplicate LLM requests sent because the first was slow, by stage"),
+    "llm_retries_total": ("counter", "LLM calls retried after an error, by stage"),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result"),
+    "result_cache_checks_total": ("counter", "Cached search results re-checked against a live search, by outcome"),
+    "result_cache_version_errors_total": ("counter", "Index version reads of the result cache that failed"),
+    "search_errors_total": ("counter", "Failed pipeline stages"),
+    "encoder_batch_size": ("histogram", "Distinct texts per batch of the encoder worker"),
+    "encoder_queue_wait_seconds": ("histogram", "Time encode requests wait for their batch"),
+    "encoder_queue_depth": ("gauge", "Encode requests waiting for a batch"),
+    "rate_limit_wait_seconds": ("histogram", "Time requests waited for the rate limit of their service"),
+    "search_first_result_seconds": ("histogram", "Time until a streamed search showed its first ranking, by stage")
+}
+
+# Completed traces kept for the debug panel
+RECENT_TRACES = 100
+
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+_metrics_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_recent = deque(maxlen=RECENT_TRACES)
+
+_server = None
+_exporter_queue = None
+_service_lock = threading.Lock()
+
+
+def enabled():
+    """
+    Return False when instrumentation is switched off (TELEMETRY=off)
+    """
+    return get_setting("TELEMETRY", True, bool)
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def count(name, value=1, **labels):
+    """
+    Increment a counter
+    """
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    """
+    Set a gauge to its current value
+    """
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        _gauges[key] = value
+
+
+def observe(name, value, **labels):
+    """
+    Record a histogram observation (seconds, unless METRIC_BUCKETS says otherwise)
+    """
+    key = (name, _labels(labels))
+    buckets = METRIC_BUCKETS.get(name, HISTOGRAM_BUCKETS)
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * len(buckets) + [0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+class Span:
+    """
+    One timed stage of a trace
+    """
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes):
+        """
+        Add attributes, e.g. results known only at the end of the stage
+        """
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self):
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+
+class Trace:
+    """
+    All spans of one search
+    """
+
+    def __init__(self, name, attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(name, self.trace_id, None, attributes)
+        self.spans = [self.root]
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a stage as a child of the current span; metrics are recorded even
+    outside a trace. Exceptions are recorded on the span and re-raised.
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    current = Span(name, trace.trace_id if trace else None, parent.span_id if parent else None, attributes)
+    if not enabled():
+        yield current
+        return
+
+    if trace is not None:
+        trace.add(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        count("search_errors_total", stage=name)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end_ns = time.time_ns()
+        observe("search_stage_seconds", (current.end_ns - current.start_ns) / 1e9, stage=name)
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """
+    Start the trace of one search; yields the Trace and exports it when done
+    """
+    trace = Trace(name, attributes)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(trace.root)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.root.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        trace.root.end_ns = time.time_ns()
+        if enabled():
+            observe("search_seconds", (trace.root.end_ns - trace.root.start_ns) / 1e9, search=name)
+            _recent.append(trace)
+            _export(trace)
+
+
+def current_span():
+    """
+    Return the innermost active span, or None
+    """
+    return _current_span.get()
+
+
+def recent_traces():
+    """
+    Return the most recent completed traces, newest last
+    """
+    return list(_recent)
+
+
+def waterfall(trace):
+    """
+    Return the spans of a trace as rows for a waterfall view, in start order:
+    name, depth, offset and duration in ms, attributes and error
+    """
+    depths = {trace.root.span_id: 0}
+    rows = []
+    for item in sorted(trace.spans, key=lambda s: s.start_ns):
+        depth = depths.get(item.parent_id, 0) + 1 if item.parent_id else 0
+        depths[item.span_id] = depth
+        rows.append({
+            "name": item.name,
+            "depth": depth,
+            "offset_ms": (item.start_ns - trace.root.start_ns) / 1e6,
+            "duration_ms": item.duration_ms,
+            "attributes": item.attributes,
+            "error": item.error
+        })
+    return rows
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{key}="{_escape(value)}"' for key, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def prometheus_text():
+    """
+    Render every metric in the Prometheus text exposition format
+    """
+    with _metrics_lock:
+        series_by_kind = {
+            "counter": dict(_counters),
+            "gauge": dict(_gauges),
+            "histogram": {key: list(value) for key, value in _histograms.items()}
+        }
+
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        series = series_by_kind[kind]
+        keys = sorted(key for key in series if key[0] == name)
+        if not keys:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key in keys:
+            labels = key[1]
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {series[key]}")
+                continue
+            histogram = series[key]
+            for bound, bucket_count in zip(METRIC_BUCKETS.get(name, HISTOGRAM_BUCKETS), histogram):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(trace, service_name="education-search"):
+    """
+    Convert a trace to an OTLP/JSON ExportTraceServiceRequest
+    """
+    spans = []
+    for item in trace.spans:
+        otlp_span = {
+            "traceId": trace.trace_id,
+            "spanId": item.span_id,
+            "name": item.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(item.start_ns),
+            "endTimeUnixNano": str(item.end_ns or item.start_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)}
+                           for key, value in item.attributes.items() if value is not None],
+            "status": {"code": 2, "message": item.error} if item.error else {"code": 1}
+        }
+        if item.parent_id:
+            otlp_span["parentSpanId"] = item.parent_id
+        spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "telemetry"}, "spans": spans}]
+        }]
+    }
+
+
+def _export(trace):
+    # Exports happen on a worker thread so a slow collector never delays a search
+    global _exporter_queue
+    endpoint = get_setting("OTEL_EXPORTER_OTLP_ENDPOINT")
+    trace_file = get_setting("TELEMETRY_TRACE_FILE")
+    if not endpoint and not trace_file:
+        return
+    with _service_lock:
+        if _exporter_queue is None:
+            _exporter_queue = queue.Queue(maxsize=1000)
+            threading.Thread(target=_export_worker, name="trace-exporter", daemon=True).start()
+    try:
+        _exporter_queue.put_nowait((trace, endpoint, trace_file))
+    except queue.Full:
+        count("search_errors_total", stage="trace_export")
+
+
+def _export_worker():
+    while True:
+        trace, endpoint, trace_file = _exporter_queue.get()
+        payload = to_otlp(trace, get_setting("OTEL_SERVICE_NAME", "education-search"))
+        try:
+            if trace_file:
+                with open(trace_file, "a", encoding="utf-8") as out:
+                    out.write(json.dumps(payload) + "\n")
+            if endpoint:
+                request = urllib.request.Request(
+                    endpoint.rstrip("/") + "/v1/traces",
+                    data=json.dumps(payload).encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                    method="POST"
+                )
+                urllib.request.urlopen(request, timeout=5).close()
+        except Exception as e:
+            count("search_errors_total", stage="trace_export")
+            print(f"Trace export failed: {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port=None):
+    """
+    Serve /metrics for Prometheus on METRICS_PORT (once per process); no-op when unset
+    """
+    global _server
+    port = port or get_setting("METRICS_PORT", None, int)
+    if not port:
+        return None
+    with _service_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((get_setting("METRICS_HOST", "0.0.0.0"), port), _MetricsHandler)
+            except OSError as e:
+                print(f"Could not start the metrics server on port {port}: {e}")
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server